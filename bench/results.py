@@ -0,0 +1,56 @@
+# Project: orbit-profile
+# Module: results.py
+#
+# Writes benchmark results as JSON and compares them against a baseline so
+# results can be tracked across commits.
+
+import json, platform, subprocess
+from typing import List
+
+from stubs import PROFILE_DIR
+
+
+def header() -> dict:
+    '''Describes the machine and commit the results were measured on.'''
+    proc = subprocess.run(['git', '-C', PROFILE_DIR, 'rev-parse', '--short', 'HEAD'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    return {
+        'commit': proc.stdout.decode('utf-8').strip() if proc.returncode == 0 else None,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+    }
+
+
+def write(results: dict, output: str=None):
+    '''Prints the `results` or saves them to the file `output`.'''
+    text = json.dumps(results, indent=2)
+    if output is not None:
+        with open(output, 'w') as f:
+            f.write(text+'\n')
+    else:
+        print(text)
+    pass
+
+
+def _metrics(data: dict, prefix: str=''):
+    '''Yields each timing (keys ending in `_ms`) within the nested `data`.'''
+    for (key, value) in data.items():
+        if isinstance(value, dict) == True:
+            yield from _metrics(value, prefix+key+'.')
+        elif key.endswith('_ms') == True and isinstance(value, (int, float)) == True:
+            yield (prefix+key, value)
+    pass
+
+
+def compare(results: dict, baseline_file: str, threshold: float) -> List[str]:
+    '''Lists timings that are slower than in the baseline by over `threshold` percent.'''
+    with open(baseline_file, 'r') as f:
+        before = dict(_metrics(json.load(f).get('results', {})))
+    regressions = []
+    for (name, now) in _metrics(results.get('results', {})):
+        if name not in before or before[name] <= 0:
+            continue
+        change = (now - before[name]) / before[name] * 100
+        if change > threshold:
+            regressions += [name+': '+'{:.2f}'.format(before[name])+' -> '+'{:.2f}'.format(now)+' ms (+'+'{:.1f}'.format(change)+'%)']
+        pass
+    return regressions
@@ -0,0 +1,116 @@
+# Project: orbit-profile
+# Benchmark: startup
+#
+# Measures how quickly each plugin and protocol gets going.
+#
+# For every entry point, two numbers are recorded:
+#   - import time: the cumulative time of all imports made while showing the
+#     help message, as reported by `python -X importtime`
+#   - first tool: the time from starting the plugin until its first tool is
+#     launched, using stub tools from `stubs.py` in a sandbox
+#
+# Results are written as JSON. Passing a previous result with '--baseline'
+# reports any measurement that got slower by more than '--threshold' percent
+# and exits with a nonzero code.
+#
+# Usage:
+#   python bench/startup.py [--repeat N] [--output FILE] [--baseline FILE]
+
+import os, sys, time, statistics, subprocess, tempfile, argparse
+from typing import Dict, List
+
+from stubs import PROFILE_DIR, make_sandbox, read_stamps
+import results as report
+
+# entry points with the arguments that reach their first tool launch
+ENTRIES = {
+    'gsim': (['plugins/gsim.py', '--lint', '--enable-veriti', '0'], True),
+    'msim': (['plugins/msim.py', '--lint'], True),
+    'quartz': (['plugins/quartz.py'], True),
+    'xsim': (['plugins/xsim.py', '--compile'], True),
+    'zipr': (['plugins/zipr.py', '--force'], False),
+    'zipp': (['protocols/zipp.py', '--gc'], False),
+    'p-git': (['protocols/p-git.py', 'https://example.com/repo.git###v1.0.0'], True),
+}
+
+
+def import_time(script: str, env: Dict[str, str]) -> Dict[str, float]:
+    '''Runs `script --help` with `-X importtime` and sums the top-level imports.
+
+    Returns the total import time and the slowest top-level modules in milliseconds.'''
+    proc = subprocess.run([sys.executable, '-X', 'importtime', script, '--help'], env=env, cwd=env['ORBIT_BUILD_DIR'], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    total = 0
+    modules = {}
+    for line in proc.stderr.decode('utf-8', errors='replace').splitlines():
+        if line.startswith('import time:') == False:
+            continue
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3 or fields[1].strip().isdigit() == False:
+            continue
+        name = fields[2].rstrip()
+        # only modules imported directly by the script start without nesting
+        if name.startswith('  ') == True:
+            continue
+        micros = int(fields[1])
+        total += micros
+        modules[name.strip()] = micros / 1000
+    slowest = dict(sorted(modules.items(), key=lambda kv: kv[1], reverse=True)[:5])
+    return {'import_ms': total / 1000, 'slowest': slowest}
+
+
+def launch_time(args: List[str], env: Dict[str, str]) -> Dict[str, float]:
+    '''Runs the entry point and measures the delay until the first stub tool starts.'''
+    read_stamps(env)
+    start = time.time()
+    subprocess.run([sys.executable] + args, env=env, cwd=env['ORBIT_BUILD_DIR'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    total = time.time() - start
+    stamps = read_stamps(env)
+    first = (min(stamps) - start) * 1000 if len(stamps) > 0 else None
+    return {'first_tool_ms': first, 'total_ms': total * 1000}
+
+
+def measure(name: str, repeat: int, env: Dict[str, str]) -> dict:
+    args, uses_tool = ENTRIES[name]
+    script = os.path.join(PROFILE_DIR, args[0])
+    runs = [import_time(script, env) for _ in range(repeat)]
+    launches = [launch_time([script] + args[1:], env) for _ in range(repeat)]
+    result = {
+        'import_ms': statistics.median([r['import_ms'] for r in runs]),
+        'slowest_imports': runs[-1]['slowest'],
+        'total_ms': statistics.median([r['total_ms'] for r in launches]),
+    }
+    firsts = [r['first_tool_ms'] for r in launches if r['first_tool_ms'] is not None]
+    if uses_tool == True and len(firsts) > 0:
+        result['first_tool_ms'] = statistics.median(firsts)
+    return result
+
+
+parser = argparse.ArgumentParser(prog='startup', allow_abbrev=False)
+
+parser.add_argument('--repeat', type=int, default=5, metavar='NUM', help='number of runs to take the median of')
+parser.add_argument('--only', action='append', default=[], choices=list(ENTRIES.keys()), help='measure only the given entry point')
+parser.add_argument('--output', '-o', default=None, metavar='FILE', help='write the results to a file instead of stdout')
+parser.add_argument('--baseline', default=None, metavar='FILE', help='previous results to check for regressions')
+parser.add_argument('--threshold', type=float, default=20.0, metavar='PCT', help='allowed slowdown against the baseline')
+
+args = parser.parse_args()
+
+results = report.header()
+results['repeat'] = args.repeat
+results['results'] = {}
+
+with tempfile.TemporaryDirectory(prefix='orbit-bench-') as root:
+    env = make_sandbox(root)
+    for name in (args.only if len(args.only) > 0 else ENTRIES.keys()):
+        results['results'][name] = measure(name, args.repeat, env)
+        print('info: Measured', name, file=sys.stderr)
+    pass
+
+report.write(results, args.output)
+
+if args.baseline is not None:
+    regressions = report.compare(results, args.baseline, args.threshold)
+    for r in regressions:
+        print('error: Startup regression in', r, file=sys.stderr)
+    if len(regressions) > 0:
+        exit(1)
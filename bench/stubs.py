@@ -0,0 +1,117 @@
+# Project: orbit-profile
+# Module: stubs.py
+#
+# Creates a sandbox for benchmarking the plugins without the real EDA tools.
+#
+# Every tool the plugins invoke is replaced by a small shell script placed first
+# on PATH. Each stub records the time it was launched in a stamp file so the
+# delay between starting a plugin and its first tool launch can be measured, and
+# so the time spent inside the tools can be separated from the plugin's own.
+
+import os
+from typing import Dict, List
+
+# root directory of the profile
+PROFILE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# executables the plugins and protocols call
+TOOLS = [
+    'ghdl',
+    'vlib', 'vmap', 'vcom', 'vsim',
+    'xvhdl', 'xelab', 'xsim',
+    'quartus_sh', 'quartus_map', 'quartus_fit', 'quartus_sta', 'quartus_asm', 'quartus_eda', 'quartus_pgm', 'quartus',
+    'orbit',
+    'git',
+]
+
+# each stub records its launch, waits for BENCH_STUB_LATENCY seconds, and then
+# prints BENCH_STUB_LINES lines of output. A '--log <file>' argument (xsim) is
+# created so plugins that read the tool's log can continue.
+STUB = '''#!/bin/sh
+date +%s.%N >> "$BENCH_STAMP_FILE"
+if [ -n "$BENCH_STUB_LATENCY" ]; then
+    sleep "$BENCH_STUB_LATENCY"
+fi
+if [ "${BENCH_STUB_LINES:-0}" -gt 0 ]; then
+    yes "$(basename "$0"): stub output" | head -n "$BENCH_STUB_LINES"
+fi
+prev=""
+for arg in "$@"; do
+    if [ "$prev" = "--log" ]; then
+        : > "$arg"
+    fi
+    prev="$arg"
+done
+exit 0
+'''
+
+
+def make_stubs(bin_dir: str, tools: List[str]=TOOLS):
+    '''Writes an executable stub for each of the `tools` into `bin_dir`.'''
+    os.makedirs(bin_dir, exist_ok=True)
+    for tool in tools:
+        path = os.path.join(bin_dir, tool)
+        with open(path, 'w') as f:
+            f.write(STUB)
+        os.chmod(path, 0o755)
+    pass
+
+
+def make_sandbox(root: str, rules: int=2, latency: float=0.0, lines: int=0) -> Dict[str, str]:
+    '''Creates a build directory with a blueprint of `rules` HDL rules under `root`.
+
+    Returns the environment variables to run a plugin within the sandbox, with
+    stub tools that take `latency` seconds and print `lines` lines.'''
+    ip_dir = os.path.join(root, 'ip')
+    build_dir = os.path.join(ip_dir, 'build')
+    bin_dir = os.path.join(root, 'bin')
+    os.makedirs(build_dir, exist_ok=True)
+    make_stubs(bin_dir)
+
+    blueprint = os.path.join(build_dir, 'blueprint.tsv')
+    with open(blueprint, 'w') as bp:
+        for i in range(rules):
+            src = os.path.join(ip_dir, 'rtl', 'unit'+str(i)+'.vhd')
+            os.makedirs(os.path.dirname(src), exist_ok=True)
+            with open(src, 'w') as f:
+                f.write('entity unit'+str(i)+' is end entity;\n')
+            fileset = 'VHDL-SIM' if i == rules - 1 else 'VHDL-RTL'
+            bp.write(fileset+'\twork\t'+src+'\n')
+        board = os.path.join(ip_dir, 'dev.board')
+        with open(board, 'w') as f:
+            f.write('[part]\nFAMILY = "MAX 10"\nDEVICE = "10M50DAF484C7G"\n\n[pins]\nPIN_A1 = "clk"\n')
+        bp.write('BOARD-CF\tdev\t'+board+'\n')
+        submission = os.path.join(ip_dir, 'submission.txt')
+        with open(submission, 'w') as f:
+            f.write('unit0.vhd\n')
+        bp.write('ZIP-LIST\tsubmission\t'+submission+'\n')
+        pass
+
+    env = dict(os.environ)
+    env.update({
+        'PATH': bin_dir + os.pathsep + env.get('PATH', ''),
+        'BENCH_STAMP_FILE': os.path.join(root, 'stamps.txt'),
+        'BENCH_STUB_LATENCY': str(latency) if latency > 0 else '',
+        'BENCH_STUB_LINES': str(lines),
+        'ORBIT_BLUEPRINT': blueprint,
+        'ORBIT_BUILD_DIR': build_dir,
+        'ORBIT_IP_PATH': ip_dir,
+        'ORBIT_IP_NAME': 'bench',
+        'ORBIT_TOP': 'unit0',
+        'ORBIT_BENCH': 'unit'+str(rules - 1),
+        'ORBIT_QUEUE': os.path.join(root, 'queue'),
+        'ORBIT_HOME': os.path.join(root, 'home'),
+        'ORBIT_ENV_PROFILE_DAEMON': 'off',
+    })
+    return env
+
+
+def read_stamps(env: Dict[str, str]) -> List[float]:
+    '''Returns the launch times recorded by the stubs, then clears them.'''
+    path = env['BENCH_STAMP_FILE']
+    if os.path.exists(path) == False:
+        return []
+    with open(path, 'r') as f:
+        stamps = [float(line) for line in f.read().split()]
+    os.remove(path)
+    return stamps
@@ -0,0 +1,145 @@
+# Project: orbit-profile
+# Benchmark: suite
+#
+# Measures the time the profile itself adds on top of the EDA tools.
+#
+# Each plugin runs end to end against stub tools (see `stubs.py`) with
+# synthetic blueprints of increasing size. The time spent inside the stubs
+# (launches x latency) is subtracted from the wall time to get the plugin's own
+# overhead. Micro-benchmarks cover the hot paths shared by the plugins:
+# `Blueprint.parse`, `Command` spawning, and zipr's file search.
+#
+# Results are written as JSON. Passing a previous result with '--baseline'
+# reports any timing that got slower by more than '--threshold' percent and
+# exits with a nonzero code.
+#
+# Usage:
+#   python bench/suite.py [--sizes 10,100,...] [--latency SEC] [--output FILE]
+
+import os, sys, ast, time, statistics, subprocess, tempfile, argparse
+from typing import Dict, List
+
+from stubs import PROFILE_DIR, make_sandbox, read_stamps
+import results as report
+
+sys.path.insert(0, os.path.join(PROFILE_DIR, 'plugins'))
+
+# plugins with the arguments that run their entire flow
+PLUGINS = {
+    'gsim': ['plugins/gsim.py', '--enable-veriti', '0'],
+    'msim': ['plugins/msim.py'],
+    'xsim': ['plugins/xsim.py', '--compile', '--elaborate', '--simulate', 'cl'],
+    'quartz': ['plugins/quartz.py', '--synth', '--route', '--sta', '--bit'],
+    'zipr': ['plugins/zipr.py', '--force'],
+}
+
+
+def end_to_end(name: str, env: Dict[str, str], latency: float, repeat: int) -> dict:
+    '''Runs the plugin `name` and separates its own time from the time in tools.'''
+    args = PLUGINS[name]
+    walls = []
+    launches = 0
+    rc = 0
+    for _ in range(repeat):
+        read_stamps(env)
+        start = time.perf_counter()
+        proc = subprocess.run([sys.executable, os.path.join(PROFILE_DIR, args[0])] + args[1:], env=env, cwd=env['ORBIT_BUILD_DIR'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        walls += [(time.perf_counter() - start) * 1000]
+        launches = len(read_stamps(env))
+        rc = proc.returncode
+    wall = statistics.median(walls)
+    return {
+        'wall_ms': wall,
+        'tool_launches': launches,
+        'overhead_ms': max(wall - launches * latency * 1000, 0.0),
+        'returncode': rc,
+    }
+
+
+def timeit(fn, repeat: int) -> float:
+    '''Returns the median time in milliseconds of calling `fn`.'''
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times += [(time.perf_counter() - start) * 1000]
+    return statistics.median(times)
+
+
+def load_functions(path: str) -> dict:
+    '''Loads only the imports and function definitions of the script at `path`.
+
+    The plugins run their workflow at the top level, so importing them directly
+    would execute the plugin.'''
+    with open(path, 'r') as f:
+        tree = ast.parse(f.read(), path)
+    tree.body = [n for n in tree.body if isinstance(n, (ast.FunctionDef, ast.Import, ast.ImportFrom)) == True]
+    namespace = {}
+    exec(compile(tree, path, 'exec'), namespace)
+    return namespace
+
+
+def micro(env: Dict[str, str], rules: int, repeat: int) -> dict:
+    '''Times the shared hot paths against a blueprint of `rules` rules.'''
+    from mod import Blueprint, Command
+    os.environ['ORBIT_BLUEPRINT'] = env['ORBIT_BLUEPRINT']
+    zipr = load_functions(os.path.join(PROFILE_DIR, 'plugins', 'zipr.py'))
+    space = [rule.path for rule in Blueprint().parse()]
+    return {
+        'blueprint_parse_ms': timeit(lambda: Blueprint().parse(), repeat),
+        # searching for a missing file scans the entire space
+        'zipr_search_ms': timeit(lambda: zipr['search']('missing.vhd', space), repeat),
+    }
+
+
+def spawn(repeat: int) -> dict:
+    '''Times launching a trivial process through `Command`.'''
+    from mod import Command
+    return {
+        'command_spawn_ms': timeit(lambda: Command('true').spawn(), repeat),
+        'command_output_ms': timeit(lambda: Command('true').output(), repeat),
+    }
+
+
+def parse_sizes(s: str) -> List[int]:
+    return [int(x) for x in s.split(',') if len(x.strip()) > 0]
+
+
+parser = argparse.ArgumentParser(prog='suite', allow_abbrev=False)
+
+parser.add_argument('--sizes', type=parse_sizes, default=[10, 100, 1000, 10000, 50000], metavar='N,...', help='blueprint sizes (number of rules) to measure')
+parser.add_argument('--e2e-max', type=int, default=1000, metavar='NUM', help='largest blueprint to run the plugins end to end on')
+parser.add_argument('--latency', type=float, default=0.0, metavar='SEC', help='time each stub tool takes to run')
+parser.add_argument('--lines', type=int, default=0, metavar='NUM', help='lines of output each stub tool prints')
+parser.add_argument('--repeat', type=int, default=3, metavar='NUM', help='number of runs to take the median of')
+parser.add_argument('--only', action='append', default=[], choices=list(PLUGINS.keys()), help='run only the given plugin end to end')
+parser.add_argument('--output', '-o', default=None, metavar='FILE', help='write the results to a file instead of stdout')
+parser.add_argument('--baseline', default=None, metavar='FILE', help='previous results to check for regressions')
+parser.add_argument('--threshold', type=float, default=20.0, metavar='PCT', help='allowed slowdown against the baseline')
+
+args = parser.parse_args()
+
+results = report.header()
+results['config'] = {'latency': args.latency, 'lines': args.lines, 'repeat': args.repeat}
+results['results'] = {'spawn': spawn(max(args.repeat, 20))}
+
+for size in args.sizes:
+    with tempfile.TemporaryDirectory(prefix='orbit-bench-') as root:
+        env = make_sandbox(root, rules=size, latency=args.latency, lines=args.lines)
+        entry = {'micro': micro(env, size, args.repeat)}
+        if size <= args.e2e_max:
+            for name in (args.only if len(args.only) > 0 else PLUGINS.keys()):
+                entry[name] = end_to_end(name, env, args.latency, args.repeat)
+                print('info: Measured', name, 'with', size, 'rules', file=sys.stderr)
+            pass
+        results['results']['rules-'+str(size)] = entry
+    pass
+
+report.write(results, args.output)
+
+if args.baseline is not None:
+    regressions = report.compare(results, args.baseline, args.threshold)
+    for r in regressions:
+        print('error: Overhead regression in', r, file=sys.stderr)
+    if len(regressions) > 0:
+        exit(1)
@@ -0,0 +1,347 @@
+# Project: orbit-profile
+# Module: artifacts.py
+#
+# A content-addressed cache of the outputs of expensive toolchain stages.
+#
+# Developers and CI runners build the same libraries, snapshots, checkpoints,
+# and bitstreams from the same commits. Before running a stage (analysis,
+# elaboration, synthesis, place and route, bitstream generation), a plugin
+# computes a key from every input of the stage: the tool and its version, the
+# options, and the contents of the source files or the key of the stage before
+# it. Absolute paths are left out so that keys match across machines. The
+# stage's outputs are saved as one archive under that key.
+#
+# Archives are looked up in a local directory first and then on an HTTP cache
+# server ('ORBIT_ENV_ARTIFACT_URL') that answers GET and PUT requests for
+# '<url>/<key>.tar.gz'. New archives are written to the local directory right
+# away and uploaded by a detached process, so a build never waits on the
+# network. The least recently used local archives are evicted past the size
+# limit.
+#
+# The module also runs as a script, which is how the Tcl flows use the cache
+# and how the bundled cache server is started:
+#
+#   python artifacts.py key <value|@file>...
+#   python artifacts.py fetch <key> [--dir DIR]
+#   python artifacts.py store <key> <path>... [--dir DIR]
+#   python artifacts.py serve [--bind ADDR] [--port PORT] [--root DIR]
+
+import os, sys, re, uuid, shutil, tarfile, argparse
+from typing import List
+
+from mod import Env, Command, Lock, Fingerprint, cache_home, evict
+
+# size limit of the local cache in megabytes if not set by the environment
+DEFAULT_LIMIT_MB = 8192
+
+# port of the bundled cache server
+DEFAULT_PORT = 8470
+
+# seconds to wait on the cache server before treating a request as a miss
+TIMEOUT = 30
+
+# a key is the hex digest of a `Fingerprint`
+KEY = re.compile(r'[0-9a-f]{64}')
+
+
+def default_root() -> str:
+    return Env.read('ORBIT_ENV_ARTIFACT_CACHE', default=os.path.join(cache_home(), 'artifacts'))
+
+
+def default_server_root() -> str:
+    return os.path.join(cache_home(), 'artifact-server')
+
+
+def default_url() -> str:
+    url = Env.read('ORBIT_ENV_ARTIFACT_URL', missing_ok=True)
+    return url.rstrip('/') if url is not None else None
+
+
+def _check_key(key: str):
+    if KEY.fullmatch(key) is None:
+        raise ValueError('invalid artifact key: '+key)
+    pass
+
+
+def _safe_members(archive: tarfile.TarFile):
+    '''Yields the regular files and directories of `archive` that stay inside
+    the directory it is extracted into.'''
+    for member in archive.getmembers():
+        parts = member.name.replace('\\', '/').split('/')
+        if os.path.isabs(member.name) == True or '..' in parts:
+            continue
+        if member.isfile() == True or member.isdir() == True:
+            yield member
+    pass
+
+
+class ArtifactCache:
+    '''Archives of stage outputs kept in a local directory and optionally
+    shared through an HTTP cache server.'''
+
+    def __init__(self, root: str=None, url: str=None):
+        self._root = root if root is not None else default_root()
+        self.url = url if url is not None else default_url()
+        self._limit = int(Env.read('ORBIT_ENV_ARTIFACT_CACHE_MB', default=str(DEFAULT_LIMIT_MB))) * 1024 * 1024
+        os.makedirs(self._root, exist_ok=True)
+        pass
+
+
+    def _entry(self, key: str) -> str:
+        _check_key(key)
+        return os.path.join(self._root, key[:2], key+'.tar.gz')
+
+
+    def _download(self, key: str, entry: str) -> bool:
+        '''Copies the archive for `key` from the cache server into `entry`.'''
+        if self.url is None:
+            return False
+        # the network modules are only needed once a server is set
+        import urllib.request, urllib.error
+        tmp = entry+'.tmp-'+uuid.uuid4().hex
+        try:
+            with urllib.request.urlopen(self.url+'/'+key+'.tar.gz', timeout=TIMEOUT) as response:
+                os.makedirs(os.path.dirname(entry), exist_ok=True)
+                with open(tmp, 'wb') as f:
+                    shutil.copyfileobj(response, f)
+            os.replace(tmp, entry)
+            return True
+        except urllib.error.HTTPError as e:
+            if e.code != 404:
+                print('warning: Artifact cache server returned', e.code, 'for', key[:12])
+            return False
+        except (urllib.error.URLError, OSError) as e:
+            print('warning: Artifact cache server is unreachable:', str(getattr(e, 'reason', e)))
+            return False
+        finally:
+            if os.path.exists(tmp) == True:
+                os.remove(tmp)
+
+
+    def fetch(self, key: str, dest: str='.') -> bool:
+        '''Extracts the outputs saved under `key` into the directory `dest`.
+
+        Returns `False` if neither the local directory nor the cache server
+        has them.'''
+        entry = self._entry(key)
+        source = 'local cache'
+        if os.path.exists(entry) == False:
+            if self._download(key, entry) == False:
+                return False
+            source = 'cache server'
+        try:
+            os.makedirs(dest, exist_ok=True)
+            with tarfile.open(entry, 'r:gz') as archive:
+                archive.extractall(dest, members=_safe_members(archive))
+            # mark the archive as recently used
+            os.utime(entry)
+        except (OSError, tarfile.TarError) as e:
+            print('warning: Discarding unreadable artifact', key[:12]+':', str(e))
+            try:
+                os.remove(entry)
+            except OSError:
+                pass
+            return False
+        print('info: Restored artifacts', key[:12], 'from the', source)
+        return True
+
+
+    def store(self, key: str, paths: List[str], base: str='.'):
+        '''Saves the existing files and directories among `paths`, given
+        relative to `base`, under `key` and uploads them in the background.'''
+        entry = self._entry(key)
+        tmp = entry+'.tmp-'+uuid.uuid4().hex
+        try:
+            os.makedirs(os.path.dirname(entry), exist_ok=True)
+            with tarfile.open(tmp, 'w:gz') as archive:
+                for path in paths:
+                    if os.path.exists(os.path.join(base, path)) == True:
+                        archive.add(os.path.join(base, path), arcname=path)
+            os.replace(tmp, entry)
+            with Lock(os.path.join(self._root, '.lock')):
+                self._evict()
+        except (OSError, tarfile.TarError) as e:
+            print('warning: Failed to cache artifacts:', str(e))
+            return
+        finally:
+            if os.path.exists(tmp) == True:
+                os.remove(tmp)
+        if self.url is not None:
+            # the detached uploader outlives this process
+            with open(os.path.join(self._root, 'upload.log'), 'a') as log:
+                Command(sys.executable) \
+                    .args([os.path.abspath(__file__), 'upload', entry, self.url+'/'+key+'.tar.gz']) \
+                    .start(group=True, log=log)
+        pass
+
+
+    def _evict(self):
+        '''Removes the least recently used archives until the cache fits its limit.
+
+        Assumes the exclusive lock is already held.'''
+        archives = []
+        for (root, _, files) in os.walk(self._root):
+            archives += [os.path.join(root, name) for name in files if name.endswith('.tar.gz') == True]
+        evict(archives, self._limit)
+        pass
+    pass
+
+
+def upload(path: str, url: str) -> bool:
+    '''Sends the archive at `path` to the cache server unless it already has it.'''
+    import urllib.request, urllib.error
+    try:
+        urllib.request.urlopen(urllib.request.Request(url, method='HEAD'), timeout=TIMEOUT).close()
+        return True
+    except urllib.error.HTTPError as e:
+        if e.code != 404:
+            print('error: Cache server returned', e.code, 'for', url)
+            return False
+    except (urllib.error.URLError, OSError) as e:
+        print('error: Failed to reach the cache server for', url+':', str(getattr(e, 'reason', e)))
+        return False
+    try:
+        with open(path, 'rb') as f:
+            request = urllib.request.Request(url, data=f, method='PUT')
+            request.add_header('Content-Length', str(os.path.getsize(path)))
+            request.add_header('Content-Type', 'application/gzip')
+            urllib.request.urlopen(request, timeout=TIMEOUT).close()
+    except (urllib.error.URLError, OSError) as e:
+        print('error: Failed to upload', url+':', str(getattr(e, 'reason', e)))
+        return False
+    print('info: Uploaded', url)
+    return True
+
+
+def serve(bind: str, port: int, root: str):
+    '''Runs the bundled cache server until interrupted.'''
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+    class Handler(BaseHTTPRequestHandler):
+        '''Serves the archives in the server's `root` directory.'''
+
+        def _path(self) -> str:
+            name = self.path.strip('/')
+            if name.endswith('.tar.gz') == False or KEY.fullmatch(name[:-len('.tar.gz')]) is None:
+                return None
+            return os.path.join(self.server.root, name[:2], name)
+
+
+        def _send_file(self, body: bool):
+            path = self._path()
+            if path is None or os.path.isfile(path) == False:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/gzip')
+            self.send_header('Content-Length', str(os.path.getsize(path)))
+            self.end_headers()
+            if body == True:
+                with open(path, 'rb') as f:
+                    shutil.copyfileobj(f, self.wfile)
+            pass
+
+
+        def do_HEAD(self):
+            self._send_file(body=False)
+
+
+        def do_GET(self):
+            self._send_file(body=True)
+
+
+        def do_PUT(self):
+            path = self._path()
+            length = self.headers.get('Content-Length')
+            if path is None or length is None:
+                self.send_error(400)
+                return
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = path+'.tmp-'+uuid.uuid4().hex
+            try:
+                with open(tmp, 'wb') as f:
+                    remaining = int(length)
+                    while remaining > 0:
+                        chunk = self.rfile.read(min(remaining, 1024 * 1024))
+                        if len(chunk) == 0:
+                            break
+                        f.write(chunk)
+                        remaining -= len(chunk)
+                if remaining > 0:
+                    self.send_error(400)
+                    return
+                # archives are immutable, so the first upload of a key wins
+                if os.path.exists(path) == False:
+                    os.replace(tmp, path)
+            finally:
+                if os.path.exists(tmp) == True:
+                    os.remove(tmp)
+            self.send_response(201)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            pass
+        pass
+
+    os.makedirs(root, exist_ok=True)
+    server = ThreadingHTTPServer((bind, port), Handler)
+    server.root = os.path.abspath(root)
+    print('info: Serving artifacts from', Env.quote_str(server.root), 'at http://'+bind+':'+str(server.server_address[1]), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    pass
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='artifacts', allow_abbrev=False)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    key = commands.add_parser('key', help='print the key of a stage\'s inputs')
+    key.add_argument('inputs', nargs='*', metavar='value|@file', help='a value, or the contents of a file')
+
+    fetch = commands.add_parser('fetch', help='restore the outputs saved under a key (exits 1 on a miss)')
+    fetch.add_argument('key')
+    fetch.add_argument('--dir', default='.', help='directory to restore the outputs into')
+
+    store = commands.add_parser('store', help='save outputs under a key')
+    store.add_argument('key')
+    store.add_argument('paths', nargs='+', metavar='path')
+    store.add_argument('--dir', default='.', help='directory the paths are relative to')
+
+    up = commands.add_parser('upload', help='send an archive to the cache server')
+    up.add_argument('path')
+    up.add_argument('url')
+
+    srv = commands.add_parser('serve', help='run a cache server')
+    srv.add_argument('--bind', default='127.0.0.1', metavar='ADDR', help='address to listen on')
+    srv.add_argument('--port', type=int, default=DEFAULT_PORT, help='port to listen on')
+    srv.add_argument('--root', default=None, metavar='DIR', help='directory to keep the archives in')
+
+    args = parser.parse_args()
+
+    if args.command in ('fetch', 'store') and KEY.fullmatch(args.key) is None:
+        exit('error: Invalid artifact key '+Env.quote_str(args.key))
+    if args.command == 'key':
+        fp = Fingerprint()
+        for item in args.inputs:
+            if item.startswith('@') == True:
+                fp.add_file(item[1:])
+            else:
+                fp.add(item)
+        print(fp.digest())
+    elif args.command == 'fetch':
+        exit(0 if ArtifactCache().fetch(args.key, args.dir) == True else 1)
+    elif args.command == 'store':
+        ArtifactCache().store(args.key, args.paths, base=args.dir)
+    elif args.command == 'upload':
+        exit(0 if upload(args.path, args.url) == True else 1)
+    elif args.command == 'serve':
+        serve(args.bind, args.port, args.root if args.root is not None else default_server_root())
+    pass
+
+
+if __name__ == '__main__':
+    main()
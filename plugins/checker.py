@@ -0,0 +1,400 @@
+# Project: orbit-profile
+# Module: checker.py
+#
+# Compares the output vectors of a simulation to the expected vectors.
+#
+# Both files hold one vector per line (one line per cycle) of values separated
+# by spaces or commas, where '#' starts a comment. The files are memory-mapped
+# and parsed in chunks into NumPy arrays, so millions of vectors are compared
+# column by column instead of line by line. Binary and hexadecimal values are
+# compared digit by digit, and a digit of 'x', 'X', or '-' in an expected value
+# is never compared. A column can also be compared within a tolerance, or only
+# in the bits of a mask. The first mismatches are reported with their cycle,
+# the index of the vector in the files.
+#
+# Requires NumPy (`pip install numpy`).
+#
+# Usage:
+#   python checker.py <expected> <actual> [--columns <names>] [--radix [<col>=]<radix>]
+#       [--tolerance <col>=<tol>] [--mask <col>=<bits>] [--mismatches <num>]
+
+import os, mmap, argparse
+from typing import Dict, List, Tuple
+
+# bytes of a file parsed at once
+CHUNK_BYTES = 8 * 1024 * 1024
+
+# mismatches listed in a report
+DEFAULT_MISMATCHES = 10
+
+RADIXES = {'bin': 2, 'hex': 16, 'dec': 10, 'real': 10}
+
+# digits and values that match anything when expected
+DONT_CARE = [b'x', b'X', b'-']
+
+# a code beyond any digit's value for characters that are not digits
+NOT_DIGIT = 16
+
+
+def _numpy():
+    try:
+        import numpy
+    except ImportError:
+        exit('error: Comparing vector files requires NumPy (pip install numpy)')
+    return numpy
+
+
+def _digit_codes():
+    '''Maps each byte to the value of its digit, or to a code of its own for
+    characters such as 'U' or 'Z' that are only equal to themselves.'''
+    global _CODES
+    if _CODES is not None:
+        return _CODES
+    np = _numpy()
+    codes = np.arange(256, dtype=np.int16) + NOT_DIGIT
+    for (i, c) in enumerate(b'0123456789'):
+        codes[c] = i
+    for (i, c) in enumerate(b'abcdef'):
+        codes[c] = 10 + i
+        codes[c - 32] = 10 + i
+    # weak values of std_logic
+    codes[ord('L')] = codes[ord('l')] = 0
+    codes[ord('H')] = codes[ord('h')] = 1
+    for c in DONT_CARE:
+        codes[c[0]] = -1
+    _CODES = codes
+    return codes
+
+
+_CODES = None
+
+
+class Column:
+    '''How the values of one column are compared.'''
+
+    def __init__(self, radix: str='bin', tolerance: float=None, relative: bool=False, mask: int=None):
+        self.radix = radix
+        self.tolerance = tolerance
+        # the tolerance is a fraction of the expected value
+        self.relative = relative
+        # only the bits set are compared
+        self.mask = mask
+        pass
+
+
+    def differ(self, expected, actual):
+        '''Returns which rows of the columns of tokens `expected` and `actual`
+        hold values that do not match.'''
+        if self.radix == 'bin' or self.radix == 'hex':
+            return self._digits(expected, actual)
+        return self._numbers(expected, actual)
+
+
+    def _digits(self, expected, actual):
+        np = _numpy()
+        codes = _digit_codes()
+        bits = 1 if self.radix == 'bin' else 4
+        width = int(max(np.char.str_len(expected).max(), np.char.str_len(actual).max()))
+        # shorter values are extended with zeros on the left
+        e = codes[np.frombuffer(np.char.rjust(expected, width, b'0').astype('S'+str(width)).tobytes(), dtype=np.uint8).reshape(-1, width)]
+        a = codes[np.frombuffer(np.char.rjust(actual, width, b'0').astype('S'+str(width)).tobytes(), dtype=np.uint8).reshape(-1, width)]
+        # a value of a single 'x' matches any value
+        whole = np.isin(expected, DONT_CARE)
+        # the bits of the mask that fall in each digit
+        care = np.full(width, (1 << bits) - 1, dtype=np.int16)
+        if self.mask is not None:
+            care = np.array([(self.mask >> (bits * (width - 1 - i))) & ((1 << bits) - 1) for i in range(width)], dtype=np.int16)
+        care = np.where(e < 0, 0, care)
+        numeric = (e < NOT_DIGIT) & (a < NOT_DIGIT) & (a >= 0)
+        # a digit that is not a number only matches the same character
+        wrong = np.where(numeric, ((e ^ a) & care) != 0, (e != a) & (care != 0))
+        if self.tolerance is None:
+            return wrong.any(axis=1) & (whole == False)
+        if bits * width > 62:
+            exit('error: Values of '+str(bits * width)+' bits are too wide to compare within a tolerance')
+        # rows with digits that are not numbers are compared exactly
+        exact = (numeric | (care == 0)).all(axis=1) == False
+        weights = np.array([1 << (bits * (width - 1 - i)) for i in range(width)], dtype=np.int64)
+        ev = (np.where(care != 0, e & care, 0).astype(np.int64) * weights).sum(axis=1)
+        av = (np.where(care != 0, a & care, 0).astype(np.int64) * weights).sum(axis=1)
+        return np.where(exact, wrong.any(axis=1), self._outside(ev, av)) & (whole == False)
+
+
+    def _numbers(self, expected, actual):
+        np = _numpy()
+        dont_care = np.isin(expected, DONT_CARE)
+        kind = np.float64 if self.radix == 'real' or self.tolerance is not None and self.mask is None else np.int64
+        ev = self._parse(np.where(dont_care, b'0', expected), kind)
+        av = self._parse(actual, kind)
+        # values that are not numbers only match the same token
+        invalid = np.zeros(len(ev), dtype=bool)
+        if ev.dtype.kind == 'f' or av.dtype.kind == 'f':
+            invalid = np.isnan(ev) | np.isnan(av)
+        if self.mask is not None:
+            ev = np.where(invalid, 0, ev).astype(np.int64) & self.mask
+            av = np.where(invalid, 0, av).astype(np.int64) & self.mask
+        wrong = np.where(invalid, expected != actual, self._outside(ev, av))
+        return wrong & (dont_care == False)
+
+
+    @staticmethod
+    def _parse(tokens, kind):
+        np = _numpy()
+        try:
+            return tokens.astype(kind)
+        except ValueError:
+            pass
+        # only a chunk with a value that is not a number is read token by token
+        def number(t: bytes) -> float:
+            try:
+                return float(t) if kind == np.float64 else int(t)
+            except ValueError:
+                return float('nan')
+        return np.array([number(t) for t in tokens], dtype=np.float64)
+
+
+    def _outside(self, ev, av):
+        np = _numpy()
+        if self.tolerance is None:
+            return ev != av
+        limit = self.tolerance * np.abs(ev) if self.relative == True else self.tolerance
+        return np.abs(ev - av) > limit
+    pass
+
+
+class Vectors:
+    '''Reads the vectors of the file at `path` in chunks.'''
+
+    def __init__(self, path: str, chunk: int=CHUNK_BYTES):
+        self.path = path
+        self._chunk = chunk
+        self.columns = None
+        self.rows = 0
+        pass
+
+
+    def _tokens(self, chunk: bytes):
+        np = _numpy()
+        text = chunk.replace(b',', b' ')
+        if b'#' in text:
+            text = b'\n'.join([line.split(b'#', 1)[0] for line in text.split(b'\n')])
+        tokens = text.split()
+        if len(tokens) == 0:
+            return None
+        if self.columns is None:
+            self.columns = len(text.lstrip().split(b'\n', 1)[0].split())
+        rows = text.count(b'\n') + (0 if text.endswith(b'\n') == True else 1)
+        # only a chunk with blank lines or malformed vectors is read line by line
+        if len(tokens) != rows * self.columns:
+            lines = [line.split() for line in text.split(b'\n')]
+            lines = [line for line in lines if len(line) > 0]
+            for (i, line) in enumerate(lines):
+                if len(line) != self.columns:
+                    exit('error: Vector at cycle '+str(self.rows + i)+' of \"'+self.path+'\" has '+str(len(line))+' values instead of '+str(self.columns))
+            rows = len(lines)
+        self.rows += rows
+        return np.array(tokens, dtype=bytes).reshape(rows, self.columns)
+
+
+    def blocks(self):
+        '''Yields the vectors as arrays of tokens with one row per vector.'''
+        with open(self.path, 'rb') as f:
+            try:
+                view = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # an empty file cannot be mapped
+                return
+            with view:
+                start = 0
+                while start < len(view):
+                    end = start + self._chunk
+                    if end < len(view):
+                        # chunks end at the end of a line
+                        end = view.rfind(b'\n', start, end) + 1
+                        if end <= start:
+                            end = view.find(b'\n', start + self._chunk)
+                            end = len(view) if end < 0 else end + 1
+                    block = self._tokens(view[start:end])
+                    start = end
+                    if block is not None:
+                        yield block
+        pass
+    pass
+
+
+class Checker:
+    '''Compares files of output vectors to files of expected vectors.'''
+
+    def __init__(self, names: List[str]=None, radixes: List[str]=None, tolerances: List[str]=None, masks: List[str]=None, mismatches: int=DEFAULT_MISMATCHES):
+        self._names = names if names is not None else []
+        self._default = 'bin'
+        self._columns: Dict[str, Column] = {}
+        for spec in (radixes if radixes is not None else []):
+            (key, value) = spec.split('=', 1) if '=' in spec else (None, spec)
+            if value not in RADIXES:
+                exit('error: Unknown radix \"'+value+'\" (expected one of: '+', '.join(RADIXES.keys())+')')
+            if key is None:
+                self._default = value
+            else:
+                self._spec(key).radix = value
+        for spec in (tolerances if tolerances is not None else []):
+            (key, value) = self._split(spec, '--tolerance')
+            column = self._spec(key)
+            column.relative = value.endswith('%')
+            try:
+                column.tolerance = float(value.rstrip('%')) / (100.0 if column.relative == True else 1.0)
+            except ValueError:
+                exit('error: Invalid tolerance \"'+value+'\" for column \"'+key+'\"')
+        for spec in (masks if masks is not None else []):
+            (key, value) = self._split(spec, '--mask')
+            try:
+                self._spec(key).mask = int(value, 0)
+            except ValueError:
+                exit('error: Invalid mask \"'+value+'\" for column \"'+key+'\"')
+        self._mismatches = mismatches
+        pass
+
+
+    @staticmethod
+    def from_args(args):
+        '''Creates a checker from the options added with `add_arguments`.'''
+        names = args.columns.split(',') if args.columns is not None else None
+        return Checker(names, args.radix, args.tolerance, args.mask, args.mismatches)
+
+
+    @staticmethod
+    def _split(spec: str, option: str) -> Tuple[str, str]:
+        if '=' not in spec:
+            exit('error: Option \"'+option+'\" expects <column>=<value> but got \"'+spec+'\"')
+        return tuple(spec.split('=', 1))
+
+
+    def _spec(self, key: str) -> Column:
+        if key not in self._columns:
+            self._columns[key] = Column(None)
+        return self._columns[key]
+
+
+    def _name(self, i: int) -> str:
+        return self._names[i] if i < len(self._names) else str(i)
+
+
+    def _column(self, i: int) -> Column:
+        '''Returns how to compare the `i`-th column, which is named by its name
+        or index.'''
+        spec = self._columns.get(self._name(i), self._columns.get(str(i), None))
+        if spec is None:
+            return Column(self._default)
+        return Column(spec.radix if spec.radix is not None else self._default, spec.tolerance, spec.relative, spec.mask)
+
+
+    def compare(self, expected: str, actual: str) -> bool:
+        '''Compares the vectors in the file `actual` to those in the file
+        `expected`, reports the result, and returns whether they match.'''
+        np = _numpy()
+        exp = Vectors(expected)
+        act = Vectors(actual)
+        exp_blocks = exp.blocks()
+        act_blocks = act.blocks()
+        e = next(exp_blocks, None)
+        a = next(act_blocks, None)
+        columns: List[Column] = []
+        counts: List[int] = []
+        first: List[Tuple[int, str, str, str]] = []
+        cycle = 0
+        while e is not None and a is not None:
+            if len(columns) == 0:
+                if exp.columns != act.columns:
+                    print('error: Vectors of \"'+actual+'\" have '+str(act.columns)+' values but vectors of \"'+expected+'\" have '+str(exp.columns))
+                    return False
+                for name in self._columns.keys():
+                    if name not in self._names and (name.isdigit() == False or int(name) >= exp.columns):
+                        exit('error: Unknown column \"'+name+'\"')
+                columns = [self._column(i) for i in range(exp.columns)]
+                counts = [0] * exp.columns
+            n = min(len(e), len(a))
+            wrong = np.zeros((n, len(columns)), dtype=bool)
+            for (i, column) in enumerate(columns):
+                wrong[:, i] = column.differ(e[:n, i], a[:n, i])
+                counts[i] += int(wrong[:, i].sum())
+            # remember the first mismatches of each cycle
+            for row in np.flatnonzero(wrong.any(axis=1))[:max(0, self._mismatches - len(first))]:
+                for i in np.flatnonzero(wrong[row]):
+                    first += [(cycle + int(row), self._name(int(i)), e[row, i].decode(errors='replace'), a[row, i].decode(errors='replace'))]
+            cycle += n
+            e = e[n:] if len(e) > n else next(exp_blocks, None)
+            a = a[n:] if len(a) > n else next(act_blocks, None)
+        # vectors left over in either file
+        missing = (len(e) if e is not None else 0) + sum([len(b) for b in exp_blocks])
+        extra = (len(a) if a is not None else 0) + sum([len(b) for b in act_blocks])
+
+        total = sum(counts)
+        print('info: Compared', cycle, 'vectors of', '\"'+actual+'\"', 'to', '\"'+expected+'\":', str(total)+' mismatch'+('es' if total != 1 else ''), 'in', len([c for c in counts if c > 0]), 'of', len(counts), 'columns')
+        if total > 0:
+            print('error: Mismatches by column:', ', '.join([self._name(i)+' ('+str(c)+')' for (i, c) in enumerate(counts) if c > 0]))
+            rows = [['Cycle', 'Column', 'Expected', 'Actual']] + [[str(m[0]), m[1], m[2], m[3]] for m in first[:self._mismatches]]
+            widths = [max([len(r[c]) for r in rows]) for c in range(4)]
+            print('error: First', min(len(first), self._mismatches), 'mismatches:')
+            for r in rows:
+                print('    '+'  '.join([r[c].ljust(widths[c]) for c in range(4)]).rstrip())
+        if missing > 0:
+            print('error:', '\"'+actual+'\"', 'is missing the last', missing, 'expected vectors')
+        if extra > 0:
+            print('error:', '\"'+actual+'\"', 'has', extra, 'more vectors than expected')
+        return total == 0 and missing == 0 and extra == 0
+
+
+    def run(self, pairs: List[str]) -> bool:
+        '''Compares each pair of files given as `<expected>=<actual>`, and
+        returns whether they all match.'''
+        passed = True
+        for pair in pairs:
+            (expected, actual) = self._split(pair, '--compare')
+            missing = [path for path in [expected, actual] if os.path.isfile(path) == False]
+            for path in missing:
+                print('error: No vector file', '\"'+path+'\"', 'to compare')
+            if len(missing) > 0 or self.compare(expected, actual) == False:
+                passed = False
+        return passed
+    pass
+
+
+def files(pairs: List[str]) -> List[str]:
+    '''Lists the files named by the pairs of `<expected>=<actual>` files.'''
+    return [path for pair in pairs for path in pair.split('=', 1)]
+
+
+def expected(pairs: List[str]) -> List[str]:
+    '''Lists the files of expected vectors named by the pairs of
+    `<expected>=<actual>` files.'''
+    return [pair.split('=', 1)[0] for pair in pairs]
+
+
+def add_arguments(parser):
+    '''Adds the options for comparing vector files after a simulation to the
+    argument `parser`.'''
+    parser.add_argument('--compare', action='append', default=[], metavar='EXPECTED=ACTUAL', help='compare a file of output vectors to a file of expected vectors after the simulation')
+    add_options(parser)
+    pass
+
+
+def add_options(parser):
+    parser.add_argument('--columns', default=None, metavar='NAMES', help='name the columns of the vectors (ex: valid,data)')
+    parser.add_argument('--radix', action='append', default=[], metavar='[COL=]RADIX', help='read the values as bin (default), hex, dec, or real')
+    parser.add_argument('--tolerance', action='append', default=[], metavar='COL=TOL', help='accept values within an absolute (ex: 2) or relative (ex: 0.5%%) tolerance')
+    parser.add_argument('--mask', action='append', default=[], metavar='COL=BITS', help='only compare the bits set in a mask (ex: 0xff00)')
+    parser.add_argument('--mismatches', type=int, default=DEFAULT_MISMATCHES, metavar='NUM', help='list up to this many mismatches')
+    pass
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='checker', allow_abbrev=False)
+    parser.add_argument('expected', help='file of expected vectors')
+    parser.add_argument('actual', help='file of output vectors')
+    add_options(parser)
+    args = parser.parse_args()
+    exit(0 if Checker.from_args(args).run([args.expected+'='+args.actual]) == True else 101)
+
+
+if __name__ == '__main__':
+    main()
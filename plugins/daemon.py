@@ -0,0 +1,409 @@
+# Project: orbit-profile
+# Module: daemon.py
+#
+# An optional server that keeps a Python interpreter warm for the plugins.
+#
+# The daemon imports the modules the plugins depend on once (argparse, toml,
+# veriti, and any extra modules listed in ORBIT_ENV_PROFILE_PRELOAD such as
+# numpy) and then listens on a local Unix socket. When a plugin starts, it hands
+# its arguments, environment, working directory, and standard streams to the
+# daemon, which forks a child from the warm interpreter to run the plugin
+# script. The plugin's exit code is sent back to the waiting client.
+#
+# Plugins fall back to running directly when no daemon is listening. The socket
+# lives in a directory only its user can enter ($XDG_RUNTIME_DIR, or else
+# $TMPDIR/orbit-profile-<uid>). Its path can be set with ORBIT_ENV_PROFILE_DAEMON,
+# or set to 'off' to never use the daemon.
+#
+# Since the environment and standard streams are handed over, a plugin only
+# delegates to a socket owned by its own user, with a daemon of the same user
+# listening on it (SO_PEERCRED). The daemon in turn only serves its own user.
+# Where the listener cannot be identified, plugins always run directly.
+#
+# Usage:
+#   python daemon.py start [--foreground]
+#   python daemon.py stop
+#   python daemon.py status
+
+import os, sys
+
+# reply sent instead of an exit code when the daemon declines a request
+DECLINED = -1
+
+# set within the daemon so plugins run by it do not delegate again
+_SERVING = False
+
+
+def socket_path() -> str:
+    '''Returns the path of the socket the daemon listens on.'''
+    path = os.environ.get('ORBIT_ENV_PROFILE_DAEMON')
+    if path is not None and len(path) > 0:
+        return path
+    runtime = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime is not None and len(runtime) > 0:
+        return os.path.join(runtime, 'orbit-profile.sock')
+    uid = str(os.getuid()) if hasattr(os, 'getuid') == True else 'user'
+    return os.path.join(os.environ.get('TMPDIR', '/tmp'), 'orbit-profile-'+uid, 'daemon.sock')
+
+
+def _owned(path: str, private: bool=False) -> bool:
+    '''Checks that `path` belongs to this user and, if `private`, that no other
+    user can access it.'''
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    if hasattr(os, 'getuid') == True and st.st_uid != os.getuid():
+        return False
+    if private == True and st.st_mode & 0o077 != 0:
+        return False
+    return True
+
+
+def _peer_uid(conn) -> int:
+    '''Returns the user id of the process at the other end of `conn`, or `None`
+    if it cannot be determined.'''
+    import socket, struct
+    if hasattr(socket, 'SO_PEERCRED') == False:
+        return None
+    try:
+        creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+    except OSError:
+        return None
+    return struct.unpack('3i', creds)[1]
+
+
+def _send_msg(conn, data: dict, fds=None):
+    import socket, struct, json, array
+    payload = json.dumps(data).encode('utf-8')
+    payload = struct.pack('!I', len(payload)) + payload
+    if fds is None:
+        conn.sendall(payload)
+    else:
+        conn.sendmsg([payload], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds))])
+    pass
+
+
+def _recv_msg(conn):
+    '''Receives a length-prefixed message and any file descriptors sent with it.'''
+    import socket, struct, json, array
+    fds = array.array('i')
+    data, ancdata, _, _ = conn.recvmsg(65536, socket.CMSG_LEN(8 * fds.itemsize))
+    for (level, kind, cdata) in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(cdata[:len(cdata) - (len(cdata) % fds.itemsize)])
+    if len(data) < 4:
+        return (None, list(fds))
+    size = struct.unpack('!I', data[:4])[0]
+    data = data[4:]
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if len(chunk) == 0:
+            break
+        data += chunk
+    return (json.loads(data.decode('utf-8')), list(fds))
+
+
+def _recv_code(conn) -> int:
+    import struct
+    data = b''
+    while len(data) < 4:
+        chunk = conn.recv(4 - len(data))
+        if len(chunk) == 0:
+            return None
+        data += chunk
+    return struct.unpack('!i', data)[0]
+
+
+def _connect():
+    path = socket_path()
+    # avoid importing socket when no daemon could be listening
+    if os.path.exists(path) == False:
+        return None
+    import socket, stat
+    if hasattr(socket, 'AF_UNIX') == False:
+        return None
+    # never talk to a socket that another user could have put in place
+    if _owned(path) == False or stat.S_ISSOCK(os.lstat(path).st_mode) == False:
+        print('warning: Ignoring profile daemon socket', '"'+path+'"', 'that is not owned by this user')
+        return None
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(path)
+    except OSError:
+        conn.close()
+        return None
+    # nor to a daemon run by another user
+    if hasattr(os, 'getuid') == False or _peer_uid(conn) != os.getuid():
+        conn.close()
+        return None
+    return conn
+
+
+def delegate(script: str):
+    '''Runs the plugin `script` on the warm daemon if one is listening.
+
+    Exits with the plugin's return code when the daemon ran it. Returns without
+    doing anything when no daemon is available, so the caller continues to run
+    the plugin directly.'''
+    if _SERVING == True or os.environ.get('ORBIT_ENV_PROFILE_DAEMON') == 'off':
+        return
+    conn = _connect()
+    if conn is None:
+        return
+    request = {
+        'script': os.path.abspath(script),
+        'argv': sys.argv[1:],
+        'env': dict(os.environ),
+        'cwd': os.getcwd(),
+    }
+    try:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        _send_msg(conn, request, fds=[0, 1, 2])
+        code = _recv_code(conn)
+    except KeyboardInterrupt:
+        # closing the connection tells the daemon to stop the plugin
+        conn.close()
+        exit(130)
+    except OSError:
+        code = DECLINED
+    conn.close()
+    if code is None:
+        print('error: Profile daemon closed the connection unexpectedly')
+        exit(101)
+    if code == DECLINED:
+        return
+    exit(code)
+
+
+## Server
+
+def _local_modules() -> dict:
+    '''Records the modification times of loaded modules from this profile.'''
+    here = os.path.dirname(os.path.abspath(__file__))
+    result = {}
+    for m in list(sys.modules.values()):
+        path = getattr(m, '__file__', None)
+        if path is not None and os.path.dirname(os.path.abspath(path)) == here and os.path.exists(path) == True:
+            result[path] = os.path.getmtime(path)
+    return result
+
+
+def _run_plugin(request: dict, fds: list):
+    '''Executes the plugin within the forked child process and never returns.'''
+    import runpy, signal
+    # take over the client's standard streams
+    for (i, fd) in enumerate(fds[:3]):
+        os.dup2(fd, i)
+    for fd in fds:
+        if fd > 2:
+            os.close(fd)
+    sys.stdin = open(0, 'r', closefd=False)
+    sys.stdout = open(1, 'w', buffering=1 if os.isatty(1) == True else -1, closefd=False)
+    sys.stderr = open(2, 'w', buffering=1, closefd=False)
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    # apply the client's context
+    os.environ.clear()
+    os.environ.update(request['env'])
+    os.chdir(request['cwd'])
+    sys.argv = [request['script']] + request['argv']
+    sys.path[0] = os.path.dirname(request['script'])
+    code = 0
+    try:
+        runpy.run_path(request['script'], run_name='__main__')
+    except SystemExit as e:
+        if e.code is None:
+            code = 0
+        elif isinstance(e.code, int) == True:
+            code = e.code
+        else:
+            print(e.code, file=sys.stderr)
+            code = 1
+    except KeyboardInterrupt:
+        code = 130
+    except BaseException:
+        import traceback
+        traceback.print_exc()
+        code = 1
+    # os._exit skips the plugin's exit handlers (such as saving telemetry)
+    import atexit
+    atexit._run_exitfuncs()
+    try:
+        sys.stdout.flush()
+        sys.stderr.flush()
+    except OSError:
+        pass
+    os._exit(code & 0xff)
+
+
+def _handle(conn, request: dict, fds: list):
+    '''Runs one request to completion and reports its exit code to the client.
+
+    Executes within a forked handler process and never returns.'''
+    import select, signal, struct
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    pid = os.fork()
+    if pid == 0:
+        conn.close()
+        # give the plugin and its tools their own process group to stop together
+        os.setpgid(0, 0)
+        _run_plugin(request, fds)
+    for fd in fds:
+        os.close(fd)
+    code = None
+    while code is None:
+        done, status = os.waitpid(pid, os.WNOHANG)
+        if done == pid:
+            code = os.WEXITSTATUS(status) if os.WIFEXITED(status) == True else 128 + os.WTERMSIG(status)
+            break
+        # a closed connection means the client was interrupted
+        readable, _, _ = select.select([conn], [], [], 0.05)
+        if len(readable) > 0 and len(conn.recv(1)) == 0:
+            try:
+                os.killpg(pid, signal.SIGTERM)
+            except OSError:
+                pass
+            os.waitpid(pid, 0)
+            os._exit(0)
+        pass
+    try:
+        conn.sendall(struct.pack('!i', code))
+    except OSError:
+        pass
+    os._exit(0)
+
+
+def serve(preload: list):
+    '''Imports the `preload` modules and then serves plugin requests until stopped.'''
+    global _SERVING
+    import signal, importlib, socket, struct
+    # let plugins that import this module see the server is running
+    sys.modules['daemon'] = sys.modules[__name__]
+    _SERVING = True
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    for name in ['argparse', 'random', 'runpy', 'subprocess', 'mod', 'toml', 'veriti'] + preload:
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            pass
+        pass
+    modules = _local_modules()
+
+    path = socket_path()
+    if os.environ.get('ORBIT_ENV_PROFILE_DAEMON') is None or len(os.environ.get('ORBIT_ENV_PROFILE_DAEMON')) == 0:
+        # the default socket lives in a directory only this user can enter
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        if _owned(os.path.dirname(path), private=True) == False:
+            exit('error: Directory '+'"'+os.path.dirname(path)+'"'+' of the profile daemon\'s socket must be private to this user')
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    if os.path.lexists(path) == True:
+        os.remove(path)
+    server.bind(path)
+    os.chmod(path, 0o600)
+    server.listen(16)
+    # reap handler processes as they finish
+    signal.signal(signal.SIGCHLD, lambda *_: _reap())
+    print('info: Profile daemon listening on', path)
+    try:
+        while True:
+            try:
+                conn, _ = server.accept()
+            except InterruptedError:
+                continue
+            # only serve plugins run by this user
+            if _peer_uid(conn) != os.getuid():
+                conn.close()
+                continue
+            # a client that hangs up or sends garbage must not stop the daemon
+            try:
+                request, fds = _recv_msg(conn)
+            except (OSError, ValueError):
+                conn.close()
+                continue
+            if request is None or 'command' in request:
+                command = request.get('command') if request is not None else None
+                try:
+                    conn.sendall(struct.pack('!i', 0))
+                except OSError:
+                    pass
+                conn.close()
+                if command == 'stop':
+                    break
+                continue
+            # do not run plugins against outdated copies of the profile's modules
+            if modules != _local_modules():
+                print('info: Profile modules changed; stopping daemon')
+                conn.sendall(struct.pack('!i', DECLINED))
+                conn.close()
+                for fd in fds:
+                    os.close(fd)
+                break
+            if os.fork() == 0:
+                server.close()
+                _handle(conn, request, fds)
+            conn.close()
+            for fd in fds:
+                os.close(fd)
+            pass
+    finally:
+        server.close()
+        if os.path.exists(path) == True:
+            os.remove(path)
+    pass
+
+
+def _reap():
+    try:
+        while os.waitpid(-1, os.WNOHANG)[0] > 0:
+            pass
+    except ChildProcessError:
+        pass
+    pass
+
+
+def _command(command: str) -> bool:
+    conn = _connect()
+    if conn is None:
+        return False
+    _send_msg(conn, {'command': command})
+    _recv_code(conn)
+    conn.close()
+    return True
+
+
+if __name__ == '__main__':
+    import argparse, socket
+
+    parser = argparse.ArgumentParser(prog='daemon', allow_abbrev=False)
+    parser.add_argument('action', choices=['start', 'stop', 'status'], help='control the profile daemon')
+    parser.add_argument('--foreground', action='store_true', default=False, help='do not detach from the terminal')
+    args = parser.parse_args()
+
+    if hasattr(socket, 'AF_UNIX') == False or hasattr(os, 'fork') == False or hasattr(socket, 'SO_PEERCRED') == False:
+        exit('error: Profile daemon requires Unix sockets, fork, and SO_PEERCRED')
+
+    if args.action == 'status':
+        if _command('ping') == True:
+            print('info: Profile daemon is running at', socket_path())
+        else:
+            print('info: Profile daemon is not running')
+    elif args.action == 'stop':
+        if _command('stop') == False:
+            print('info: Profile daemon is not running')
+    elif args.action == 'start':
+        if _command('ping') == True:
+            exit('error: Profile daemon is already running at '+socket_path())
+        preload = [m.strip() for m in os.environ.get('ORBIT_ENV_PROFILE_PRELOAD', '').split(',') if len(m.strip()) > 0]
+        if args.foreground == False:
+            # detach from the terminal
+            if os.fork() > 0:
+                exit(0)
+            os.setsid()
+            devnull = os.open(os.devnull, os.O_RDWR)
+            for fd in (0, 1, 2):
+                os.dup2(devnull, fd)
+        serve(preload)
+    pass
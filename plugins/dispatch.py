@@ -0,0 +1,572 @@
+# Project: orbit-profile
+# Plugin: dispatch
+#
+# Spreads a regression across worker processes on this and other hosts.
+#
+# The coordinator runs as a plugin in the build directory. It compiles the
+# design once, splits the regression into jobs (every testbench for every seed
+# and combination of swept generics), and listens on a TCP port. Workers
+# connect, ask for jobs, run each job's simulation step with gsim or msim, and
+# stream its output and verdict back. Workers must see the build directory,
+# the sources, and this profile at the same paths as the coordinator, such as
+# through a shared or synced filesystem.
+#
+# Workers send a heartbeat every few seconds. A worker that goes quiet or
+# disconnects loses its jobs, which are queued again up to a number of retries,
+# as are jobs that crash instead of passing or failing. Once the queue is empty,
+# an idle worker also runs a copy of a job that has been running the longest on
+# another worker; whichever copy finishes first wins and the other is cancelled.
+#
+# With a shared token, the coordinator and each worker prove to one another
+# that they know it (an HMAC of the other's nonce) before any job is handed
+# out, so the token itself is never sent. A worker only runs the simulation
+# plugins of its own profile, with the orbit variables the coordinator gives.
+#
+# Messages are JSON objects, one per line. A worker is started with:
+#   python dispatch.py --worker <host>:<port> [--slots <num>]
+
+import os, sys, json, time, socket, socketserver, subprocess, threading, argparse
+import hmac, hashlib, secrets
+from typing import Dict, List
+
+from mod import Env, Command, Status, Blueprint, Generic, Telemetry
+from session import parse_seeds, parse_sweep, expand
+
+# directory within the build directory that holds each job's run
+DISPATCH_DIR = 'dispatch'
+
+# seconds between a worker's heartbeats
+HEARTBEAT = 2.0
+
+# seconds an idle worker waits before asking for a job again
+IDLE = 1.0
+
+# exit code reported for a job the worker could not run, so it is retried
+CRASH = 2
+
+# arguments that make each plugin compile the design and stop
+COMPILE_ARGS = {
+    'gsim': ['--lint'],
+    'msim': ['--lint'],
+}
+
+
+def plugin_path(name: str) -> str:
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), name+'.py')
+
+
+def proof(token: str, role: str, *nonces: str) -> str:
+    '''Proves that the `role` (coordinator or worker) knows the `token`.'''
+    return hmac.new(token.encode('utf-8'), ':'.join([role] + list(nonces)).encode('utf-8'), hashlib.sha256).hexdigest()
+
+
+def verify(token: str, claim, role: str, *nonces: str) -> bool:
+    return hmac.compare_digest(str(claim).encode('utf-8'), proof(token, role, *nonces).encode('utf-8'))
+
+
+class Link:
+    '''A connection that carries one JSON message per line.'''
+
+    def __init__(self, sock: socket.socket):
+        self._sock = sock
+        self._reader = sock.makefile('r', encoding='utf-8', newline='\n')
+        self._lock = threading.Lock()
+        pass
+
+
+    def send(self, msg: dict) -> bool:
+        data = (json.dumps(msg)+'\n').encode('utf-8')
+        with self._lock:
+            try:
+                self._sock.sendall(data)
+                return True
+            except OSError:
+                return False
+
+
+    def recv(self) -> dict:
+        '''Returns the next message, or `None` once the connection is lost.'''
+        try:
+            line = self._reader.readline()
+            return json.loads(line) if len(line) > 0 else None
+        except (OSError, ValueError):
+            return None
+
+
+    def close(self):
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        pass
+    pass
+
+
+class Job:
+    '''One simulation of a testbench with a seed and generics.'''
+
+    def __init__(self, id: int, bench: str, seed: int, generics: List[Generic]):
+        self.id = id
+        self.bench = bench
+        self.seed = seed
+        self.generics = generics
+        self.name = str(id)+'-'+bench
+        self.attempts = 0
+        # the workers running a copy of the job, and when each copy started
+        self.copies: Dict[str, float] = {}
+        # the output of each copy so far
+        self.output: Dict[str, List[str]] = {}
+        # (passed, reason, worker, seconds) once the job is finished
+        self.result = None
+        pass
+    pass
+
+
+class Server(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+    pass
+
+
+class Coordinator:
+    '''Hands out `jobs` to the workers that connect and collects their verdicts.'''
+
+    def __init__(self, jobs: List[Job], plugin: str, forward: List[str], run_root: str, retries: int, steal_after: float, timeout: float, token: str):
+        self._jobs = jobs
+        self._queue = list(jobs)
+        self._plugin = plugin
+        self._forward = forward
+        self._run_root = run_root
+        self._retries = retries
+        self._steal_after = steal_after
+        self._timeout = timeout
+        self._token = token
+        self._cwd = os.getcwd()
+        # the orbit variables describe the build to every worker
+        self._env = dict([(k, v) for (k, v) in os.environ.items() if k.startswith('ORBIT_') == True])
+        self._lock = threading.Lock()
+        self._workers: Dict[str, Link] = {}
+        self.done = threading.Event()
+        pass
+
+
+    def serve(self, bind: str, port: int) -> Server:
+        '''Starts accepting workers in the background.'''
+        coordinator = self
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                coordinator._handle(self.request)
+        server = Server((bind, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+    def _handle(self, sock: socket.socket):
+        # a worker that is silent for longer than the timeout is lost
+        sock.settimeout(self._timeout)
+        link = Link(sock)
+        hello = link.recv()
+        if hello is None or hello.get('type') != 'hello':
+            return
+        if self._token is not None:
+            # prove the token to the worker first, then have it prove the same
+            theirs = str(hello.get('nonce'))
+            ours = secrets.token_hex(16)
+            link.send({'type': 'challenge', 'nonce': ours, 'proof': proof(self._token, 'coordinator', theirs, ours)})
+            auth = link.recv()
+            if auth is None or auth.get('type') != 'auth' or verify(self._token, auth.get('proof'), 'worker', ours, theirs) == False:
+                print('warning: Rejected worker '+str(hello.get('name'))+' with an invalid token')
+                link.send({'type': 'reject', 'reason': 'invalid token'})
+                return
+        with self._lock:
+            name = str(hello.get('name'))
+            while name in self._workers:
+                name += '+'
+            self._workers[name] = link
+        print('info: Worker '+name+' connected with '+str(hello.get('slots'))+' slots')
+        link.send({'type': 'welcome', 'name': name})
+        try:
+            while True:
+                msg = link.recv()
+                if msg is None:
+                    break
+                kind = msg.get('type')
+                if kind == 'request':
+                    self._assign(name, link)
+                elif kind == 'log':
+                    self._log(name, msg)
+                elif kind == 'result':
+                    self._finish(name, msg)
+        finally:
+            self._lost(name)
+        pass
+
+
+    def _args(self, job: Job, worker: str) -> List[str]:
+        run_dir = os.path.join(self._run_root, job.name+'.'+worker)
+        return self._forward \
+            + (['--seed', str(job.seed)] if job.seed is not None else []) \
+            + sum([['-g', item.to_str()] for item in job.generics], []) \
+            + ['--skip-compile', '--run-dir', run_dir]
+
+
+    def _assign(self, name: str, link: Link):
+        with self._lock:
+            if self.done.is_set() == True:
+                reply = {'type': 'done'}
+            else:
+                job = None
+                if len(self._queue) > 0:
+                    job = self._queue.pop(0)
+                    job.attempts += 1
+                else:
+                    job = self._steal(name)
+                if job is None:
+                    reply = {'type': 'wait'}
+                else:
+                    job.copies[name] = time.monotonic()
+                    job.output[name] = []
+                    env = dict(self._env)
+                    env['ORBIT_BENCH'] = job.bench
+                    reply = {'type': 'job', 'id': job.id, 'name': job.name, 'plugin': self._plugin, 'args': self._args(job, name), 'env': env, 'cwd': self._cwd}
+        link.send(reply)
+        pass
+
+
+    def _steal(self, name: str) -> Job:
+        '''Picks a job that has been running the longest on another worker.
+
+        Assumes the lock is already held.'''
+        now = time.monotonic()
+        running = [j for j in self._jobs if j.result is None and len(j.copies) == 1 and name not in j.copies]
+        running = [j for j in running if now - list(j.copies.values())[0] >= self._steal_after]
+        if len(running) == 0:
+            return None
+        job = min(running, key=lambda j: list(j.copies.values())[0])
+        print('info: Worker '+name+' is also running job '+job.name+' from worker '+list(job.copies.keys())[0])
+        return job
+
+
+    def _log(self, name: str, msg: dict):
+        with self._lock:
+            job = self._jobs[msg['id']]
+            if name in job.output:
+                job.output[name] += [msg['data']]
+        pass
+
+
+    def _finish(self, name: str, msg: dict):
+        with self._lock:
+            job = self._jobs[msg['id']]
+            # the job was cancelled or finished by another copy
+            if name not in job.copies or job.result is not None:
+                return
+            job.copies.pop(name)
+            output = job.output.pop(name, [])
+            rc = msg.get('rc')
+            if rc != 0 and rc != Status.FAIL.value:
+                self._retry(job, name, 'exited with code '+str(rc), output)
+                return
+            self._record(job, rc == 0, 'passed' if rc == 0 else 'failed', name, round(msg.get('seconds', 0.0), 1), output)
+            # stop the slower copies
+            for other in job.copies:
+                if other in self._workers:
+                    self._workers[other].send({'type': 'cancel', 'id': job.id})
+            job.copies.clear()
+            job.output.clear()
+        pass
+
+
+    def _retry(self, job: Job, name: str, reason: str, output: List[str]):
+        '''Queues a job again after its copy on worker `name` did not finish.
+
+        Assumes the lock is already held.'''
+        if len(job.copies) > 0:
+            # another copy is still running
+            return
+        if job.attempts <= self._retries:
+            print('warning: Retrying job '+job.name+' (worker '+name+': '+reason+')')
+            self._queue.insert(0, job)
+        else:
+            self._record(job, False, reason, name, None, output)
+        pass
+
+
+    def _record(self, job: Job, passed: bool, reason: str, name: str, seconds: float, output: List[str]):
+        '''Saves the verdict and output of a job. Assumes the lock is already held.'''
+        job.result = (passed, reason, name, seconds)
+        with open(os.path.join(self._run_root, job.name+'.log'), 'w') as f:
+            f.write(''.join(output))
+        finished = len([j for j in self._jobs if j.result is not None])
+        print('info: ['+str(finished)+'/'+str(len(self._jobs))+']', 'PASS' if passed == True else 'FAIL', job.name, 'on worker', name, '('+str(seconds)+'s)' if seconds is not None else '('+reason+')')
+        if finished == len(self._jobs):
+            self.done.set()
+        pass
+
+
+    def _lost(self, name: str):
+        with self._lock:
+            self._workers.pop(name, None)
+            if self.done.is_set() == False:
+                print('warning: Lost connection to worker '+name)
+            for job in self._jobs:
+                if name in job.copies:
+                    job.copies.pop(name)
+                    self._retry(job, name, 'connection lost', job.output.pop(name, []))
+        pass
+    pass
+
+
+class Worker:
+    '''Runs jobs from the coordinator at `address`, up to `slots` at once.'''
+
+    def __init__(self, address: str, slots: int, name: str, token: str):
+        (host, port) = address.rsplit(':', 1)
+        self._address = (host, int(port))
+        self._slots = slots
+        self._name = name
+        self._token = token
+        self._link = None
+        self._lock = threading.Lock()
+        self._running: Dict[int, object] = {}
+        self._cancelled = set()
+        self._done = False
+        pass
+
+
+    def _connect(self, wait: float=30.0) -> socket.socket:
+        deadline = time.monotonic() + wait
+        while True:
+            try:
+                return socket.create_connection(self._address)
+            except OSError as e:
+                if time.monotonic() >= deadline:
+                    exit('error: Failed to connect to coordinator at '+self._address[0]+':'+str(self._address[1])+': '+str(e))
+                time.sleep(0.5)
+
+
+    def run(self) -> int:
+        self._link = Link(self._connect())
+        ours = secrets.token_hex(16)
+        self._link.send({'type': 'hello', 'name': self._name, 'slots': self._slots, 'nonce': ours})
+        reply = self._link.recv()
+        if reply is None:
+            exit('error: Lost connection to coordinator')
+        if self._token is not None:
+            # never take jobs from a coordinator that does not know the token
+            if reply.get('type') != 'challenge' or verify(self._token, reply.get('proof'), 'coordinator', ours, str(reply.get('nonce'))) == False:
+                exit('error: Coordinator failed to prove it knows the token in ORBIT_ENV_DISPATCH_TOKEN')
+            self._link.send({'type': 'auth', 'proof': proof(self._token, 'worker', str(reply.get('nonce')), ours)})
+            reply = self._link.recv()
+            if reply is None:
+                exit('error: Lost connection to coordinator')
+        elif reply.get('type') == 'challenge':
+            exit('error: Coordinator requires a token to be set in ORBIT_ENV_DISPATCH_TOKEN')
+        if reply.get('type') != 'welcome':
+            exit('error: Coordinator refused this worker ('+str(reply.get('reason'))+')')
+        self._name = reply['name']
+        print('info: Worker '+self._name+' connected to coordinator at '+self._address[0]+':'+str(self._address[1]))
+        threading.Thread(target=self._heartbeat, daemon=True).start()
+        for _ in range(self._slots):
+            self._link.send({'type': 'request'})
+        while True:
+            msg = self._link.recv()
+            if msg is None:
+                break
+            kind = msg.get('type')
+            if kind == 'job':
+                threading.Thread(target=self._run, args=(msg,), daemon=True).start()
+            elif kind == 'wait':
+                threading.Timer(IDLE, self._link.send, args=({'type': 'request'},)).start()
+            elif kind == 'cancel':
+                self._cancel(msg['id'])
+            elif kind == 'done':
+                with self._lock:
+                    self._done = True
+                    if len(self._running) == 0:
+                        break
+        # the coordinator is gone, so the remaining jobs have no one to report to
+        with self._lock:
+            self._done = True
+            for proc in self._running.values():
+                Command.stop(proc)
+        self._link.close()
+        return 0
+
+
+    def _heartbeat(self):
+        while self._done == False:
+            time.sleep(HEARTBEAT)
+            if self._link.send({'type': 'heartbeat'}) == False:
+                break
+        pass
+
+
+    def _cancel(self, id: int):
+        with self._lock:
+            self._cancelled.add(id)
+            proc = self._running.get(id)
+        if proc is not None:
+            Command.stop(proc)
+        pass
+
+
+    def _run(self, job: dict):
+        # only run this profile's simulation plugins, and only let the
+        # coordinator describe the build through the orbit variables
+        if job.get('plugin') not in COMPILE_ARGS or os.path.isfile(plugin_path(job['plugin'])) == False or \
+            isinstance(job.get('args'), list) == False or any([isinstance(a, str) == False for a in job['args']]) == True:
+            print('warning: Refused job '+str(job.get('name'))+' that does not run a simulation plugin of this profile')
+            self._link.send({'type': 'result', 'id': job['id'], 'rc': CRASH, 'seconds': 0.0})
+            return
+        env = dict(os.environ)
+        env.update([(k, str(v)) for (k, v) in dict(job.get('env', {})).items() if str(k).startswith('ORBIT_') == True])
+        # pass the plugin's output on as it is printed
+        env['PYTHONUNBUFFERED'] = '1'
+        print('info: Running job '+job['name']+' ...')
+        start = time.monotonic()
+        proc = None
+        try:
+            if os.path.isdir(job['cwd']) == False:
+                raise OSError('build directory '+Env.quote_str(job['cwd'])+' is not on this worker')
+            proc = Command(sys.executable) \
+                .arg(plugin_path(job['plugin'])) \
+                .args(job['args']) \
+                .start(group=True, capture=True, env=env, cwd=job['cwd'])
+            with self._lock:
+                self._running[job['id']] = proc
+            for line in proc.stdout:
+                self._link.send({'type': 'log', 'id': job['id'], 'data': line})
+            proc.wait()
+            rc = proc.returncode
+        except (Exception, SystemExit) as e:
+            # report the job as crashed (`Command` exits when it cannot start a
+            # command) so the coordinator retries it instead of waiting forever
+            reason = str(e) if len(str(e)) > 0 else type(e).__name__
+            print('error: Failed to run job '+job['name']+': '+reason)
+            self._link.send({'type': 'log', 'id': job['id'], 'data': 'error: Worker '+self._name+' failed to run the job: '+reason+'\n'})
+            if proc is not None and proc.poll() is None:
+                Command.stop(proc)
+            rc = CRASH
+        seconds = time.monotonic() - start
+        with self._lock:
+            self._running.pop(job['id'], None)
+            cancelled = job['id'] in self._cancelled
+            finished = self._done == True and len(self._running) == 0
+        if cancelled == True:
+            print('info: Cancelled job '+job['name']+' since another worker finished it')
+        else:
+            print('info: Finished job '+job['name']+' with exit code '+str(rc)+' ('+str(round(seconds, 1))+'s)')
+            self._link.send({'type': 'result', 'id': job['id'], 'rc': rc, 'seconds': seconds})
+        if finished == True:
+            self._link.close()
+        elif self._done == False:
+            self._link.send({'type': 'request'})
+        pass
+    pass
+
+
+## Handle command-line arguments
+
+parser = argparse.ArgumentParser(prog='dispatch', allow_abbrev=False, epilog='Other arguments are passed to the simulation plugin.')
+
+parser.add_argument('--worker', default=None, metavar='HOST:PORT', help='run jobs from the coordinator at this address')
+parser.add_argument('--slots', type=int, default=1, metavar='NUM', help='number of jobs a worker runs at once')
+parser.add_argument('--name', default=socket.gethostname()+'-'+str(os.getpid()), help='name of the worker')
+
+parser.add_argument('--sim', choices=list(COMPILE_ARGS.keys()), default='gsim', help='simulation plugin to run each job with')
+parser.add_argument('--bench', action='append', default=[], metavar='NAME', help='only run this testbench (default: every testbench)')
+parser.add_argument('--seeds', type=parse_seeds, default=None, metavar='LIST', help='run every testbench once per seed (ex: 1-20,33)')
+parser.add_argument('--generic', '-g', action='append', type=Generic.from_arg, default=[], metavar='KEY=VALUE', help='override top-level VHDL generics')
+parser.add_argument('--sweep-generic', action='append', type=parse_sweep, default=[], metavar='KEY=V1,V2', help='run every testbench once per value of a generic')
+parser.add_argument('--bind', default='127.0.0.1', metavar='HOST', help='address to accept workers on (use 0.0.0.0 for other hosts)')
+parser.add_argument('--port', type=int, default=0, metavar='NUM', help='port to accept workers on (default: any free port)')
+parser.add_argument('--workers', type=int, default=0, metavar='NUM', help='number of workers to start on this host')
+parser.add_argument('--retries', type=int, default=2, metavar='NUM', help='times to retry a job whose worker is lost or that crashes')
+parser.add_argument('--heartbeat-timeout', type=float, default=15.0, metavar='SEC', help='seconds of silence after which a worker is lost')
+parser.add_argument('--steal-after', type=float, default=30.0, metavar='SEC', help='seconds a job runs before an idle worker may also run it')
+
+args, forward = parser.parse_known_args()
+
+TOKEN = Env.read('ORBIT_ENV_DISPATCH_TOKEN', missing_ok=True)
+
+if args.worker is not None:
+    exit(Worker(args.worker, max(1, args.slots), args.name, TOKEN).run())
+
+## Plan the jobs
+
+benches = Blueprint().testbenches()
+if len(args.bench) > 0:
+    missing = [b for b in args.bench if b.lower() not in [x.lower() for x in benches]]
+    if len(missing) > 0:
+        exit('error: Testbench '+Env.quote_str(missing[0])+' is not in the blueprint\'s VHDL-SIM files')
+    benches = [b for b in benches if b.lower() in [x.lower() for x in args.bench]]
+if len(benches) == 0:
+    exit('error: No testbenches found in the blueprint\'s VHDL-SIM files')
+
+runs = expand(args.generic, args.sweep_generic, args.seeds if args.seeds is not None else [])
+jobs: List[Job] = []
+for bench in benches:
+    for (generics, seed) in runs:
+        jobs += [Job(len(jobs), bench, seed, generics)]
+
+## Compile the design once
+
+# record the time of each stage of the coordinator
+Telemetry.begin('dispatch', os.path.join(DISPATCH_DIR, args.sim), 'compile')
+
+Env.write('ORBIT_BENCH', benches[0])
+print('info: Compiling the design with', args.sim, '...')
+Command(sys.executable).arg(plugin_path(args.sim)).args(forward + COMPILE_ARGS[args.sim]).spawn().unwrap()
+
+## Hand out the jobs
+
+Telemetry.stage('dispatch')
+run_root = os.path.abspath(os.path.join(DISPATCH_DIR, args.sim))
+os.makedirs(run_root, exist_ok=True)
+
+coordinator = Coordinator(jobs, args.sim, forward, run_root, args.retries, args.steal_after, args.heartbeat_timeout, TOKEN)
+server = coordinator.serve(args.bind, args.port)
+port = server.server_address[1]
+host = args.bind if args.bind != '0.0.0.0' else socket.gethostname()
+print('info: Dispatching', len(jobs), 'jobs from', host+':'+str(port), '...')
+print('info: Start a worker with: python', Env.quote_str(os.path.abspath(__file__)), '--worker', host+':'+str(port))
+
+local = []
+for i in range(args.workers):
+    local += [Command(sys.executable) \
+        .arg(os.path.abspath(__file__)) \
+        .args(['--worker', host+':'+str(port), '--slots', str(args.slots), '--name', 'local-'+str(i+1)]) \
+        .start(group=True)]
+
+try:
+    while coordinator.done.wait(0.5) == False:
+        pass
+finally:
+    for proc in local:
+        try:
+            proc.wait(timeout=10 if coordinator.done.is_set() == True else 0)
+        except subprocess.TimeoutExpired:
+            Command.stop(proc)
+    server.shutdown()
+    server.server_close()
+
+# print and save a table of the jobs
+table = [['Job', 'Testbench', 'Seed', 'Generics', 'Result', 'Worker', 'Tries', 'Seconds']]
+for job in jobs:
+    (passed, reason, worker, seconds) = job.result
+    table += [[str(job.id), job.bench, str(job.seed) if job.seed is not None else '-', ' '.join([g.to_str() for g in job.generics]) or '-', 'PASS' if passed == True else 'FAIL', worker, str(job.attempts), str(seconds) if seconds is not None else reason]]
+widths = [max([len(row[c]) for row in table]) for c in range(len(table[0]))]
+lines = ['  '.join([cell.ljust(w) for (cell, w) in zip(row, widths)]).rstrip() for row in table]
+with open(os.path.join(run_root, 'summary.txt'), 'w') as f:
+    f.write('\n'.join(lines)+'\n')
+
+failed = [j for j in jobs if j.result[0] == False]
+print('info: Dispatch summary ('+str(len(jobs)-len(failed))+' of '+str(len(jobs))+' passed):')
+for line in lines:
+    print('    '+line)
+for job in failed:
+    print('info: Log for job', job.name, 'saved at:', Env.quote_str(os.path.join(run_root, job.name+'.log')))
+
+if len(failed) > 0:
+    exit(Status.FAIL.value)
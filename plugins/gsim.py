@@ -10,11 +10,17 @@
 #
 # [1] https://github.com/ghdl/ghdl
 
-import os, sys
+import os, sys, io
 import argparse, random
 from typing import List
 
-from mod import Command, Status, Env, Generic, Blueprint, Hdl
+from daemon import delegate
+
+# run on the warm profile daemon instead when one is available
+delegate(__file__)
+
+from mod import Command, Status, Env, Generic, Blueprint, Hdl, Fingerprint, JobServer, Telemetry
+import monitor, checker, layer
 
 # directory to store artifacts within build directory
 SIM_DIR = 'gsim'
@@ -28,27 +34,55 @@ VCD_VIEWER: str = Env.read("ORBIT_ENV_VCD_VIEWER")
 
 ## Handle command-line arguments
 
+# stands in for a seed to be chosen at random
+ANY_SEED = object()
+
 parser = argparse.ArgumentParser(prog='gsim', allow_abbrev=False)
 
 parser.add_argument('--view', action='store_true', default=False, help='open the vcd file in a waveform viewer')
 parser.add_argument('--lint', action='store_true', default=False, help='run static analysis and exit')
-parser.add_argument('--seed', action='store', type=int, nargs='?', default=None, const=random.randrange(sys.maxsize), metavar='NUM', help='set the randomness seed')
+parser.add_argument('--seed', action='store', type=int, nargs='?', default=None, const=ANY_SEED, metavar='NUM', help='set the randomness seed')
 parser.add_argument('--generic', '-g', action='append', type=Generic.from_arg, default=[], metavar='KEY=VALUE', help='override top-level VHDL generics')
 parser.add_argument('--std', action='store', default='93', metavar='EDITION', help="specify the VHDL edition (87, 93, 02, 08, 19)")
 parser.add_argument('--enable-veriti', default=1, metavar='BIT', help="toggle the usage of veriti verification library")
 parser.add_argument('--run-model', default=1, metavar='BIT', help="toggle the generation of test vectors")
+parser.add_argument('--stream', action='append', default=[], metavar='FILE', help="stream a vector file from the model to the simulation through a pipe")
+parser.add_argument('--lib-cache', default=1, metavar='BIT', help="toggle the machine-wide cache of precompiled libraries")
+parser.add_argument('--force', action='store_true', default=False, help='run the simulation even if its result is cached')
+parser.add_argument('--skip-compile', action='store_true', default=False, help='use the libraries already analyzed by an earlier run')
+parser.add_argument('--run-dir', default=None, metavar='DIR', help='simulate in this directory instead of the analysis directory')
+parser.add_argument('--isolate', action='store_true', default=False, help='simulate in a new directory of its own over the shared analyzed libraries')
+parser.add_argument('--watch', action='store_true', default=False, help='analyze and simulate again whenever a source file changes')
+parser.add_argument('--profile', action='store_true', default=False, help='rank the design units by their share of the simulation time')
+monitor.add_arguments(parser)
+checker.add_arguments(parser)
 
 args = parser.parse_args()
 
 USE_VERITI = int(args.enable_veriti) != 0
 RUN_MODEL = int(args.run_model) != 0
+USE_LIB_CACHE = int(args.lib_cache) != 0
 
-# import and use the veriti library
-if USE_VERITI == True:
-    import veriti
+# a seed chosen at random makes the run irreproducible
+RANDOM_SEED = args.seed is ANY_SEED
+if RANDOM_SEED == True:
+    args.seed = random.randrange(sys.maxsize)
 
 generics: List[Generic] = args.generic
 
+if args.watch == True and args.view == True:
+    exit("error: Option \"--watch\" cannot be combined with \"--view\"")
+
+if args.isolate == True and args.run_dir is not None:
+    exit("error: Option \"--isolate\" cannot be combined with \"--run-dir\"")
+
+if args.isolate == True and args.watch == True:
+    exit("error: Option \"--isolate\" cannot be combined with \"--watch\"")
+
+# streamed vectors are gone once the simulation ends
+if len(set(args.stream) & set(checker.files(args.compare))) > 0:
+    exit("error: Streamed vector files cannot be compared with \"--compare\"")
+
 ## Read blueprint
 
 py_model: str = None
@@ -61,28 +95,165 @@ for rule in Blueprint().parse():
         py_model = rule.path
     pass
 
+BENCH = Env.read("ORBIT_BENCH", missing_ok=True)
+
+VCD_FILE = str(BENCH)+'.vcd'
+
 ## Run backend workflow
 
-# enter GHDL simulation working directory
-os.makedirs(SIM_DIR, exist_ok=True)
-os.chdir(SIM_DIR)
+# each run in watch mode starts from the build directory
+BUILD_DIR = os.getcwd()
 
-# analyze units
-print("info: Analyzing HDL source code ...")
-item: Hdl
-for item in rtl_order:
-    print('  -', Env.quote_str(item.path))
-    Command('ghdl') \
+# the analyzed libraries live in SIM_DIR, which is also where the simulation
+# runs unless it is given its own directory
+if args.isolate == True:
+    args.run_dir = layer.run_dir(SIM_DIR)
+    print('info: Running in isolated directory:', Env.quote_str(os.path.abspath(args.run_dir)))
+
+WORK_DIR: str = None
+if args.run_dir is not None:
+    WORK_DIR = os.path.abspath(SIM_DIR)
+    os.makedirs(WORK_DIR, exist_ok=True)
+    os.makedirs(args.run_dir, exist_ok=True)
+    os.chdir(args.run_dir)
+else:
+    # enter GHDL simulation working directory
+    os.makedirs(SIM_DIR, exist_ok=True)
+    os.chdir(SIM_DIR)
+
+# record the time of each stage and tool (each run of watch mode records its own)
+if args.watch == False:
+    Telemetry.begin('gsim')
+
+# identify the simulator for the caches
+GHDL_VERSION: str = None
+version, status = Command('ghdl').arg('--version').output()
+if status == Status.OKAY and len(version.strip()) > 0:
+    GHDL_VERSION = version.splitlines()[0]
+
+# reuse the result of an identical earlier simulation
+results = None
+if args.lint == False and args.watch == False and args.profile == False and BENCH is not None and GHDL_VERSION is not None:
+    missing = [path for path in checker.expected(args.compare) if os.path.isfile(path) == False]
+    if len(missing) > 0:
+        print('info: Not caching the result since the expected vectors in', Env.quote_str(missing[0]), 'do not exist yet')
+    elif RUN_MODEL == False and py_model != None:
+        # the vectors left by an earlier run of the model are not in the key
+        print('info: Not caching the result of a run that reuses the Python model\'s earlier outputs')
+    elif RUN_MODEL == True and py_model != None and (args.seed is None or RANDOM_SEED == True):
+        print('info: Not caching the result of a randomized run without a fixed seed')
+    else:
+        from simcache import ResultCache, replay, model_files
+        fp = Fingerprint() \
+            .add('gsim', GHDL_VERSION, BENCH, args.std, USE_VERITI, RUN_MODEL, args.seed, VCD_VIEWER is not None) \
+            .add(args.fail_fast, args.max_errors, args.stop_time) \
+            .add(args.compare, args.columns, args.radix, args.tolerance, args.mask) \
+            .add(*[item.to_str() for item in generics])
+        # the verdict depends on what the expected vectors hold
+        for path in checker.expected(args.compare):
+            fp.add_file(path)
+        for item in rtl_order:
+            fp.add(item.lib).add_file(item.path)
+        if py_model != None:
+            for path in model_files(py_model):
+                fp.add(os.path.relpath(path, os.path.dirname(os.path.abspath(py_model)))).add_file(path)
+        results = ResultCache('gsim', fp)
+        verdict = results.restore() if args.force == False else None
+        if verdict is not None:
+            rc = replay(verdict)
+            if rc == 0 and VCD_VIEWER != None and args.view == True:
+                Telemetry.end()
+                Command(VCD_VIEWER).arg(VCD_FILE).spawn().unwrap()
+            exit(rc)
+    pass
+
+# search paths of the precompiled libraries used from the cache
+lib_paths: List[str] = []
+
+def analyze(item: Hdl, workdir: str=None) -> Status:
+    workdir = workdir if workdir is not None else WORK_DIR
+    return Command('ghdl') \
         .args(['-a', '--ieee=synopsys', '--std='+args.std, '--work='+str(item.lib), item.path]) \
-        .spawn() \
-        .unwrap()
+        .args(['--workdir='+workdir] if workdir is not None else []) \
+        .args(['-P'+path for path in lib_paths]) \
+        .spawn()
+
+# reference dependency libraries from the machine-wide cache
+if USE_LIB_CACHE == True:
+    Telemetry.stage('libraries')
+    from libcache import LibCache, partition
+    if GHDL_VERSION is not None:
+        cache = LibCache('ghdl', GHDL_VERSION, ['--ieee=synopsys', '--std='+args.std], compiler='ghdl -a')
+        cached, rtl_order = partition(rtl_order, Env.read('ORBIT_IP_PATH', missing_ok=True))
+        for (lib, files) in cached:
+            def build(path: str) -> bool:
+                for item in files:
+                    print('  -', Env.quote_str(item.path))
+                    if analyze(item, workdir=path) != Status.OKAY:
+                        return False
+                return True
+            path = cache.fetch(lib, files, build)
+            if path is None:
+                exit('error: Failed to precompile library '+Env.quote_str(lib))
+            lib_paths += [path]
+            pass
+    else:
+        print('warning: Unable to determine GHDL version; skipping library cache')
     pass
 
+# concurrent runs share the analyzed libraries (watch mode owns them while it
+# analyzes, and each of its runs reads them like any other)
+shared = layer.Layer(WORK_DIR if WORK_DIR is not None else os.getcwd())
+ANALYSIS = 'analysis-'+args.std
+
+# analyze units
+if args.skip_compile == False and args.watch == False:
+    # the libraries are analyzed again only when their sources changed
+    key = None
+    if GHDL_VERSION is not None:
+        key = Fingerprint().add('gsim', GHDL_VERSION, args.std, *lib_paths)
+        for item in rtl_order:
+            key.add(item.lib).add_file(item.path)
+        key = key.digest()
+    if shared.update(ANALYSIS, key) == True:
+        Telemetry.stage('analysis')
+        print("info: Analyzing HDL source code ...")
+        # wait for a core from the host's job server
+        with JobServer().acquire('ghdl -a'):
+            item: Hdl
+            for item in rtl_order:
+                print('  -', Env.quote_str(item.path))
+                analyze(item).unwrap()
+                pass
+        shared.commit(ANALYSIS, key)
+    else:
+        print("info: Using the libraries analyzed by an earlier run")
+elif args.watch == False:
+    shared.share()
+else:
+    # whatever watch mode analyzes is not what an earlier run recorded
+    shared.invalidate([ANALYSIS])
+
+# keep analyzing and simulating as the sources change
+if args.watch == True:
+    from watch import Watch
+    def rerun(model_stale: bool) -> Command:
+        forward = [a for a in sys.argv[1:] if a != '--watch'] + ['--skip-compile']
+        # the vectors of an unchanged model are still in place
+        if model_stale == False and len(args.stream) == 0:
+            forward += ['--run-model', '0']
+        return Command(sys.executable).arg(os.path.abspath(__file__)).args(forward)
+    Watch(rtl_order, py_model if RUN_MODEL == True else None).loop(analyze, rerun if args.lint == False else None, cwd=BUILD_DIR)
+    exit(0)
+
 # halt workflow here when only providing lint
 if args.lint == True:
     print("info: Static analysis complete")
     exit(0)
 
+# anything besides the generics and seed that is given to the model
+model_context: List[str] = []
+
 # pre-simulation hook: generate test vectors
 if USE_VERITI == True and py_model != None:
     import veriti
@@ -96,17 +267,23 @@ if USE_VERITI == True and py_model != None:
     
     # prepare the proper context
     veriti.config.set(design_if=design_if, bench_if=bench_if, work_dir='.', generics=generics, seed=args.seed)
+    model_context = [design_if, bench_if]
     pass
 
-if RUN_MODEL == True and py_model != None:
-    import runpy, sys, os
-    # switch the sys.path[0] from this script's path to the model's path
-    this_script_path = sys.path[0]
-    sys.path[0] = os.path.dirname(py_model)
+# the model runs alongside the simulation when its vectors are streamed
+STREAM = RUN_MODEL == True and py_model != None and len(args.stream) > 0
+
+if RUN_MODEL == True and py_model != None and STREAM == False:
+    from model import run_model
+    Telemetry.stage('model')
     print("info: Running Python software model ...")
-    # run the python model script in its own namespace
-    runpy.run_path(py_model, init_globals={})
-    sys.path[0] = this_script_path
+    # outputs of a run with a fixed seed can be reused when nothing changed
+    if args.seed is not None and RANDOM_SEED == False:
+        from memo import Memo
+        Memo(py_model, [item.to_str() for item in generics], args.seed, model_context) \
+            .run(lambda: run_model(py_model), reuse=args.force == False)
+    else:
+        run_model(py_model)
     pass
 
 BYPASS_FAILURE = VCD_VIEWER is not None
@@ -114,36 +291,96 @@ BYPASS_FAILURE = VCD_VIEWER is not None
 # determine level of severity to exit
 severity_arg = '--assert-level=' + ('none' if BYPASS_FAILURE == True else 'failure')
 
-BENCH = Env.read("ORBIT_BENCH", missing_ok=True)
-
 if BENCH is None:
     exit('error: No testbench to simulate\n\nUse \"--lint\" to only compile the HDL code or set a testbench to simulate')
 
-VCD_FILE = str(BENCH)+'.vcd'
+# sample the simulation with perf to find its design units, or else only split
+# its time between processes and the kernel with ghdl's statistics
+profile = None
+SAMPLE = False
+if args.profile == True:
+    import hotspot
+    SAMPLE = hotspot.available()
+    if SAMPLE == False:
+        print('info: Unable to sample with perf; profiling with GHDL\'s run-time statistics')
+    profile = hotspot.Profile('ghdl', 'perf samples' if SAMPLE == True else 'run-time statistics')
 
 # run simulation
+Telemetry.stage('simulation')
 print("info: Starting VHDL simulation for testbench", Env.quote_str(BENCH), "...")
-status: Status = Command('ghdl') \
-    .args(['-r', '--ieee=synopsys', '--std='+args.std, BENCH, '--vcd='+VCD_FILE, severity_arg]) \
+sim = (Command('ghdl') if SAMPLE == False else hotspot.sampler().arg('ghdl')) \
+    .args(['-r', '--ieee=synopsys', '--std='+args.std]) \
+    .args(['--workdir='+WORK_DIR, '-P'+WORK_DIR] if WORK_DIR is not None else []) \
+    .args(['-P'+path for path in lib_paths]) \
+    .args([BENCH, '--vcd='+VCD_FILE, severity_arg]) \
+    .args(['--stop-time='+monitor.format_time(args.stop_time).replace(' ', '')] if args.stop_time is not None else []) \
     .args(['-g' + item.to_str() for item in generics]) \
-    .spawn(verbose=False)
+    .args(['--stats'] if profile is not None and SAMPLE == False else [])
 
-if BYPASS_FAILURE == False:
-    status.unwrap()
+# watch the simulator's output as it runs
+watcher = monitor.Monitor.from_args('ghdl', args)
+
+# wait for a core (and the memory ghdl needs) from the host's job server
+job = JobServer().acquire('ghdl')
+
+# the statistics are read from ghdl's output
+output = io.StringIO() if profile is not None else None
+
+if STREAM == True:
+    from model import Stream
+    stream = Stream(py_model, args.stream).open().start()
+    try:
+        proc = sim.start(group=True, capture=True)
+        status: Status = stream.finish(watcher.watch(proc, poll=stream.check, log=output))
+    finally:
+        stream.close()
+else:
+    proc = sim.start(group=True, capture=True)
+    status: Status = watcher.watch(proc, log=output)
+
+job.release(peak_mb=proc.peak_mb())
+shared.release()
+watcher.report()
+
+if profile is not None:
+    Telemetry.stage('profile')
+    profile.add(hotspot.read_perf() if SAMPLE == True else hotspot.read_ghdl_stats(output.getvalue()))
+    profile.measure(proc, watcher.now).report()
+
+rc = 0 if status == Status.OKAY or BYPASS_FAILURE == True else Status.FAIL.value
+scores = {}
+artifacts = [VCD_FILE]
+
+# post-simulation hook: compare the output vectors to the expected vectors
+if rc == 0 and len(args.compare) > 0:
+    Telemetry.stage('check')
+    if checker.Checker.from_args(args).run(args.compare) == False:
+        rc = Status.FAIL.value
 
 # post-simulation hook: analyze outcomes
-if USE_VERITI == True:
+if USE_VERITI == True and rc == 0:
+    import veriti
+    Telemetry.stage('results')
     print("info: Coverage report saved at:", veriti.coverage.get_coverage_report_path())
     print("info: Simulation history saved at:", veriti.log.get_event_log_path())
     print("info: Computing results ...")
-    print("info: Coverage score:", veriti.coverage.report_score())
-    print("info: Simulation score:", veriti.log.report_score())
+    scores = {'Coverage': str(veriti.coverage.report_score()), 'Simulation': str(veriti.log.report_score())}
+    print("info: Coverage score:", scores['Coverage'])
+    print("info: Simulation score:", scores['Simulation'])
+    artifacts += [os.path.relpath(veriti.coverage.get_coverage_report_path()), os.path.relpath(veriti.log.get_event_log_path())]
     rc = 0 if veriti.log.check() == True and veriti.coverage.check() == True else 101
-    exit(rc)
-else:
+elif rc == 0:
     print('info: Simulation complete')
 
+if results is not None and watcher.timed_out == False:
+    results.store({'returncode': rc, 'reason': watcher.reason, 'counts': watcher.counts, 'scores': scores}, artifacts)
+
+if rc != 0 or USE_VERITI == True:
+    exit(rc)
+
 # open the vcd file
 if(VCD_VIEWER != None and args.view == True):
+    # time spent in the viewer is not part of the build
+    Telemetry.end()
     Command(VCD_VIEWER).arg(VCD_FILE).spawn().unwrap()
     pass
\ No newline at end of file
@@ -0,0 +1,243 @@
+# Project: orbit-profile
+# Module: hotspot.py
+#
+# Ranks the design units that take up a simulator's time.
+#
+# Each simulator is profiled with its own tools: ModelSim's sampling profiler
+# ('profile on', 'profile report'), the profiler built into an xsim snapshot
+# elaborated with 'xelab --profile', and for GHDL either 'perf' samples of the
+# simulation (when perf is installed) or GHDL's run-time statistics ('--stats').
+# Their results are read into one report that ranks design units by their share
+# of the samples or time, along with how much simulated time passed per second
+# of wall time.
+
+import os, re, shutil
+from typing import Dict, List, Tuple
+
+from mod import Command
+import monitor
+
+# file the common report is saved to in the simulation's directory
+REPORT_FILE = 'profile.txt'
+
+# design units printed at the end of a run (the saved report lists all of them)
+RANKED = 20
+
+# files written by the simulators' own profilers
+MODELSIM_REPORT = 'vsim-profile.txt'
+XSIM_REPORT = 'xsim-profile.txt'
+PERF_DATA = 'ghdl.perf.data'
+
+# samples taken by perf per second
+PERF_RATE = 999
+
+# time spent outside of any design unit
+SIMULATOR = '(simulator)'
+
+# headers of the columns that hold the time spent in a unit itself, most
+# precise first
+SELF_COLUMNS = ['in(raw)', 'self(raw)', 'in(%)', 'self(%)', 'self', 'in', 'time(%)', 'time']
+
+# a column of values in a profiler's report
+COLUMN = re.compile(r'\(|%|^(in|under|self|total|time|samples|calls)$')
+
+# a perf report row: '  12.34%  [.] symbol'
+PERF_ROW = re.compile(r'^\s*(\d+(?:\.\d+)?)%\s+(?:\S+\s+)?\[([.k])\]\s+(\S+)')
+
+# code generated by GHDL is named after its library, unit, and architecture
+# (ex: work__counter__ARCH__rtl__P0__PROC)
+GHDL_SYMBOL = re.compile(r'^([a-z]\w*?)__([a-z]\w*?)(?:__ARCH__([a-z]\w*?))?(?:__|$)')
+
+# libraries of GHDL's own run-time
+GHDL_RUNTIME = ['grt', 'ghdl']
+
+# a line of GHDL's run-time statistics: 'name: 0.123s'
+GHDL_STAT = re.compile(r'^\s*([a-z][a-z ]*?)\s*:\s*(\d+(?:\.\d+)?)\s*s\s*$', re.IGNORECASE)
+
+
+def _number(s: str) -> float:
+    try:
+        return float(s.rstrip('%s'))
+    except ValueError:
+        return None
+
+
+def read_table(path: str) -> Dict[str, float]:
+    '''Reads the time spent in each design unit from a profiler's text report
+    at `path`, a table with the unit's name first and a column of samples,
+    seconds, or percentages of the time spent in the unit itself.'''
+    units = {}
+    try:
+        with open(path, 'r', errors='replace') as f:
+            lines = [line.lstrip('#').rstrip() for line in f.readlines()]
+    except OSError:
+        return units
+    width = 0
+    column = None
+    for line in lines:
+        tokens = line.split()
+        if len(tokens) == 0:
+            continue
+        lowered = [t.lower() for t in tokens]
+        # a header names its columns, one of which holds the unit's own time
+        found = [c for c in SELF_COLUMNS if c in lowered]
+        if len(found) > 0:
+            # the columns of values follow the unit's name
+            first = [i for i in range(len(tokens)) if COLUMN.search(lowered[i]) is not None][0]
+            width = len(tokens) - first
+            column = lowered.index(found[0]) - first
+            continue
+        if width == 0 or len(tokens) <= width:
+            continue
+        values = [_number(t) for t in tokens[-width:]]
+        if None in values:
+            continue
+        name = ' '.join(tokens[:-width])
+        units[name] = units.get(name, 0.0) + values[column]
+    return units
+
+
+def available() -> bool:
+    '''Checks if perf can sample a process on this host.'''
+    if shutil.which('perf') is None:
+        return False
+    # `output()` reports success whenever the command ran, so check its exit code
+    proc = Command('perf').args(['record', '-q', '-o', os.devnull, '--', 'true']).start(capture=True)
+    proc.communicate()
+    return proc.returncode == 0
+
+
+def sampler(data: str=PERF_DATA) -> Command:
+    '''Returns the start of a command that samples the command given after it
+    with perf, saving the samples to `data`.'''
+    return Command('perf').args(['record', '-q', '-F', str(PERF_RATE), '-o', data, '--'])
+
+
+def read_perf(data: str=PERF_DATA) -> Dict[str, float]:
+    '''Reads the share of perf's samples in `data` that fell in each design
+    unit of a GHDL simulation.'''
+    units = {}
+    proc = Command('perf').args(['report', '-i', data, '--stdio', '--no-children', '--sort', 'sym', '-q']).start(capture=True)
+    (out, _) = proc.communicate()
+    if proc.returncode != 0:
+        return units
+    for line in out.splitlines():
+        m = PERF_ROW.match(line)
+        if m is None:
+            continue
+        name = SIMULATOR
+        symbol = GHDL_SYMBOL.match(m.group(3))
+        if m.group(2) == '.' and symbol is not None and symbol.group(1) not in GHDL_RUNTIME:
+            name = symbol.group(1)+'.'+symbol.group(2)
+            if symbol.group(3) is not None:
+                name += '('+symbol.group(3)+')'
+        units[name] = units.get(name, 0.0) + float(m.group(1))
+    return units
+
+
+def read_ghdl_stats(text: str) -> Dict[str, float]:
+    '''Splits the simulation time in GHDL's run-time statistics in `text`
+    between the design's processes and the simulator's kernel.'''
+    stats = {}
+    for line in text.splitlines():
+        m = GHDL_STAT.match(line)
+        if m is not None:
+            stats[m.group(1).lower()] = float(m.group(2))
+    process = stats.get('process', stats.get('processes'))
+    total = stats.get('simu', stats.get('simulation', stats.get('total')))
+    if process is None or total is None:
+        return {}
+    return {'(processes)': process, SIMULATOR: max(0.0, total - process)}
+
+
+def format_rate(fs: float) -> str:
+    '''Writes a rate of `fs` femtoseconds per second in the largest unit that
+    keeps it at least one.'''
+    for unit in ['sec', 'ms', 'us', 'ns', 'ps']:
+        if fs >= monitor.UNITS[unit]:
+            return '{:.3g}'.format(fs / monitor.UNITS[unit])+' '+unit+'/s'
+    return '{:.3g}'.format(fs)+' fs/s'
+
+
+class Profile:
+    '''Where a simulator spent its time, and how fast it simulated.'''
+
+    def __init__(self, simulator: str, source: str):
+        self.simulator = simulator
+        # what the simulator's profiler measured (ex: 'perf samples')
+        self.source = source
+        self.units: Dict[str, float] = {}
+        self.wall = None
+        self.cpu = None
+        # simulated time reached (femtoseconds)
+        self.simulated = None
+        pass
+
+
+    def add(self, units: Dict[str, float]):
+        for (name, weight) in units.items():
+            self.units[name] = self.units.get(name, 0.0) + weight
+        return self
+
+
+    def measure(self, proc, simulated: int):
+        '''Takes the wall and CPU time of the simulator's process `proc` and the
+        `simulated` time it reached.'''
+        if getattr(proc, 'ended', None) is not None:
+            self.wall = proc.ended - proc.started
+        if getattr(proc, 'usage', None) is not None:
+            self.cpu = proc.usage.ru_utime + proc.usage.ru_stime
+        self.simulated = simulated
+        return self
+
+
+    def ranked(self) -> List[Tuple[str, float]]:
+        '''Lists each design unit with its share of the total, largest first.'''
+        total = sum(self.units.values())
+        if total <= 0:
+            return []
+        return sorted([(name, weight / total) for (name, weight) in self.units.items()], key=lambda u: (-u[1], u[0]))
+
+
+    def throughput(self) -> List[str]:
+        lines = []
+        if self.wall is not None:
+            lines += ['Wall time: '+str(round(self.wall, 2))+' s'+(', CPU time: '+str(round(self.cpu, 2))+' s' if self.cpu is not None else '')]
+        if self.simulated is not None and self.wall is not None and self.wall > 0:
+            lines += ['Simulated '+monitor.format_time(self.simulated)+' at '+format_rate(self.simulated / self.wall)+' of wall time']
+        elif self.simulated is None:
+            lines += ['Simulated time unknown (set \"--stop-time\" to measure throughput)']
+        return lines
+
+
+    def table(self, limit: int=None) -> List[str]:
+        units = self.ranked()
+        rows = [['Rank', 'Share', 'Design unit']]
+        for (i, (name, share)) in enumerate(units[:limit] if limit is not None else units):
+            rows += [[str(i+1), '{:.1f}%'.format(share * 100), name]]
+        widths = [max([len(r[c]) for r in rows]) for c in range(2)]
+        return [r[0].rjust(widths[0])+'  '+r[1].rjust(widths[1])+'  '+r[2] for r in rows]
+
+
+    def report(self, path: str=REPORT_FILE):
+        '''Prints the top design units and the throughput, and saves the full
+        report to `path`.'''
+        units = self.ranked()
+        if len(units) == 0:
+            print('warning: No design units were profiled by', self.simulator, '('+self.source+')')
+        else:
+            print('info: Design units by share of', self.simulator+"'s time ("+self.source+'):')
+            for line in self.table(RANKED):
+                print('    '+line)
+            if len(units) > RANKED:
+                print('    ... and', len(units) - RANKED, 'more')
+        for line in self.throughput():
+            print('info:', line)
+        with open(path, 'w') as f:
+            f.write('Profile of '+self.simulator+' ('+self.source+')\n\n')
+            if len(units) > 0:
+                f.write('\n'.join(self.table())+'\n\n')
+            f.write('\n'.join(self.throughput())+'\n')
+        print('info: Profile saved at:', '\"'+os.path.abspath(path)+'\"')
+        pass
+    pass
@@ -0,0 +1,204 @@
+# Project: orbit-profile
+# Module: layer.py
+#
+# Isolated run directories over a shared layer of compiled libraries.
+#
+# Concurrent builds of one IP (other seeds, generics, or CI jobs) compile into
+# the same directory (gsim/, msim/, xsim/), but each can run in a directory of
+# its own ('--isolate'), so waveforms, scripts, logs, and vectors never clash.
+# The runs reach the compiled libraries through the simulator's library path
+# options (GHDL's '--workdir' and '-P', a modelsim.ini mapping) or, for xsim,
+# through hard links to the elaborated snapshot.
+#
+# The compiled directory is guarded by an advisory lock: runs that read it hold
+# a shared lock, and a build that updates it holds an exclusive lock, so a
+# library is never recompiled underneath a running simulation. A stamp of the
+# inputs each part was built from lets later runs skip compiling when nothing
+# changed, so identical runs only ever take the shared lock and proceed in
+# parallel. A stamp is removed before its part is updated and only written back
+# once the update succeeds, so an interrupted build is never trusted.
+#
+# An xsim run lets go of the lock as soon as its snapshot is linked into its
+# run directory, so builds of other snapshots need not wait for it to finish
+# simulating. Before a build updates the layer, it replaces every file that is
+# still hard-linked elsewhere with a copy of its own, so the files under a
+# running simulation never change.
+
+import os, time, shutil
+from typing import List
+
+# file locked by the runs that use the layer
+LOCK_FILE = '.orbit-layer.lock'
+
+# prefix of the files that hold the inputs each part was built from
+STAMP_PREFIX = '.orbit-layer-'
+
+# prefix of the directories made for isolated runs
+RUN_PREFIX = 'run-'
+
+# files and directories a simulator writes while it runs, which are never shared
+PRIVATE = ('.log', '.pb', '.jou', '.wdb')
+PRIVATE_DIRS = ('webtalk',)
+
+# files a simulator may rewrite in place, which are copied instead of linked
+COPIED = ('.ini',)
+
+
+def run_dir(root: str) -> str:
+    '''Returns a new directory for an isolated run within `root`.'''
+    name = RUN_PREFIX+time.strftime('%Y%m%d-%H%M%S')+'-'+str(os.getpid())
+    return os.path.join(root, name)
+
+
+def link_tree(src: str, dst: str):
+    '''Mirrors the directory `src` at `dst` with hard links to its files,
+    copying them where hard links are not possible.'''
+    for (root, dirs, files) in os.walk(src):
+        dirs[:] = [d for d in dirs if d not in PRIVATE_DIRS]
+        target = os.path.join(dst, os.path.relpath(root, src))
+        os.makedirs(target, exist_ok=True)
+        for name in files:
+            if name.endswith(PRIVATE) == True:
+                continue
+            path = os.path.join(target, name)
+            if os.path.lexists(path) == True:
+                os.remove(path)
+            if name.endswith(COPIED) == False:
+                try:
+                    os.link(os.path.join(root, name), path)
+                    continue
+                except OSError:
+                    pass
+            shutil.copy2(os.path.join(root, name), path)
+    pass
+
+
+class Layer:
+    '''The compiled libraries in the directory `path`, shared by the runs of
+    one IP.'''
+
+    def __init__(self, path: str):
+        self._path = path
+        self._file = None
+        self._mode = None
+        os.makedirs(path, exist_ok=True)
+        pass
+
+
+    def _lock(self, exclusive: bool):
+        try:
+            import fcntl
+        except ImportError:
+            # without flock, runs must not share the layer concurrently
+            return
+        mode = fcntl.LOCK_EX if exclusive == True else fcntl.LOCK_SH
+        if mode == self._mode:
+            return
+        if self._file is None:
+            self._file = open(os.path.join(self._path, LOCK_FILE), 'a+')
+        if exclusive == True and self._mode == fcntl.LOCK_SH:
+            # converting a shared lock may wait for the other runs to finish
+            try:
+                fcntl.flock(self._file.fileno(), mode | fcntl.LOCK_NB)
+            except BlockingIOError:
+                print('info: Waiting for other runs to finish with', '\"'+self._path+'\"', '...')
+                fcntl.flock(self._file.fileno(), mode)
+        else:
+            try:
+                fcntl.flock(self._file.fileno(), mode | fcntl.LOCK_NB)
+            except BlockingIOError:
+                print('info: Waiting for another build to update', '\"'+self._path+'\"', '...')
+                fcntl.flock(self._file.fileno(), mode)
+        self._mode = mode
+        pass
+
+
+    def _stamp(self, name: str) -> str:
+        return os.path.join(self._path, STAMP_PREFIX+name)
+
+
+    def built(self, name: str) -> str:
+        '''Returns the key of the inputs the part `name` was built from.'''
+        try:
+            with open(self._stamp(name), 'r') as f:
+                return f.read().strip()
+        except OSError:
+            return None
+
+
+    def share(self):
+        '''Holds a shared lock while a run reads the layer.'''
+        self._lock(False)
+        return self
+
+
+    def update(self, name: str=None, key: str=None) -> bool:
+        '''Locks the layer to build its part `name` from the inputs `key`.
+
+        Returns `False` with a shared lock held when the part is already built
+        from `key`, or `True` with an exclusive lock held when it must be built.
+        Without a `key`, the layer is always locked to be updated, and what
+        the part was built from is forgotten.'''
+        if key is not None:
+            self._lock(False)
+            if self.built(name) == key:
+                return False
+        self._lock(True)
+        # another build may have finished while we waited
+        if key is not None and self.built(name) == key:
+            self._lock(False)
+            return False
+        if name is not None:
+            self.invalidate([name])
+        self._detach()
+        return True
+
+
+    def commit(self, name: str=None, key: str=None):
+        '''Marks the part `name` as built from the inputs `key` and lets other
+        runs read the layer again.'''
+        if key is not None:
+            tmp = self._stamp(name)+'.'+str(os.getpid())
+            with open(tmp, 'w') as f:
+                f.write(key+'\n')
+            os.replace(tmp, self._stamp(name))
+        self._lock(False)
+        pass
+
+
+    def release(self):
+        '''Lets other builds update the layer.'''
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self._mode = None
+        pass
+
+
+    def _detach(self):
+        '''Replaces the files that runs reach through hard links with copies,
+        so updating them in place never changes what a run simulates.
+
+        Assumes the exclusive lock is already held.'''
+        for (root, dirs, files) in os.walk(self._path):
+            dirs[:] = [d for d in dirs if d.startswith(RUN_PREFIX) == False]
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    if os.path.islink(path) == True or os.stat(path).st_nlink < 2:
+                        continue
+                    tmp = path+'.'+str(os.getpid())
+                    shutil.copy2(path, tmp)
+                    os.replace(tmp, path)
+                except OSError:
+                    pass
+        pass
+
+
+    def invalidate(self, names: List[str]):
+        '''Forgets what the parts `names` were built from.'''
+        for name in names:
+            if os.path.exists(self._stamp(name)) == True:
+                os.remove(self._stamp(name))
+        pass
+    pass
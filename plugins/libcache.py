@@ -0,0 +1,120 @@
+# Project: orbit-profile
+# Module: libcache.py
+#
+# A machine-wide cache of precompiled HDL libraries.
+#
+# Dependency libraries (vendor primitives, OSVVM, UVVM, ...) rarely change, yet
+# every IP's build directory recompiles them. This cache compiles each library
+# once per host, keyed on the tool, its version, the compile options (such as
+# the VHDL standard), the library's source files, and the libraries compiled
+# before it. Plugins then reference the cached library instead of compiling it
+# (GHDL with '-P', ModelSim with a modelsim.ini mapping).
+#
+# A library is compiled directly into its final location while holding a lock
+# and is only marked complete once compiling succeeds, so concurrent jobs wait
+# for the first one rather than compiling the same library at once.
+#
+# When an artifact cache server is configured ('ORBIT_ENV_ARTIFACT_URL'), a
+# library missing on this host is downloaded from it before compiling, and a
+# newly compiled library is uploaded for other hosts.
+
+import os, shutil
+from typing import Callable, List, Tuple
+
+from mod import Env, Hdl, Lock, Fingerprint, JobServer, cache_home
+from artifacts import ArtifactCache, default_url
+
+# name of the file that marks a cached library as fully compiled
+COMPLETE = '.orbit-complete'
+
+
+def default_root() -> str:
+    return Env.read('ORBIT_ENV_LIB_CACHE', default=os.path.join(cache_home(), 'libs'))
+
+
+def partition(order: List[Hdl], ip_path: str) -> Tuple[List[Tuple[str, List[Hdl]]], List[Hdl]]:
+    '''Splits the compile `order` into cacheable libraries and the remaining files.
+
+    Only libraries compiled entirely before the first file of the current IP
+    (at `ip_path`) are cacheable, since those cannot depend on the IP. Returns
+    the cacheable libraries as (name, files) pairs in compile order, and the
+    files left to compile locally.'''
+    if ip_path is None:
+        return ([], order)
+    root = os.path.realpath(ip_path) + os.sep
+    prefix = 0
+    while prefix < len(order) and os.path.realpath(order[prefix].path).startswith(root) == False:
+        prefix += 1
+    # libraries that also have files after the prefix must be compiled locally
+    local_libs = set([item.lib for item in order[prefix:]])
+    libraries = []
+    files = {}
+    for item in order[:prefix]:
+        if item.lib in local_libs:
+            continue
+        if item.lib not in files:
+            libraries += [item.lib]
+            files[item.lib] = []
+        files[item.lib] += [item]
+    cached = [(lib, files[lib]) for lib in libraries]
+    local = [item for item in order if item.lib not in files]
+    return (cached, local)
+
+
+class LibCache:
+    '''Precompiled libraries for one tool version and set of compile options.'''
+
+    def __init__(self, tool: str, version: str, options: List[str], root: str=None, compiler: str=None):
+        self._root = os.path.join(root if root is not None else default_root(), tool)
+        # the name the host's job server knows the compiler by
+        self._compiler = compiler if compiler is not None else tool
+        self._base = Fingerprint().add(tool, version, *options).digest()
+        # keys of the libraries fetched so far, which later libraries may use
+        self._chain = []
+        # libraries are already kept on this host, so only a server adds to it
+        self._shared = ArtifactCache() if default_url() is not None else None
+        os.makedirs(self._root, exist_ok=True)
+        pass
+
+
+    def fetch(self, lib: str, files: List[Hdl], build: Callable[[str], bool]) -> str:
+        '''Returns the directory holding the compiled library `lib`.
+
+        If the library is not cached yet, `build` is called with the directory
+        to compile `files` into. Returns `None` if compiling fails.'''
+        fp = Fingerprint().add(self._base, lib, *self._chain)
+        for item in files:
+            fp.add(item.lib).add_file(item.path)
+        key = fp.digest()
+        self._chain += [key]
+        path = os.path.join(self._root, lib+'-'+key[:24])
+        if os.path.exists(os.path.join(path, COMPLETE)) == True:
+            print('info: Using precompiled library', Env.quote_str(lib), 'from cache')
+            return path
+        with Lock(path+'.lock'):
+            # another job may have finished compiling while we waited
+            if os.path.exists(os.path.join(path, COMPLETE)) == True:
+                print('info: Using precompiled library', Env.quote_str(lib), 'from cache')
+                return path
+            # discard what an interrupted job left behind
+            if os.path.exists(path) == True:
+                shutil.rmtree(path)
+            os.makedirs(path)
+            if self._shared is not None and self._shared.fetch(key, path) == True:
+                with open(os.path.join(path, COMPLETE), 'w'):
+                    pass
+                print('info: Using precompiled library', Env.quote_str(lib), 'from the artifact cache')
+                return path
+            print('info: Precompiling library', Env.quote_str(lib), 'into cache ...')
+            # compiling takes a core from the host's job server
+            with JobServer().acquire(self._compiler):
+                built = build(path)
+            if built == False:
+                shutil.rmtree(path, ignore_errors=True)
+                return None
+            if self._shared is not None:
+                self._shared.store(key, os.listdir(path), base=path)
+            with open(os.path.join(path, COMPLETE), 'w'):
+                pass
+        return path
+    pass
@@ -0,0 +1,223 @@
+# Project: orbit-profile
+# Module: memo.py
+#
+# Remembers the files a Python model produced so an identical run can be skipped.
+#
+# An entry is keyed on the model script, its arguments or generics, the seed,
+# and any other context the plugin passes in (such as the interfaces given to
+# veriti). While the model runs, every file it opens is traced with an audit
+# hook: files it reads (data files and local modules) are recorded as inputs,
+# and files it writes within the working directory are saved as outputs. A
+# later run restores the outputs only if every recorded input is unchanged.
+#
+# Staleness detection errs on the side of running the model: files inside the
+# Python installation are compared by size and modification time, all other
+# inputs by their contents, and a model that writes files outside the working
+# directory is never memoized.
+
+import os, sys, json, time, shutil, tempfile, uuid, site, sysconfig
+from typing import Callable, Dict, List
+
+from mod import Env, Lock, Fingerprint, cache_home, evict
+
+# size limit of the memo in megabytes if not set by the environment
+DEFAULT_LIMIT_MB = 2048
+
+# the files opened while a model runs, or `None` when not tracing
+_trace = None
+
+# audit hooks cannot be removed, so the hook is only added once
+_hooked = False
+
+# files that describe the running system rather than the model's inputs
+SYSTEM_DIRS = ['/proc/', '/sys/', '/dev/']
+
+
+def default_root() -> str:
+    return Env.read('ORBIT_ENV_MODEL_CACHE', default=os.path.join(cache_home(), 'models'))
+
+
+def _audit(event: str, args):
+    if _trace is None or event != 'open':
+        return
+    path, mode, flags = args
+    if isinstance(path, int) == True or path is None:
+        return
+    path = os.path.abspath(os.fsdecode(path))
+    if mode is not None:
+        writing = any([c in mode for c in 'wax+'])
+    else:
+        writing = (flags & (os.O_WRONLY | os.O_RDWR | os.O_CREAT)) != 0
+    _trace['writes' if writing == True else 'reads'].add(path)
+    pass
+
+
+def _packages() -> List[str]:
+    '''Lists the directories of installed third-party packages.'''
+    try:
+        dirs = site.getsitepackages() + [site.getusersitepackages()]
+    except AttributeError:
+        dirs = []
+    return [os.path.join(os.path.abspath(d), '') for d in dirs]
+
+
+def _installed() -> List[str]:
+    '''Lists the directories of the Python installation and its packages.'''
+    dirs = [sys.prefix, sys.base_prefix, sys.exec_prefix, sys.base_exec_prefix]
+    return list(set([os.path.join(os.path.abspath(d), '') for d in dirs] + _packages()))
+
+
+def _snapshot(root: str) -> Dict[str, tuple]:
+    '''Records the size and modification time of every file under `root`.'''
+    files = {}
+    for (dirpath, _, names) in os.walk(root):
+        for name in names:
+            path = os.path.join(dirpath, name)
+            try:
+                st = os.stat(path)
+                files[path] = (st.st_size, st.st_mtime_ns)
+            except OSError:
+                pass
+    return files
+
+
+def _signature(path: str, installed: List[str]) -> list:
+    '''Identifies the current version of the input file at `path`.'''
+    if any([path.startswith(d) for d in installed]) == True:
+        st = os.stat(path)
+        return ['stat', st.st_size, st.st_mtime_ns]
+    return ['sha256', Fingerprint().add_file(path).digest()]
+
+
+def _within(path: str, root: str) -> bool:
+    return path.startswith(os.path.join(root, ''))
+
+
+class Memo:
+    '''The memoized outputs of running the model script `py_model`.'''
+
+    def __init__(self, py_model: str, args: List[str], seed, context: List[str]=[], root: str=None):
+        self._model = os.path.abspath(py_model)
+        self._root = root if root is not None else default_root()
+        self._limit = int(Env.read('ORBIT_ENV_MODEL_CACHE_MB', default=str(DEFAULT_LIMIT_MB))) * 1024 * 1024
+        # the model may read any of the orbit variables
+        env = sorted([k+'='+v for (k, v) in os.environ.items() if k.startswith('ORBIT_') == True])
+        self.key = Fingerprint() \
+            .add(sys.version, self._model, seed, *args) \
+            .add(*context) \
+            .add(*env) \
+            .add_file(self._model) \
+            .digest()
+        self._entry = os.path.join(self._root, self.key)
+        os.makedirs(self._root, exist_ok=True)
+        pass
+
+
+    def restore(self) -> bool:
+        '''Restores the outputs of an earlier run if all of its inputs are unchanged.'''
+        with Lock(os.path.join(self._root, '.lock'), shared=True):
+            manifest_file = os.path.join(self._entry, 'manifest.json')
+            if os.path.exists(manifest_file) == False:
+                return False
+            with open(manifest_file, 'r') as f:
+                manifest = json.load(f)
+            installed = _installed()
+            for (path, signature) in manifest['inputs'].items():
+                try:
+                    if _signature(path, installed) != signature:
+                        print('info: Python model input changed:', Env.quote_str(path))
+                        return False
+                except OSError:
+                    print('info: Python model input is missing:', Env.quote_str(path))
+                    return False
+            for name in manifest['outputs']:
+                os.makedirs(os.path.dirname(os.path.abspath(name)), exist_ok=True)
+                shutil.copy2(os.path.join(self._entry, 'outputs', name), name)
+            os.utime(self._entry)
+        print('info: Reusing outputs of Python software model from an earlier run', self.key[:12])
+        return True
+
+
+    def run(self, model: Callable[[], None], reuse: bool=True):
+        '''Restores the model's outputs, or runs `model` and remembers its outputs.
+
+        With `reuse` off, the model always runs and replaces what was remembered.'''
+        global _trace, _hooked
+        if reuse == True and self.restore() == True:
+            return
+        if hasattr(sys, 'addaudithook') == False:
+            model()
+            return
+        if _hooked == False:
+            sys.addaudithook(_audit)
+            _hooked = True
+        cwd = os.path.abspath(os.getcwd())
+        before = _snapshot(cwd)
+        _trace = {'reads': set(), 'writes': set()}
+        try:
+            model()
+        finally:
+            trace = _trace
+            _trace = None
+        after = _snapshot(cwd)
+        outputs = set([p for (p, sig) in after.items() if before.get(p) != sig])
+        outputs |= set([p for p in trace['writes'] if _within(p, cwd) == True and os.path.isfile(p) == True])
+        # a model with side effects elsewhere cannot be skipped safely
+        elsewhere = [p for p in trace['writes'] if _within(p, cwd) == False and _within(p, tempfile.gettempdir()) == False and any([p.startswith(d) for d in SYSTEM_DIRS]) == False]
+        if len(elsewhere) > 0:
+            print('info: Not remembering Python model outputs since it wrote outside the working directory:', Env.quote_str(elsewhere[0]))
+            return
+        inputs = set([p for p in trace['reads'] - trace['writes'] if p not in outputs and os.path.isfile(p) == True and any([p.startswith(d) for d in SYSTEM_DIRS]) == False])
+        # modules imported before the model ran are not traced, so record every
+        # module outside the standard library (which is covered by the version)
+        stdlib = [os.path.join(os.path.abspath(sysconfig.get_paths()[k]), '') for k in ('stdlib', 'platstdlib')]
+        packages = _packages()
+        for module in list(sys.modules.values()):
+            path = getattr(module, '__file__', None)
+            if path is None or os.path.isfile(path) == False:
+                continue
+            path = os.path.abspath(path)
+            if any([path.startswith(d) for d in stdlib]) == True and any([path.startswith(d) for d in packages]) == False:
+                continue
+            inputs.add(path)
+        self._store(inputs, [os.path.relpath(p, cwd) for p in sorted(outputs)])
+        pass
+
+
+    def _store(self, inputs: set, outputs: List[str]):
+        installed = _installed()
+        tmp = os.path.join(self._root, '.tmp-'+uuid.uuid4().hex)
+        try:
+            manifest = {
+                'model': self._model,
+                'created': time.time(),
+                'inputs': dict([(p, _signature(p, installed)) for p in sorted(inputs) if p.endswith('.pyc') == False]),
+                'outputs': outputs,
+            }
+            for name in outputs:
+                dest = os.path.join(tmp, 'outputs', name)
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                shutil.copy2(name, dest)
+            os.makedirs(tmp, exist_ok=True)
+            with open(os.path.join(tmp, 'manifest.json'), 'w') as f:
+                json.dump(manifest, f, indent=2)
+            with Lock(os.path.join(self._root, '.lock')):
+                if os.path.exists(self._entry) == True:
+                    shutil.rmtree(self._entry)
+                os.rename(tmp, self._entry)
+                self._evict()
+        except OSError as e:
+            print('warning: Failed to remember Python model outputs:', str(e))
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+        pass
+
+
+    def _evict(self):
+        '''Removes the least recently used entries until the memo fits its limit.
+
+        Assumes the exclusive lock is already held.'''
+        names = [n for n in os.listdir(self._root) if n.startswith('.') == False]
+        evict([os.path.join(self._root, n) for n in names if os.path.isdir(os.path.join(self._root, n)) == True], self._limit)
+        pass
+    pass
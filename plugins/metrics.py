@@ -0,0 +1,443 @@
+# Project: orbit-profile
+# Module: metrics.py
+#
+# A history of the timing, utilization, and runtime of FPGA builds.
+#
+# After a build, quartz and viv-no-xpr parse the reports left by each stage
+# into one normalized record: the setup and hold slack (and Fmax) of every
+# clock, the use of each kind of resource, and the runtime and peak memory of
+# each stage as measured by the build's telemetry. Records are appended to a
+# local SQLite database so results can be compared across commits. Resources
+# are named the same for both vendors: 'logic' (LUTs, LEs, or ALMs),
+# 'registers', 'memory' (block RAM tiles or memory bits), 'dsp', and 'io'.
+#
+# A new record is compared against the previous build of the same design and
+# part, and any metric that got worse by more than a threshold is reported.
+#
+# The module also runs as a script, which is how the Tcl flows record their
+# reports and how the history is queried:
+#
+#   python metrics.py record <plugin> [--part PART] [--telemetry FILE] <stage>=<report>...
+#   python metrics.py show [--plugin NAME] [--ip NAME] [--last NUM] [--check]
+
+import os, re, time, sqlite3, argparse
+from typing import Dict, List, Tuple
+
+from mod import Env, Status, Telemetry, cache_home
+
+# metrics that got worse by more than this percentage are reported
+DEFAULT_THRESHOLD = 10.0
+
+# slack that dropped by more than this many nanoseconds is reported
+DEFAULT_SLACK_NS = 0.1
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, time REAL, plugin TEXT, ip TEXT, top TEXT, part TEXT, revision TEXT);
+CREATE TABLE IF NOT EXISTS stages (run INTEGER, stage TEXT, seconds REAL, peak_mb REAL);
+CREATE TABLE IF NOT EXISTS timing (run INTEGER, stage TEXT, clock TEXT, kind TEXT, slack_ns REAL, tns_ns REAL, fmax_mhz REAL);
+CREATE TABLE IF NOT EXISTS utilization (run INTEGER, stage TEXT, resource TEXT, used REAL, available REAL);
+CREATE INDEX IF NOT EXISTS runs_design ON runs (plugin, ip, top, part);
+'''
+
+# names of each kind of resource in the utilization reports
+RESOURCES = [
+    ('logic', re.compile(r'^(?:Slice|CLB) LUTs\*?$|^Total logic elements$|^Logic utilization \(in ALMs\)$')),
+    ('registers', re.compile(r'^(?:Slice|CLB) Registers\*?$|^Total registers$')),
+    ('memory', re.compile(r'^Block RAM Tile\*?$|^Total (?:block )?memory bits$')),
+    ('dsp', re.compile(r'^DSPs\*?$|^Embedded Multiplier 9-bit elements$|^Total DSP Blocks$')),
+    ('io', re.compile(r'^Bonded IOB\*?$|^Total pins$')),
+]
+
+# the clock that stands for the whole design
+DESIGN = '*'
+
+
+def default_db() -> str:
+    return Env.read('ORBIT_ENV_METRICS_DB', default=os.path.join(cache_home(), 'metrics.db'))
+
+
+def _number(s: str) -> float:
+    '''Reads a number such as '1,234' or '250.5 MHz', or returns `None`.'''
+    m = re.match(r'\s*(-?[\d,]*\.?\d+)', s)
+    return float(m.group(1).replace(',', '')) if m is not None else None
+
+
+def _resource(name: str) -> str:
+    for (resource, pattern) in RESOURCES:
+        if pattern.match(name.strip()) is not None:
+            return resource
+    return None
+
+
+def parse_vivado_timing(text: str) -> List[Tuple[str, str, float, float, float]]:
+    '''Reads the slack of each clock from a `report_timing_summary` report.
+
+    Returns (clock, kind, slack, tns, fmax) for the setup and hold checks of the
+    whole design and of each clock, where Fmax follows from the clock's period
+    and its setup slack.'''
+    periods = {}
+    rows = []
+    section = None
+    for line in text.splitlines():
+        m = re.match(r'^\|\s*(Design Timing Summary|Clock Summary|Intra Clock Table)\s*$', line)
+        if m is not None:
+            section = m.group(1)
+            continue
+        elif re.match(r'^\|\s*\w', line) is not None:
+            # the title of another section
+            section = None
+        words = line.split()
+        if section is None or len(words) == 0 or set(words[0]) == set('-') or words[0] in ('Clock', 'WNS(ns)'):
+            continue
+        if section == 'Clock Summary' and len(words) >= 4:
+            # the waveform is a braced pair of numbers
+            m = re.match(r'^(\S+)\s+\{[^}]*\}\s+(\S+)', line.strip())
+            if m is not None:
+                periods[m.group(1)] = _number(m.group(2))
+        elif section == 'Design Timing Summary' and len(words) >= 6:
+            rows += [(DESIGN, words[0], words[1], words[4], words[5])]
+            section = None
+        elif section == 'Intra Clock Table' and len(words) >= 7:
+            rows += [(words[0], words[1], words[2], words[5], words[6])]
+    result = []
+    for (clock, wns, tns, whs, ths) in rows:
+        (wns, tns, whs, ths) = (_number(wns), _number(tns), _number(whs), _number(ths))
+        fmax = None
+        period = periods.get(clock)
+        if wns is not None and period is not None and period - wns > 0:
+            fmax = 1000.0 / (period - wns)
+        if wns is not None:
+            result += [(clock, 'setup', wns, tns, fmax)]
+        if whs is not None:
+            result += [(clock, 'hold', whs, ths, None)]
+    return result
+
+
+def parse_vivado_utilization(text: str) -> List[Tuple[str, float, float]]:
+    '''Reads the (resource, used, available) rows of a `report_utilization`
+    report.'''
+    result = {}
+    columns = None
+    for line in text.splitlines():
+        if line.startswith('|') == False:
+            continue
+        cells = [c.strip() for c in line.strip().strip('|').split('|')]
+        if 'Used' in cells and 'Available' in cells:
+            columns = (cells.index('Used'), cells.index('Available'))
+            continue
+        # sub-rows are indented within the first column
+        if columns is None or line[1:].startswith('  ') == True or max(columns) >= len(cells):
+            continue
+        resource = _resource(cells[0])
+        if resource is not None and resource not in result:
+            result[resource] = (_number(cells[columns[0]]), _number(cells[columns[1]]))
+    return [(r, used, avail) for (r, (used, avail)) in result.items() if used is not None]
+
+
+def parse_quartus_timing(text: str) -> List[Tuple[str, str, float, float, float]]:
+    '''Reads the slack of each clock from a TimeQuest (.sta.rpt) report,
+    keeping the worst value over the timing models.'''
+    worst: Dict[Tuple[str, str], list] = {}
+    table = None
+    header = False
+    for line in text.splitlines():
+        m = re.match(r'^;\s*(?:.*Model )?(Setup|Hold|Fmax) Summary\s*;$', line)
+        if m is not None:
+            table = m.group(1).lower()
+            header = True
+            continue
+        if line.strip() == '':
+            table = None
+            continue
+        if table is None or line.startswith(';') == False:
+            continue
+        cells = [c.strip() for c in line.strip().strip(';').split(';')]
+        if header == True:
+            # the first row names the columns
+            header = False
+            continue
+        if table == 'fmax' and len(cells) >= 3:
+            # the restricted Fmax accounts for the device's limits
+            fmax = _number(cells[1]) if _number(cells[1]) is not None else _number(cells[0])
+            entry = worst.setdefault((cells[2], 'setup'), [None, None, None])
+            entry[2] = fmax if entry[2] is None or fmax is None else min(entry[2], fmax)
+        elif table in ('setup', 'hold') and len(cells) >= 3:
+            (slack, tns) = (_number(cells[1]), _number(cells[2]))
+            if slack is None:
+                continue
+            entry = worst.setdefault((cells[0], table), [None, None, None])
+            entry[0] = slack if entry[0] is None else min(entry[0], slack)
+            entry[1] = tns if entry[1] is None or tns is None else min(entry[1], tns)
+    result = []
+    for ((clock, kind), (slack, tns, fmax)) in worst.items():
+        if slack is not None:
+            result += [(clock, kind, slack, tns, fmax)]
+    # the whole design is as good as its worst clock
+    for kind in ('setup', 'hold'):
+        rows = [r for r in result if r[1] == kind]
+        if len(rows) > 0:
+            tns = [r[3] for r in rows if r[3] is not None]
+            result += [(DESIGN, kind, min([r[2] for r in rows]), sum(tns) if len(tns) > 0 else None, None)]
+    return result
+
+
+def parse_quartus_utilization(text: str) -> List[Tuple[str, float, float]]:
+    '''Reads the (resource, used, available) rows of the summary of a fitter
+    (.fit.rpt) or synthesis (.map.rpt) report.'''
+    result = {}
+    for line in text.splitlines():
+        m = re.match(r'^;\s*([^;]+?)\s*;\s*([\d,]+)(?:\s*/\s*([\d,]+))?[^;]*;\s*$', line)
+        if m is None:
+            continue
+        resource = _resource(m.group(1))
+        if resource is not None and resource not in result:
+            result[resource] = (_number(m.group(2)), _number(m.group(3)) if m.group(3) is not None else None)
+    return [(r, used, avail) for (r, (used, avail)) in result.items()]
+
+
+def revision() -> str:
+    '''Returns the git revision of the IP being built, if any.'''
+    import subprocess
+    path = Env.read('ORBIT_IP_PATH', default='.')
+    try:
+        out = subprocess.run(['git', '-C', path, 'describe', '--always', '--dirty'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True, timeout=10)
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    return out.stdout.strip() if out.returncode == 0 and len(out.stdout.strip()) > 0 else None
+
+
+class Record:
+    '''The metrics of one build of `plugin` for the `part`.'''
+
+    def __init__(self, plugin: str, part: str=None):
+        self.plugin = plugin
+        self.part = part
+        self.stages: List[Tuple[str, float, float]] = []
+        self.timing: List[Tuple[str, str, str, float, float, float]] = []
+        self.utilization: List[Tuple[str, str, float, float]] = []
+        pass
+
+
+    def add_stage(self, stage: str, seconds: float=None, peak_mb: float=None):
+        '''Adds the runtime and peak memory of a stage that ran.'''
+        self.stages += [(stage, seconds, peak_mb)]
+        return self
+
+
+    def add_report(self, stage: str, path: str):
+        '''Adds the metrics in the report at `path` written by the `stage`.
+        Reports that do not exist or are not understood are skipped.'''
+        try:
+            with open(path, 'r', errors='replace') as f:
+                text = f.read()
+        except OSError:
+            return self
+        name = os.path.basename(path)
+        if name.endswith('timing_summary.rpt') == True:
+            self.timing += [(stage,) + row for row in parse_vivado_timing(text)]
+        elif name.endswith('util.rpt') == True:
+            self.utilization += [(stage,) + row for row in parse_vivado_utilization(text)]
+        elif name.endswith('.sta.rpt') == True:
+            self.timing += [(stage,) + row for row in parse_quartus_timing(text)]
+        elif name.endswith('.fit.rpt') == True or name.endswith('.map.rpt') == True:
+            self.utilization += [(stage,) + row for row in parse_quartus_utilization(text)]
+        return self
+    pass
+
+
+class Metrics:
+    '''The history of build metrics kept in the SQLite database at `path`.'''
+
+    def __init__(self, path: str=None):
+        self._path = path if path is not None else default_db()
+        os.makedirs(os.path.dirname(os.path.abspath(self._path)), exist_ok=True)
+        # concurrent builds wait for each other's writes
+        self._db = sqlite3.connect(self._path, timeout=60)
+        self._db.executescript(SCHEMA)
+        pass
+
+
+    def save(self, record: Record, threshold: float=DEFAULT_THRESHOLD, slack_ns: float=DEFAULT_SLACK_NS) -> int:
+        '''Appends the `record` as a new run, reports how it compares to the
+        previous run of the same design, and returns its id.'''
+        with self._db:
+            run = self._db.execute('INSERT INTO runs (time, plugin, ip, top, part, revision) VALUES (?, ?, ?, ?, ?, ?)', (
+                time.time(),
+                record.plugin,
+                Env.read('ORBIT_IP_NAME', default=''),
+                Env.read('ORBIT_TOP', default=''),
+                record.part or '',
+                revision(),
+            )).lastrowid
+            self._db.executemany('INSERT INTO stages VALUES (?, ?, ?, ?)', [(run,) + row for row in record.stages])
+            self._db.executemany('INSERT INTO timing VALUES (?, ?, ?, ?, ?, ?, ?)', [(run,) + row for row in record.timing])
+            self._db.executemany('INSERT INTO utilization VALUES (?, ?, ?, ?, ?)', [(run,) + row for row in record.utilization])
+        print('info: Build metrics saved at:', Env.quote_str(self._path))
+        previous = self.runs(self._design(run), 2)
+        if len(previous) == 2:
+            for problem in self.compare(previous[0], previous[1], threshold, slack_ns):
+                print('warning:', problem)
+        return run
+
+
+    def _design(self, run: int) -> tuple:
+        return self._db.execute('SELECT plugin, ip, top, part FROM runs WHERE id = ?', (run,)).fetchone()
+
+
+    def designs(self, plugin: str=None, ip: str=None) -> List[tuple]:
+        '''Lists the (plugin, ip, top, part) of every design with runs.'''
+        rows = self._db.execute('SELECT DISTINCT plugin, ip, top, part FROM runs ORDER BY plugin, ip, top, part').fetchall()
+        return [r for r in rows if (plugin is None or r[0] == plugin) and (ip is None or r[1] == ip)]
+
+
+    def runs(self, design: tuple, last: int) -> List[dict]:
+        '''Returns a summary of the `last` runs of the `design`, oldest first.
+
+        Timing and utilization come from the latest stage that reported them,
+        and the runtime sums up the stages that ran.'''
+        ids = self._db.execute('SELECT id, time, revision FROM runs WHERE plugin = ? AND ip = ? AND top = ? AND part = ? ORDER BY id DESC LIMIT ?', tuple(design) + (last,)).fetchall()
+        result = []
+        for (run, when, rev) in reversed(ids):
+            summary = {'id': run, 'time': when, 'revision': rev, 'clocks': {}, 'resources': {}, 'seconds': None, 'peak_mb': None, 'stages': {}}
+            for (stage, seconds, peak) in self._db.execute('SELECT stage, seconds, peak_mb FROM stages WHERE run = ? ORDER BY rowid', (run,)):
+                if seconds is not None:
+                    summary['stages'][stage] = seconds
+                    summary['seconds'] = (summary['seconds'] or 0.0) + seconds
+                if peak is not None:
+                    summary['peak_mb'] = max(summary['peak_mb'] or 0.0, peak)
+            # later rows come from later stages and replace earlier ones
+            for (clock, slack, fmax) in self._db.execute('SELECT clock, slack_ns, fmax_mhz FROM timing WHERE run = ? AND kind = \'setup\' ORDER BY rowid', (run,)):
+                summary['clocks'][clock] = (slack, fmax)
+            for (resource, used, avail) in self._db.execute('SELECT resource, used, available FROM utilization WHERE run = ? ORDER BY rowid', (run,)):
+                summary['resources'][resource] = (used, avail)
+            result += [summary]
+        return result
+
+
+    @staticmethod
+    def compare(old: dict, new: dict, threshold: float, slack_ns: float) -> List[str]:
+        '''Lists the metrics of the `new` run that got worse than in the `old`
+        run by more than the `threshold` (a percentage) or `slack_ns`.'''
+        problems = []
+        # `after` is over the threshold above (or below) `before`
+        grew = lambda before, after: before is not None and after is not None and before > 0 and (after - before) / before * 100.0 > threshold
+        dropped = lambda before, after: before is not None and after is not None and before > 0 and (before - after) / before * 100.0 > threshold
+        for (clock, (slack, fmax)) in new['clocks'].items():
+            if clock not in old['clocks']:
+                continue
+            (old_slack, old_fmax) = old['clocks'][clock]
+            name = 'the design' if clock == DESIGN else 'clock '+Env.quote_str(clock)
+            if slack is not None and old_slack is not None and (old_slack - slack > slack_ns or (slack < 0 and old_slack >= 0)):
+                problems += ['Setup slack of '+name+' dropped from '+'%.3f' % old_slack+' ns to '+'%.3f' % slack+' ns']
+            if dropped(old_fmax, fmax) == True:
+                problems += ['Fmax of '+name+' dropped from '+'%.1f' % old_fmax+' MHz to '+'%.1f' % fmax+' MHz']
+        for (resource, (used, _)) in new['resources'].items():
+            old_used = old['resources'].get(resource, (None, None))[0]
+            if grew(old_used, used) == True:
+                problems += ['Use of '+resource+' grew from '+'%g' % old_used+' to '+'%g' % used]
+        # only stages that ran both times have comparable runtimes
+        common = [s for s in new['stages'] if s in old['stages']]
+        (before, after) = (sum([old['stages'][s] for s in common]), sum([new['stages'][s] for s in common]))
+        if len(common) > 0 and grew(before, after) == True and after - before > 1.0:
+            problems += ['Runtime of '+', '.join(common)+' grew from '+'%.1f' % before+'s to '+'%.1f' % after+'s']
+        if grew(old['peak_mb'], new['peak_mb']) == True:
+            problems += ['Peak memory grew from '+'%.0f' % old['peak_mb']+' MB to '+'%.0f' % new['peak_mb']+' MB']
+        return problems
+
+
+    def show(self, plugin: str=None, ip: str=None, last: int=10, threshold: float=DEFAULT_THRESHOLD, slack_ns: float=DEFAULT_SLACK_NS) -> bool:
+        '''Prints the trends of the `last` runs of each design, and returns
+        whether the latest run of any design regressed.'''
+        regressed = False
+        designs = self.designs(plugin, ip)
+        if len(designs) == 0:
+            print('info: No builds recorded in', Env.quote_str(self._path))
+        for design in designs:
+            runs = self.runs(design, last)
+            (name, ip_name, top, part) = design
+            print('info:', name, 'for', ':'.join([x for x in [ip_name, top] if x != '']) or '-', ('on '+part+' ' if part != '' else '')+'('+str(len(runs))+' builds)')
+            resources = [r for (r, _) in RESOURCES if any([r in run['resources'] for run in runs]) == True]
+            table = [['Run', 'Date', 'Revision', 'WNS (ns)', 'Fmax (MHz)'] + resources + ['Seconds', 'Peak MB']]
+            for run in runs:
+                (wns, fmax) = run['clocks'].get(DESIGN, (None, None))
+                fmaxes = [f for (c, (_, f)) in run['clocks'].items() if f is not None]
+                fmax = fmax if fmax is not None else (min(fmaxes) if len(fmaxes) > 0 else None)
+                fmt = lambda v, f: f % v if v is not None else '-'
+                table += [[
+                    str(run['id']),
+                    time.strftime('%Y-%m-%d %H:%M', time.localtime(run['time'])),
+                    run['revision'] or '-',
+                    fmt(wns, '%.3f'),
+                    fmt(fmax, '%.1f'),
+                ] + [fmt(run['resources'].get(r, (None, None))[0], '%g') for r in resources] + [fmt(run['seconds'], '%.1f'), fmt(run['peak_mb'], '%.0f')]]
+            widths = [max([len(row[c]) for row in table]) for c in range(len(table[0]))]
+            for row in table:
+                print('    '+'  '.join([cell.ljust(w) for (cell, w) in zip(row, widths)]).rstrip())
+            if len(runs) >= 2:
+                for problem in Metrics.compare(runs[-2], runs[-1], threshold, slack_ns):
+                    print('warning:', problem)
+                    regressed = True
+        return regressed
+    pass
+
+
+def record_build(plugin: str, part: str, reports: List[Tuple[str, str]], stages: List[Tuple[str, float, float]]=None):
+    '''Saves the metrics of a build from the (stage, path) `reports` and the
+    (stage, seconds, peak MB) of the `stages` that ran, or of the stages
+    measured by the build's telemetry.'''
+    record = Record(plugin, part)
+    if stages is None:
+        stages = [(name, m['seconds'], m['peak_mb']) for (name, m) in Telemetry.measured().items()]
+    for (stage, seconds, peak) in stages:
+        record.add_stage(stage, seconds, peak if peak is not None and peak > 0 else None)
+    for (stage, path) in reports:
+        record.add_report(stage, path)
+    if len(record.timing) == 0 and len(record.utilization) == 0:
+        return
+    try:
+        Metrics().save(record)
+    except sqlite3.Error as e:
+        print('warning: Failed to save build metrics:', e)
+    pass
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='metrics', allow_abbrev=False)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    rec = commands.add_parser('record', help='save the metrics in the reports of a build')
+    rec.add_argument('plugin', help='name of the plugin that ran the build')
+    rec.add_argument('reports', nargs='*', metavar='stage=report', help='a report and the stage that wrote it')
+    rec.add_argument('--part', default=None, help='device the design was built for')
+    rec.add_argument('--telemetry', default=None, metavar='FILE', help='stages recorded by the build\'s telemetry')
+
+    show = commands.add_parser('show', help='show the trends of recent builds')
+    show.add_argument('--plugin', default=None, help='only show builds by this plugin')
+    show.add_argument('--ip', default=None, help='only show builds of this ip')
+    show.add_argument('--last', type=int, default=10, metavar='NUM', help='number of recent builds to show')
+    show.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD, metavar='PCT', help='percentage by which a metric must get worse to be reported')
+    show.add_argument('--slack', type=float, default=DEFAULT_SLACK_NS, metavar='NS', help='nanoseconds by which slack must drop to be reported')
+    show.add_argument('--check', action='store_true', default=False, help='exit with an error if the latest build regressed')
+
+    args = parser.parse_args()
+
+    if args.command == 'record':
+        reports = []
+        for item in args.reports:
+            (stage, sep, path) = item.partition('=')
+            if sep == '':
+                exit('error: Report '+Env.quote_str(item)+' must be given as <stage>=<report>')
+            reports += [(stage, path)]
+        stages = []
+        if args.telemetry is not None:
+            stages = [(st['name'], st['end'] - st['start'], st.get('peak_mb')) for st in Telemetry.load(args.telemetry)]
+        record_build(args.plugin, args.part, reports, stages)
+    elif args.command == 'show':
+        regressed = Metrics().show(args.plugin, args.ip, max(1, args.last), args.threshold, args.slack)
+        if args.check == True and regressed == True:
+            exit(Status.FAIL.value)
+    pass
+
+
+if __name__ == '__main__':
+    main()
@@ -9,6 +9,10 @@ from typing import List, Tuple
 from enum import Enum
 import argparse
 import subprocess
+import hashlib
+import shutil
+import threading
+import time
 
 class Env:
     @staticmethod
@@ -80,6 +84,24 @@ class Blueprint:
             pass
         return rules
 
+
+    def testbenches(self) -> List[str]:
+        '''Lists the entities without ports declared in the VHDL-SIM files.'''
+        import re
+        # an entity declaration up to its end
+        entity = re.compile(r'\bentity\s+(\w+)\s+is\b(.*?)\bend\b', re.IGNORECASE | re.DOTALL)
+        port = re.compile(r'\bport\s*\(', re.IGNORECASE)
+        benches = []
+        for rule in self.parse():
+            if rule.fileset != 'VHDL-SIM':
+                continue
+            with open(rule.path, 'r', errors='replace') as f:
+                text = re.sub(r'--[^\n]*|/\*.*?\*/', '', f.read(), flags=re.DOTALL)
+            for m in entity.finditer(text):
+                if port.search(m.group(2)) is None and m.group(1).lower() not in [b.lower() for b in benches]:
+                    benches += [m.group(1)]
+        return benches
+
     pass
 
 
@@ -136,6 +158,86 @@ class Status(Enum):
     pass
 
 
+class Process(subprocess.Popen):
+    '''A child process whose resource use is collected with `wait4` once it
+    exits and recorded by the build's `Telemetry`.'''
+
+    # the exit code of a process whose exit status was collected elsewhere
+    UNKNOWN = 255
+
+    def __init__(self, name: str, args, **kwargs):
+        self.name = os.path.basename(name)
+        self.started = time.time()
+        self.ended = None
+        self.usage = None
+        # the job this process runs in, which its peak memory is credited to
+        self.job = Job.current()
+        # threads that wait on the same process take turns to collect it
+        self._reaping = threading.Lock()
+        super().__init__(args, **kwargs)
+        pass
+
+
+    def _reap(self, block: bool) -> bool:
+        '''Collects the exit status and resource use if the process exited
+        (waiting for it with `block`), and returns whether it did.'''
+        if self.returncode is not None:
+            return True
+        if hasattr(os, 'wait4') == False:
+            return (super().wait() if block == True else super().poll()) is not None
+        if block == True and hasattr(os, 'waitid') == True:
+            # wait for the exit without collecting it, so other threads can
+            # still poll while this one blocks
+            try:
+                os.waitid(os.P_PID, self.pid, os.WEXITED | os.WNOWAIT)
+            except ChildProcessError:
+                pass
+        with self._reaping:
+            # another thread may have collected the exit status meanwhile
+            if self.returncode is not None:
+                return True
+            try:
+                (pid, status, usage) = os.wait4(self.pid, 0 if block == True else os.WNOHANG)
+            except ChildProcessError:
+                # the exit status was collected outside of this object and is
+                # lost, so never report it as a success
+                print('warning: Exit status of', Env.quote_str(self.name), 'is unknown')
+                self.returncode = Process.UNKNOWN
+                return True
+            if pid == 0:
+                return False
+            self.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) == True else os.WEXITSTATUS(status)
+            self.ended = time.time()
+            self.usage = usage
+        Telemetry.record(self)
+        Job.observe(self)
+        return True
+
+
+    def peak_mb(self) -> float:
+        '''Returns the peak memory of the process, or of the largest process it
+        waited for, once it exited, or `None` if unknown.'''
+        return _rss_mb(self.usage.ru_maxrss) if self.usage is not None else None
+
+
+    def poll(self):
+        self._reap(False)
+        return self.returncode
+
+
+    def wait(self, timeout: float=None):
+        if timeout is None:
+            self._reap(True)
+            return self.returncode
+        deadline = time.monotonic() + timeout
+        while self._reap(False) == False:
+            if time.monotonic() >= deadline:
+                raise subprocess.TimeoutExpired(self.args, timeout)
+            time.sleep(0.01)
+        return self.returncode
+    pass
+
+
 class Command:
     def __init__(self, command: str):
         self._command = command
@@ -161,8 +263,66 @@ class Command:
             job = job + ' ' + Env.quote_str(c)
         if verbose == True:
             print('info:', job)
-        status = os.system(job)
-        return Status.from_int(status)
+        proc = Process(self._command, job, shell=True)
+        # like os.system, leave Ctrl+C to the command while it runs
+        import signal
+        try:
+            handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
+        except ValueError:
+            # only the main thread can handle signals
+            handler = None
+        try:
+            proc.wait()
+        finally:
+            if handler is not None:
+                signal.signal(signal.SIGINT, handler)
+        return Status.from_int(proc.returncode)
+    
+
+    def start(self, verbose: bool=False, group: bool=False, capture: bool=False, interactive: bool=False, log=None, env: dict=None, cwd: str=None) -> subprocess.Popen:
+        '''Launches the command without waiting for it to finish.
+
+        With `group`, the command runs in its own process group so it can be
+        stopped together with any processes it starts. With `capture`, its
+        stdout and stderr are readable as lines of text from `stdout`. With
+        `interactive`, text can be written to its `stdin`. With `log`, its
+        stdout and stderr are written to that open file instead. The command
+        inherits this process's environment and working directory unless
+        `env` or `cwd` is given.'''
+        job = [self._command] + self._args
+        if verbose == True:
+            command_line = self._command
+            for c in self._args:
+                command_line += ' ' + Env.quote_str(c)
+            print('info:', command_line)
+        channels = {}
+        if capture == True:
+            channels = {'stdout': subprocess.PIPE, 'stderr': subprocess.STDOUT, 'universal_newlines': True, 'errors': 'replace', 'bufsize': 1}
+        elif log is not None:
+            channels = {'stdout': log, 'stderr': subprocess.STDOUT}
+        if interactive == True:
+            channels['stdin'] = subprocess.PIPE
+            channels['universal_newlines'] = True
+        try:
+            return Process(self._command, job, start_new_session=group, env=env, cwd=cwd, **channels)
+        except FileNotFoundError:
+            exit('error: Command not found: \"'+self._command+'\"')
+
+
+    @staticmethod
+    def stop(proc: subprocess.Popen):
+        '''Terminates the process group of `proc` started with `group`.'''
+        import signal
+        try:
+            os.killpg(proc.pid, signal.SIGTERM)
+        except (ProcessLookupError, PermissionError):
+            pass
+        try:
+            proc.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            os.killpg(proc.pid, signal.SIGKILL)
+            proc.wait()
+        pass
     
 
     def output(self, verbose: bool=False) -> Tuple[str, Status]:
@@ -175,7 +335,7 @@ class Command:
             print('info:', command_line)
         # execute the command and capture channels for stdout and stderr
         try:
-            pipe = subprocess.Popen(job, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            pipe = Process(self._command, job, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
         except FileNotFoundError:
             print('error: Command not found: \"'+self._command+'\"')
             return ('', Status.FAIL)
@@ -185,4 +345,740 @@ class Command:
         if out is not None:
             return (out.decode('utf-8'), Status.OKAY)
         return ('', Status.OKAY)
-    pass
\ No newline at end of file
+    pass
+
+
+class Lock:
+    '''An advisory lock on a file that is released when the context exits.
+
+    Shared locks can be held by many processes at once, while an exclusive lock
+    is held by only one process.'''
+
+    def __init__(self, path: str, shared: bool=False):
+        self._path = path
+        self._shared = shared
+        self._file = None
+        pass
+
+
+    def __enter__(self):
+        self._file = open(self._path, 'a+')
+        try:
+            import fcntl
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_SH if self._shared == True else fcntl.LOCK_EX)
+        except ImportError:
+            # windows only supports exclusive locks
+            import msvcrt
+            self._file.seek(0)
+            msvcrt.locking(self._file.fileno(), msvcrt.LK_LOCK, 1)
+        return self
+
+
+    def __exit__(self, *exc):
+        try:
+            import fcntl
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        except ImportError:
+            import msvcrt
+            self._file.seek(0)
+            msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+        self._file.close()
+        self._file = None
+        return False
+    pass
+
+
+def cache_home() -> str:
+    '''Returns the directory that holds orbit's caches on this host.'''
+    home = Env.read('ORBIT_HOME', default=os.path.join(os.path.expanduser('~'), '.orbit'))
+    return os.path.join(home, 'cache')
+
+
+def disk_usage(path: str) -> int:
+    '''Returns the number of bytes taken by the file or directory at `path`.'''
+    if os.path.isdir(path) == False or os.path.islink(path) == True:
+        return os.lstat(path).st_size
+    total = 0
+    for (root, _, files) in os.walk(path):
+        for name in files:
+            total += os.lstat(os.path.join(root, name)).st_size
+    return total
+
+
+def evict(entries: List[str], limit: int):
+    '''Removes the least recently used of the files and directories `entries`
+    of a cache until their total size fits within `limit` bytes.
+
+    An entry is marked as used by updating its modification time. Assumes the
+    cache's exclusive lock is already held.'''
+    sized = []
+    total = 0
+    for path in entries:
+        try:
+            size = disk_usage(path)
+            sized += [(os.stat(path).st_mtime, size, path)]
+            total += size
+        except OSError:
+            pass
+    sized.sort()
+    for (_, size, path) in sized:
+        if total <= limit:
+            break
+        if os.path.isdir(path) == True and os.path.islink(path) == False:
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            os.remove(path)
+        total -= size
+    pass
+
+
+class Fingerprint:
+    '''Accumulates a digest of every input that affects an outcome.'''
+
+    def __init__(self):
+        self._hasher = hashlib.sha256()
+        pass
+
+
+    def add(self, *values):
+        for v in values:
+            self._hasher.update(str(v).encode('utf-8'))
+            self._hasher.update(b'\0')
+        return self
+
+
+    def add_file(self, path: str):
+        '''Adds the contents of the file at `path`.'''
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                self._hasher.update(chunk)
+        self._hasher.update(b'\0')
+        return self
+
+
+    def digest(self) -> str:
+        return self._hasher.hexdigest()
+    pass
+
+
+class Telemetry:
+    '''Records where the time of a build goes.
+
+    A plugin starts recording with `begin` and marks the start of each of its
+    stages with `stage`, which lasts until the next one starts. Every tool run
+    through `Command` is recorded within the current stage along with its wall
+    time, CPU time, and peak memory as reported by `wait4`. When the plugin
+    exits, the build's trace is saved in Chrome's trace-event format (open it
+    in chrome://tracing or ui.perfetto.dev), a summary table is printed and
+    saved next to it, and the build's totals are added to a history of past
+    builds that warns when a stage becomes slower than usual.'''
+
+    # the build being recorded by this process
+    _build = None
+
+    # builds kept in the history
+    HISTORY_LIMIT = 5000
+
+    # past builds of the same testbench a stage's time is compared against
+    HISTORY_WINDOW = 20
+
+    # a stage this many times slower than its median (and by over a second)
+    # is reported
+    SLOWDOWN = 1.5
+
+    def __init__(self, plugin: str, out_dir: str):
+        self.plugin = plugin
+        self._dir = os.path.abspath(out_dir)
+        self._pid = os.getpid()
+        self.stages: List[dict] = []
+        self.tools: List[dict] = []
+        self._started = time.time()
+        self._usage = Telemetry._cpu()
+        self._current = None
+        # what was built, read before the plugin changes it
+        self._context = {
+            'ip': Env.read('ORBIT_IP_NAME', default=''),
+            'top': Env.read('ORBIT_TOP', default=''),
+            'bench': Env.read('ORBIT_BENCH', default=''),
+        }
+        pass
+
+
+    @staticmethod
+    def _cpu() -> Tuple[float, float]:
+        '''Returns the CPU seconds used by this process and by its children
+        that exited.'''
+        try:
+            import resource
+        except ImportError:
+            return (0.0, 0.0)
+        me = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return (me.ru_utime + me.ru_stime, children.ru_utime + children.ru_stime)
+
+
+    @staticmethod
+    def default_history() -> str:
+        return Env.read('ORBIT_ENV_TELEMETRY_HISTORY', default=os.path.join(cache_home(), 'telemetry.jsonl'))
+
+
+    @staticmethod
+    def begin(plugin: str, out_dir: str='.', stage: str='setup'):
+        '''Starts recording the build of `plugin` at its first `stage`, unless
+        ORBIT_ENV_TELEMETRY is 'off'. The trace and summary are saved in
+        `out_dir`.'''
+        if Telemetry._build is not None or Env.read('ORBIT_ENV_TELEMETRY', default='on') == 'off':
+            return Telemetry._build
+        import atexit
+        Telemetry._build = Telemetry(plugin, out_dir)
+        Telemetry._build._open(stage)
+        atexit.register(Telemetry.end)
+        return Telemetry._build
+
+
+    @staticmethod
+    def stage(name: str):
+        '''Ends the current stage of the build and starts the stage `name`.'''
+        build = Telemetry._build
+        if build is not None:
+            build._close()
+            build._open(name)
+        pass
+
+
+    @staticmethod
+    def record(proc: Process):
+        '''Adds a tool that exited to the current stage of the build.'''
+        build = Telemetry._build
+        if build is None or proc.usage is None:
+            return
+        build.tools += [{
+            'name': proc.name,
+            'pid': proc.pid,
+            'start': proc.started,
+            'end': proc.ended,
+            'cpu': proc.usage.ru_utime + proc.usage.ru_stime,
+            'peak_mb': _rss_mb(proc.usage.ru_maxrss),
+            'exit': proc.returncode,
+            'stage': build._current['name'] if build._current is not None else None,
+        }]
+        pass
+
+
+    @staticmethod
+    def measured() -> dict:
+        '''Returns the totals of each stage of the build that has ended so far,
+        by name.'''
+        build = Telemetry._build
+        if build is None:
+            return {}
+        return build.totals()['stages']
+
+
+    @staticmethod
+    def end():
+        '''Finishes recording the build and saves it.'''
+        build = Telemetry._build
+        # a forked process does not own the build
+        if build is None or build._pid != os.getpid():
+            return
+        Telemetry._build = None
+        build._close()
+        build.save()
+        pass
+
+
+    def _open(self, name: str):
+        self._current = {'name': name, 'start': time.time(), 'usage': Telemetry._cpu(), 'tools': len(self.tools)}
+        pass
+
+
+    def _close(self):
+        if self._current is None:
+            return
+        (me, children) = Telemetry._cpu()
+        tools = self.tools[self._current['tools']:]
+        self.stages += [{
+            'name': self._current['name'],
+            'start': self._current['start'],
+            'end': time.time(),
+            'cpu': children - self._current['usage'][1],
+            'python_cpu': me - self._current['usage'][0],
+            'peak_mb': max([0.0] + [t['peak_mb'] for t in tools]),
+            'tools': len(tools),
+        }]
+        self._current = None
+        pass
+
+
+    def totals(self) -> dict:
+        '''Sums up the build and each of its stages and tools.'''
+        stages = {}
+        for st in self.stages:
+            entry = stages.setdefault(st['name'], {'seconds': 0.0, 'cpu': 0.0, 'python_cpu': 0.0, 'peak_mb': 0.0, 'tools': 0})
+            entry['seconds'] += st['end'] - st['start']
+            entry['cpu'] += st['cpu']
+            entry['python_cpu'] += st['python_cpu']
+            entry['peak_mb'] = max(entry['peak_mb'], st['peak_mb'])
+            entry['tools'] += st['tools']
+        tools = {}
+        for t in self.tools:
+            entry = tools.setdefault(t['name'], {'seconds': 0.0, 'cpu': 0.0, 'peak_mb': 0.0, 'count': 0})
+            entry['seconds'] += t['end'] - t['start']
+            entry['cpu'] += t['cpu']
+            entry['peak_mb'] = max(entry['peak_mb'], t['peak_mb'])
+            entry['count'] += 1
+        start = min([self._started] + [st['start'] for st in self.stages])
+        end = max([start] + [st['end'] for st in self.stages])
+        return {
+            'seconds': end - start,
+            'cpu': sum([st['cpu'] for st in stages.values()]),
+            'python_cpu': sum([st['python_cpu'] for st in stages.values()]),
+            'peak_mb': max([0.0] + [st['peak_mb'] for st in stages.values()]),
+            'stages': stages,
+            'tools': tools,
+        }
+
+
+    def trace(self) -> dict:
+        '''Returns the build as Chrome trace events, with the stages on one
+        track and each tool on a track of its own.'''
+        us = lambda t: int(round(t * 1000000))
+        pid = self._pid
+        events = [
+            {'name': 'process_name', 'ph': 'M', 'pid': pid, 'tid': pid, 'args': {'name': self.plugin}},
+            {'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': pid, 'args': {'name': 'stages'}},
+        ]
+        for st in self.stages:
+            events += [{'name': st['name'], 'cat': 'stage', 'ph': 'X', 'pid': pid, 'tid': pid, 'ts': us(st['start']), 'dur': us(st['end'] - st['start']),
+                'args': {'cpu_s': round(st['cpu'], 3), 'python_cpu_s': round(st['python_cpu'], 3), 'peak_rss_mb': round(st['peak_mb'], 1), 'tools': st['tools']}}]
+        for t in self.tools:
+            events += [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': t['pid'], 'args': {'name': t['name']+' ('+str(t['pid'])+')'}}]
+            events += [{'name': t['name'], 'cat': 'tool', 'ph': 'X', 'pid': pid, 'tid': t['pid'], 'ts': us(t['start']), 'dur': us(t['end'] - t['start']),
+                'args': {'cpu_s': round(t['cpu'], 3), 'peak_rss_mb': round(t['peak_mb'], 1), 'exit_code': t['exit'], 'stage': t['stage']}}]
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+    def summary(self, totals: dict) -> List[str]:
+        '''Formats the time of each stage as the lines of a table.'''
+        row = lambda name, e: [name, '%.2f' % e['seconds'], '%.2f' % e['cpu'], '%.2f' % e['python_cpu'], str(int(round(e['peak_mb']))), str(e['tools'])]
+        table = [['Stage', 'Seconds', 'Tool CPU', 'Python CPU', 'Peak MB', 'Tools']]
+        for (name, entry) in totals['stages'].items():
+            table += [row(name, entry)]
+        table += [row('total', dict(totals, tools=len(self.tools)))]
+        widths = [max([len(r[c]) for r in table]) for c in range(len(table[0]))]
+        return ['  '.join([(cell.ljust(w) if c == 0 else cell.rjust(w)) for (c, (cell, w)) in enumerate(zip(r, widths))]).rstrip() for r in table]
+
+
+    def save(self, history: str=None):
+        '''Writes the trace and summary, prints the summary, and adds the build
+        to the `history`.'''
+        import json
+        totals = self.totals()
+        lines = self.summary(totals)
+        try:
+            os.makedirs(self._dir, exist_ok=True)
+            with open(os.path.join(self._dir, 'telemetry.json'), 'w') as f:
+                json.dump(self.trace(), f)
+            with open(os.path.join(self._dir, 'telemetry.txt'), 'w') as f:
+                f.write('\n'.join(lines)+'\n')
+        except OSError as e:
+            print('warning: Failed to save telemetry:', e)
+        print('info: Build telemetry saved at:', Env.quote_str(os.path.join(self._dir, 'telemetry.json')))
+        for line in lines:
+            print('    '+line)
+        try:
+            self._remember(totals, history if history is not None else Telemetry.default_history())
+        except OSError as e:
+            print('warning: Failed to update telemetry history:', e)
+        pass
+
+
+    def _remember(self, totals: dict, path: str):
+        '''Appends the build to the history at `path` and warns about stages
+        that took much longer than in earlier builds of the same testbench.'''
+        import json, statistics
+        entry = dict(self._context, time=round(self._started, 3), plugin=self.plugin)
+        same = lambda e: all([e.get(k) == entry[k] for k in ['plugin', 'ip', 'top', 'bench']])
+        round_all = lambda d: dict([(k, round(v, 3) if isinstance(v, float) else v) for (k, v) in d.items()])
+        entry.update(round_all(dict([(k, v) for (k, v) in totals.items() if k not in ['stages', 'tools']])))
+        entry['stages'] = dict([(k, round_all(v)) for (k, v) in totals['stages'].items()])
+        entry['tools'] = dict([(k, round_all(v)) for (k, v) in totals['tools'].items()])
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with Lock(path+'.lock'):
+            builds = Telemetry.load(path)
+            # compare against the builds of the same testbench that came before
+            earlier = [b for b in builds if same(b) == True][-Telemetry.HISTORY_WINDOW:]
+            for (name, now) in [('total', entry['seconds'])] + [(k, v['seconds']) for (k, v) in entry['stages'].items()]:
+                past = [b['seconds'] if name == 'total' else b['stages'][name]['seconds'] for b in earlier if name == 'total' or name in b.get('stages', {})]
+                if len(past) < 5:
+                    continue
+                median = statistics.median(past)
+                if now > median * Telemetry.SLOWDOWN and now - median > 1.0:
+                    print('warning: Stage', Env.quote_str(name), 'took', '%.2fs,' % now, '%.1fx' % (now / max(median, 0.001)), 'its median of', '%.2fs' % median, 'over the last', len(past), 'builds')
+            builds = builds[-(Telemetry.HISTORY_LIMIT-1):] + [entry]
+            tmp = path+'.tmp'
+            with open(tmp, 'w') as f:
+                for b in builds:
+                    f.write(json.dumps(b)+'\n')
+            os.replace(tmp, path)
+        pass
+
+
+    @staticmethod
+    def load(path: str) -> List[dict]:
+        '''Reads the builds in the history at `path`, oldest first.'''
+        import json
+        builds = []
+        try:
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        builds += [json.loads(line)]
+                    except ValueError:
+                        # skip a line cut short by a crash
+                        pass
+        except OSError:
+            pass
+        return builds
+    pass
+
+
+def _rss_mb(maxrss: int) -> float:
+    '''Converts a `ru_maxrss` value to megabytes.'''
+    import sys
+    # reported in bytes on macOS and in kilobytes elsewhere
+    return maxrss / (1024 * 1024) if sys.platform == 'darwin' else maxrss / 1024
+
+
+class Job:
+    '''CPU and memory tokens that `JobServer` granted to one heavy tool.
+
+    The tool should use `threads` threads. The tokens return when the context
+    exits, when `release` is called, or when this process ends.'''
+
+    # the jobs this process holds, in the order they were acquired
+    _held = []
+
+    def __init__(self, server, tool: str, threads: int, files: list):
+        import threading
+        self._server = server
+        self.tool = tool
+        self.threads = threads
+        self._files = files
+        self._peak_mb = None
+        self._thread = threading.get_ident()
+        Job._held += [self]
+        pass
+
+
+    @staticmethod
+    def current():
+        '''Returns the job most recently acquired by the calling thread that
+        is still held, or `None` if there is none.'''
+        import threading
+        thread = threading.get_ident()
+        for job in reversed(Job._held):
+            if job._thread == thread:
+                return job
+        return None
+
+
+    @staticmethod
+    def observe(proc: Process):
+        '''Notes the peak memory of the tool `proc` that exited for the job
+        it was started in.'''
+        peak_mb = proc.peak_mb()
+        job = proc.job
+        if peak_mb is None or job is None or job not in Job._held:
+            return
+        job._peak_mb = max(job._peak_mb or 0, peak_mb)
+        pass
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.release()
+        return False
+
+
+    def release(self, peak_mb: float=None):
+        '''Returns the tokens and learns the tool's peak memory use, which is
+        the largest tool started in the job unless `peak_mb` is given.'''
+        if self._files is None:
+            return
+        if self in Job._held:
+            Job._held.remove(self)
+        if peak_mb is None:
+            peak_mb = self._peak_mb
+        if self._server is not None and peak_mb is not None and peak_mb > 0:
+            self._server.learn(self.tool, peak_mb)
+        for f in self._files:
+            if os.path.basename(f.name).startswith('mem-') == True:
+                try:
+                    os.remove(f.name)
+                except OSError:
+                    pass
+            f.close()
+        self._files = None
+        pass
+    pass
+
+
+class JobServer:
+    '''Host-wide tokens that keep parallel plugins from oversubscribing the
+    CPU and memory.
+
+    Like make's job server, a heavy tool must hold one token per thread it
+    runs. Each token is a file in a shared directory that a job holds a lock
+    on, so unrelated jobs on the same host share the tokens, and tokens return
+    on their own when a process exits or crashes. A job is also only admitted
+    while the peak memory of the running tools, as learned from past runs,
+    fits within the memory budget.'''
+
+    def __init__(self, root: str=None):
+        import tempfile
+        self._root = root if root is not None else Env.read('ORBIT_ENV_JOBS_DIR', default=os.path.join(tempfile.gettempdir(), 'orbit-jobs'))
+        setting = Env.read('ORBIT_ENV_JOBS', default=str(os.cpu_count() or 1))
+        self.enabled = setting != 'off'
+        try:
+            import fcntl
+        except ImportError:
+            # tokens rely on flock
+            self.enabled = False
+        self.slots = os.cpu_count() or 1
+        if self.enabled == True:
+            try:
+                self.slots = max(1, int(setting))
+            except ValueError:
+                print('warning: Ignoring ORBIT_ENV_JOBS', Env.quote_str(setting), 'that is not a number or "off" (using the number of CPUs:', str(self.slots)+')')
+        self.memory_mb = JobServer.physical_mb()
+        budget = Env.read('ORBIT_ENV_JOBS_MEM_MB', missing_ok=True)
+        if budget is not None:
+            try:
+                self.memory_mb = float(budget)
+            except ValueError:
+                print('warning: Ignoring ORBIT_ENV_JOBS_MEM_MB', Env.quote_str(budget), 'that is not a number of megabytes')
+        pass
+
+
+    @staticmethod
+    def physical_mb() -> float:
+        '''Returns the size of this host's memory, or `None` if unknown.'''
+        try:
+            return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / (1024 * 1024)
+        except (ValueError, OSError, AttributeError):
+            return None
+
+
+    def _open(self, name: str):
+        f = open(os.path.join(self._root, name), 'a+')
+        try:
+            # tokens are shared with the other users of this host
+            os.chmod(f.name, 0o666)
+        except OSError:
+            pass
+        return f
+
+
+    def _try_lock(self, f) -> bool:
+        import fcntl
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except OSError:
+            return False
+
+
+    def _load(self) -> dict:
+        import json
+        try:
+            with open(os.path.join(self._root, 'peak-rss.json'), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+
+    def estimate(self, tool: str) -> float:
+        '''Returns the expected peak memory of `tool` in megabytes (0 if unknown).'''
+        return float(self._load().get(tool, 0))
+
+
+    def learn(self, tool: str, peak_mb: float):
+        '''Updates the expected peak memory of `tool` after a run.'''
+        import json
+        if self.enabled == False:
+            return
+        with Lock(os.path.join(self._root, '.lock')):
+            history = self._load()
+            old = history.get(tool)
+            # lean toward the larger value since running out of memory is worse
+            history[tool] = round(peak_mb if old is None else max(peak_mb, (old + peak_mb) / 2), 1)
+            tmp = os.path.join(self._root, 'peak-rss.json.tmp')
+            with open(tmp, 'w') as f:
+                json.dump(history, f, indent=2, sort_keys=True)
+            os.replace(tmp, os.path.join(self._root, 'peak-rss.json'))
+        pass
+
+
+    def _reserved_mb(self) -> float:
+        '''Sums the memory of the admitted jobs, clearing those that ended.
+
+        Assumes the exclusive lock is already held.'''
+        total = 0.0
+        for name in os.listdir(self._root):
+            if name.startswith('mem-') == False:
+                continue
+            path = os.path.join(self._root, name)
+            try:
+                with open(path, 'r+') as f:
+                    # a reservation nobody holds belongs to a job that ended
+                    if self._try_lock(f) == True:
+                        os.remove(path)
+                        continue
+                    total += float(f.read().strip() or 0)
+            except (OSError, ValueError):
+                pass
+        return total
+
+
+    def acquire(self, tool: str, threads: int=1) -> Job:
+        '''Waits for tokens to run `tool` with up to `threads` threads.
+
+        The job gets as many of the tokens as are free, but at least one.'''
+        threads = max(1, threads)
+        if self.enabled == False:
+            return Job(None, tool, min(threads, self.slots), [])
+        import time, uuid
+        os.makedirs(self._root, exist_ok=True)
+        need_mb = self.estimate(tool)
+        waiting = False
+        while True:
+            held = []
+            with Lock(os.path.join(self._root, '.lock')):
+                for i in range(self.slots):
+                    if len(held) >= threads:
+                        break
+                    f = self._open('slot-'+str(i))
+                    if self._try_lock(f) == True:
+                        held += [f]
+                    else:
+                        f.close()
+                reason = None
+                if len(held) == 0:
+                    reason = 'all '+str(self.slots)+' cores are in use'
+                else:
+                    reserved = self._reserved_mb()
+                    # a job that fits nowhere still runs once it is alone
+                    if self.memory_mb is not None and reserved > 0 and reserved + need_mb > self.memory_mb:
+                        reason = str(round(need_mb))+' MB of memory is not free'
+                if reason is None:
+                    reservation = self._open('mem-'+uuid.uuid4().hex)
+                    self._try_lock(reservation)
+                    reservation.write(str(need_mb))
+                    reservation.flush()
+                    return Job(self, tool, len(held), held + [reservation])
+                for f in held:
+                    f.close()
+            if waiting == False:
+                print('info: Waiting to run', tool, 'because', reason, '...', flush=True)
+                waiting = True
+            time.sleep(0.25)
+        pass
+    pass
+
+
+def hold(tool: str, threads: int, pid: int):
+    '''Acquires tokens for the process `pid`, prints the number of threads it
+    may use, and keeps the tokens until that process exits.
+
+    This is how tools driven by Tcl scripts take part in the job server.'''
+    import time
+    job = JobServer().acquire(tool, threads)
+    print(job.threads, flush=True)
+    peak_mb = None
+    while True:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            break
+        except PermissionError:
+            pass
+        # the process's peak memory is only visible while it runs
+        try:
+            with open('/proc/'+str(pid)+'/status', 'r') as f:
+                for line in f:
+                    if line.startswith('VmHWM:') == True:
+                        # the process may reset its peak between stages
+                        peak_mb = max(peak_mb or 0, int(line.split()[1]) / 1024)
+        except (OSError, ValueError):
+            pass
+        time.sleep(1)
+    job.release(peak_mb if peak_mb is not None else 0)
+    pass
+
+
+def trace(plugin: str, path: str):
+    '''Saves the build of `plugin` from the stages a Tcl flow recorded in the
+    file at `path`, one JSON object per line with the stage's name, start and
+    end (in seconds), CPU seconds, and peak memory (in MB).
+
+    The trace and summary are saved next to the file.'''
+    build = Telemetry(plugin, os.path.dirname(os.path.abspath(path)))
+    for st in Telemetry.load(path):
+        build.stages += [{'name': st['name'], 'start': st['start'], 'end': st['end'], 'cpu': st.get('cpu', 0.0), 'python_cpu': 0.0, 'peak_mb': st.get('peak_mb', 0.0), 'tools': 0}]
+    if len(build.stages) > 0:
+        build.save()
+    pass
+
+
+def history(plugin: str=None, ip: str=None, last: int=Telemetry.HISTORY_WINDOW):
+    '''Prints how long each stage took in the `last` builds of every testbench
+    or design, to spot stages that became slower over time.'''
+    import statistics
+    groups = {}
+    for b in Telemetry.load(Telemetry.default_history()):
+        if (plugin is not None and b.get('plugin') != plugin) or (ip is not None and b.get('ip') != ip):
+            continue
+        groups.setdefault((b.get('plugin', ''), b.get('ip', ''), b.get('bench', '') or b.get('top', '')), []).append(b)
+    if len(groups) == 0:
+        print('info: No builds recorded in', Env.quote_str(Telemetry.default_history()))
+    for ((name, ip_name, unit), builds) in sorted(groups.items()):
+        builds = builds[-last:]
+        print('info:', name, 'for', ':'.join([x for x in [ip_name, unit] if x != '']) or '-', '('+str(len(builds))+' builds)')
+        table = [['Stage', 'Last', 'Median', 'Min', 'Max', 'Last/Median']]
+        stages = ['total'] + list(dict.fromkeys([k for b in builds for k in b.get('stages', {}).keys()]))
+        for stage in stages:
+            times = [b['seconds'] if stage == 'total' else b['stages'][stage]['seconds'] for b in builds if stage == 'total' or stage in b.get('stages', {})]
+            median = statistics.median(times)
+            table += [[stage] + ['%.2f' % t for t in [times[-1], median, min(times), max(times)]] + ['%.2f' % (times[-1] / median) if median > 0 else '-']]
+        widths = [max([len(r[c]) for r in table]) for c in range(len(table[0]))]
+        for r in table:
+            print('    '+'  '.join([(cell.ljust(w) if c == 0 else cell.rjust(w)) for (c, (cell, w)) in enumerate(zip(r, widths))]).rstrip())
+    pass
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='mod', allow_abbrev=False)
+    commands = parser.add_subparsers(dest='command', required=True)
+    cmd = commands.add_parser('hold', help='hold job server tokens for another process until it exits')
+    cmd.add_argument('tool', help='name of the tool to learn the memory use of')
+    cmd.add_argument('pid', type=int, help='process to hold the tokens for')
+    cmd.add_argument('--threads', type=int, default=os.cpu_count(), metavar='NUM', help='most threads the tool can use')
+    cmd = commands.add_parser('trace', help='save the telemetry of stages recorded by a Tcl flow')
+    cmd.add_argument('plugin', help='name of the plugin that ran the stages')
+    cmd.add_argument('events', help='file of stages, one JSON object per line')
+    cmd = commands.add_parser('history', help='show how long the stages of recent builds took')
+    cmd.add_argument('--plugin', default=None, help='only show builds by this plugin')
+    cmd.add_argument('--ip', default=None, help='only show builds of this ip')
+    cmd.add_argument('--last', type=int, default=Telemetry.HISTORY_WINDOW, metavar='NUM', help='number of recent builds to show')
+    args = parser.parse_args()
+    if args.command == 'hold':
+        hold(args.tool, args.threads, args.pid)
+    elif args.command == 'trace':
+        trace(args.plugin, args.events)
+    elif args.command == 'history':
+        history(args.plugin, args.ip, max(1, args.last))
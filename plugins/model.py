@@ -0,0 +1,143 @@
+# Project: orbit-profile
+# Module: model.py
+#
+# Runs the Python software model that generates test vectors for a simulation.
+#
+# Normally the model runs to completion before the simulator starts and writes
+# its vector files to disk. In streaming mode, the vector files are replaced by
+# named pipes (FIFOs) and the model runs in a thread alongside the simulator.
+# The testbench reads the pipes as ordinary files, the model blocks whenever the
+# testbench falls behind, and no vector data is stored on disk.
+
+import os, sys, threading
+from typing import List
+
+from mod import Env, Status
+
+
+def run_model(py_model: str, main: bool=False):
+    '''Runs the Python model script at `py_model` in its own namespace.
+
+    With `main`, the script runs as `__main__` like it would from the command line.'''
+    import runpy
+    # switch the sys.path[0] from this script's path to the model's path
+    this_script_path = sys.path[0]
+    sys.path[0] = os.path.dirname(py_model)
+    try:
+        runpy.run_path(py_model, init_globals={}, run_name='__main__' if main == True else None)
+    finally:
+        sys.path[0] = this_script_path
+    pass
+
+
+class Stream:
+    '''Feeds the vector `files` of a model to the simulator through named pipes.
+
+    Files the model writes that are not streamed must be written before the
+    model opens its first stream, since the simulator is already running.'''
+
+    def __init__(self, py_model: str, files: List[str]):
+        self._model = py_model
+        self._files = files
+        self._thread = None
+        self._error = None
+        self._broken = False
+        pass
+
+
+    def open(self):
+        '''Creates a named pipe in place of each streamed file.'''
+        if hasattr(os, 'mkfifo') == False:
+            exit('error: Streaming test vectors requires named pipes, which are not supported on this platform')
+        for path in self._files:
+            if os.path.lexists(path) == True:
+                os.remove(path)
+            os.mkfifo(path)
+        return self
+
+
+    def close(self):
+        '''Removes the named pipes so later runs write regular files again.'''
+        for path in self._files:
+            if os.path.exists(path) == True and os.path.isfile(path) == False:
+                os.remove(path)
+        pass
+
+
+    def _run(self):
+        try:
+            run_model(self._model)
+        except BrokenPipeError:
+            # the simulator stopped reading
+            self._broken = True
+        except SystemExit as e:
+            if e.code is not None and e.code != 0:
+                self._error = 'exited with code '+str(e.code)
+        except BaseException as e:
+            import traceback
+            traceback.print_exc()
+            self._error = type(e).__name__+': '+str(e)
+        pass
+
+
+    def start(self):
+        '''Runs the model in the background.'''
+        print("info: Streaming Python software model into", ', '.join([Env.quote_str(f) for f in self._files]), "...")
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+
+    def check(self) -> str:
+        '''Returns why the simulation should stop, if the model failed.
+
+        The testbench would otherwise wait forever for vectors that never arrive.'''
+        if self._thread.is_alive() == False and self._error is not None:
+            return 'Python model failed'
+        return None
+
+
+    def _release(self):
+        '''Unblocks a model waiting to open a stream that nobody will read.'''
+        for path in self._files:
+            try:
+                os.close(os.open(path, os.O_RDONLY | os.O_NONBLOCK))
+            except OSError:
+                pass
+        pass
+
+
+    def finish(self, status: Status) -> Status:
+        '''Stops the model once the simulation that exited with `status` is done.'''
+        # nothing reads the pipes anymore
+        while self._thread.is_alive() == True:
+            self._release()
+            self._thread.join(0.05)
+        if self._error is not None:
+            print('error: Python model failed ('+self._error+')')
+            return Status.FAIL
+        if self._broken == True and status == Status.OKAY:
+            print('warning: Simulation finished before reading all streamed vectors')
+        return status
+    pass
+
+
+if __name__ == '__main__':
+    # runs a model in its own process for plugins that do not run Python
+    # themselves, remembering its outputs when a seed is given:
+    #   python model.py [--force] <script> [args...]
+    argv = sys.argv[1:]
+    force = len(argv) > 0 and argv[0] == '--force'
+    if force == True:
+        argv = argv[1:]
+    if len(argv) == 0:
+        exit('error: No model script to run')
+    py_model = argv[0]
+    # the model only sees its own arguments
+    sys.argv = argv
+    if len([a for a in argv[1:] if a.startswith('--seed=') == True]) > 0:
+        from memo import Memo
+        Memo(py_model, argv[1:], None).run(lambda: run_model(py_model, main=True), reuse=force == False)
+    else:
+        run_model(py_model, main=True)
+    pass
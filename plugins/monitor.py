@@ -0,0 +1,246 @@
+# Project: orbit-profile
+# Module: monitor.py
+#
+# Watches a simulator's output while it runs.
+#
+# Each line the simulator prints is echoed and classified by its assertion
+# severity (note, warning, error, failure) as soon as it arrives. The simulator
+# is stopped early after the first failure ('--fail-fast'), after a number of
+# errors ('--max-errors'), or after a wall-clock timeout ('--timeout'). A limit
+# on simulated time ('--stop-time') is passed to the simulator itself, and the
+# monitor reports which of these ended the run.
+
+import re, time, queue, threading, subprocess
+from typing import Callable, Dict
+
+from mod import Command, Status
+
+SEVERITIES = ['note', 'warning', 'error', 'failure']
+
+# time units in femtoseconds
+UNITS = {
+    'fs': 1,
+    'ps': 10**3,
+    'ns': 10**6,
+    'us': 10**9,
+    'ms': 10**12,
+    'sec': 10**15,
+    's': 10**15,
+    'min': 60 * 10**15,
+    'hr': 3600 * 10**15,
+}
+
+TIME = r'(\d+(?:\.\d+)?) ?(fs|ps|ns|us|ms|sec|s|min|hr)\b'
+
+
+class Dialect:
+    '''Patterns for reading the output of one simulator.'''
+
+    def __init__(self, severities, time: str):
+        # (pattern, severity) pairs; a severity of `None` uses the match's first group
+        self.severities = [(re.compile(p, re.IGNORECASE), s) for (p, s) in severities]
+        self.time = re.compile(time)
+        pass
+    pass
+
+
+DIALECTS: Dict[str, Dialect] = {
+    # tb.vhd:12:5:@20ns:(assertion error): message
+    # ghdl:info: simulation stopped by --stop-time @20ns
+    'ghdl': Dialect([
+        (r':\((?:assertion|report) (note|warning|error|failure)\)', None),
+        (r'^ghdl:error:', 'error'),
+    ], r'[: ]@'+TIME),
+    # # ** Error: message
+    # #    Time: 20 ns  Iteration: 0  Instance: /tb
+    'modelsim': Dialect([
+        (r'^# \*\* (note|warning|error|failure)\b', None),
+        (r'^# \*\* fatal\b', 'failure'),
+    ], r'Time: '+TIME),
+    # Error: message
+    # Time: 20 ns  Iteration: 0  Process: /tb/line__12
+    'xsim': Dialect([
+        (r'^(note|warning|error|failure): ', None),
+        (r'^fatal: ', 'failure'),
+    ], r'Time: '+TIME),
+}
+
+# printed by the simulator when it reaches the simulated-time limit
+STOPPED = re.compile(r'orbit: stopped at (.*)$|simulation stopped by --stop-time')
+
+
+def parse_time(s: str) -> int:
+    '''Converts a simulated time such as '10us' or '2.5 ms' into femtoseconds.'''
+    m = re.fullmatch(TIME, s.strip())
+    if m is None:
+        raise ValueError('invalid time: '+s)
+    return int(float(m.group(1)) * UNITS[m.group(2)])
+
+
+def format_time(fs: int) -> str:
+    '''Writes `fs` femtoseconds in the largest unit that keeps it a whole number.'''
+    for unit in ['sec', 'ms', 'us', 'ns', 'ps']:
+        if fs % UNITS[unit] == 0:
+            return str(fs // UNITS[unit])+' '+unit
+    return str(fs)+' fs'
+
+
+def add_arguments(parser):
+    '''Adds the options for stopping a simulation early to the argument `parser`.'''
+    parser.add_argument('--fail-fast', action='store_true', default=False, help='stop the simulation after the first failure')
+    parser.add_argument('--max-errors', type=int, default=None, metavar='NUM', help='stop the simulation after this many errors')
+    parser.add_argument('--timeout', type=float, default=None, metavar='SEC', help='stop the simulation after this many seconds')
+    parser.add_argument('--stop-time', type=parse_time, default=None, metavar='TIME', help='stop the simulation at this simulated time (ex: 10us)')
+    pass
+
+
+class Lines:
+    '''Reads the output of a process line by line in the background.'''
+
+    def __init__(self, proc: subprocess.Popen):
+        self._queue = queue.Queue()
+        threading.Thread(target=self._read, args=(proc,), daemon=True).start()
+        pass
+
+
+    def _read(self, proc: subprocess.Popen):
+        for line in proc.stdout:
+            self._queue.put(line)
+        self._queue.put(None)
+        pass
+
+
+    def get(self, timeout: float) -> str:
+        '''Returns the next line, `None` once the output ends, or raises
+        `queue.Empty` after `timeout` seconds.'''
+        return self._queue.get(timeout=timeout)
+    pass
+
+
+class Monitor:
+    '''Classifies a simulator's output and decides when to stop it.'''
+
+    def __init__(self, dialect: str, fail_fast: bool=False, max_errors: int=None, timeout: float=None, stop_time: int=None):
+        self._dialect = DIALECTS[dialect]
+        self._fail_fast = fail_fast
+        self._max_errors = max_errors
+        self._timeout = timeout
+        self._stop_time = stop_time
+        self.counts = dict([(s, 0) for s in SEVERITIES])
+        # latest simulated time seen in the output (femtoseconds)
+        self.now = None
+        self.reason = None
+        # a run cut short by the wall clock may end differently the next time
+        self.timed_out = False
+        pass
+
+
+    @staticmethod
+    def from_args(dialect: str, args):
+        '''Creates a monitor from the options added with `add_arguments`.'''
+        return Monitor(dialect, args.fail_fast, args.max_errors, args.timeout, args.stop_time)
+
+
+    def feed(self, line: str) -> bool:
+        '''Classifies one line of output. Returns `True` if the simulation should stop.'''
+        m = self._dialect.time.search(line)
+        if m is not None:
+            self.now = parse_time(m.group(1)+m.group(2))
+        m = STOPPED.search(line)
+        if m is not None:
+            limit = None
+            try:
+                limit = parse_time(m.group(1)) if m.group(1) is not None else None
+            except ValueError:
+                pass
+            if limit is not None:
+                self.now = limit
+            if self._stop_time is not None and (limit is None or limit >= self._stop_time):
+                self.reason = 'reached the simulated-time limit of '+format_time(self._stop_time)
+                self.now = self._stop_time
+            return False
+        for (pattern, severity) in self._dialect.severities:
+            m = pattern.search(line)
+            if m is None:
+                continue
+            severity = severity if severity is not None else m.group(1).lower()
+            self.counts[severity] += 1
+            if severity == 'failure' and self._fail_fast == True:
+                self.reason = 'stopped after the first failure'
+                return True
+            errors = self.counts['error'] + self.counts['failure']
+            if self._max_errors is not None and errors >= self._max_errors:
+                self.reason = 'stopped after '+str(errors)+' errors'
+                return True
+            break
+        return False
+
+
+    def watch(self, proc: subprocess.Popen, poll: Callable[[], str]=None, lines: Lines=None, until: str=None, log=None) -> Status:
+        '''Echoes and classifies the output of `proc` until it exits or must stop.
+
+        The process must be started with `Command.start(group=True, capture=True)`.
+        The optional `poll` is called regularly and returns a reason to stop the
+        simulation, or `None`. For a process that runs several simulations,
+        the output is read from its existing `lines` and watching ends at the
+        first line matching `until`. Each line is also written to `log`.'''
+        if lines is None:
+            lines = Lines(proc)
+        end = re.compile(until) if until is not None else None
+
+        deadline = time.monotonic() + self._timeout if self._timeout is not None else None
+        stop = False
+        try:
+            while True:
+                wait = 0.1
+                if deadline is not None:
+                    wait = min(wait, deadline - time.monotonic())
+                    if wait <= 0:
+                        self.reason = 'stopped after the wall-clock timeout of '+str(self._timeout)+'s'
+                        self.timed_out = True
+                        stop = True
+                        break
+                cause = poll() if poll is not None else None
+                if cause is not None:
+                    self.reason = 'stopped because the '+cause
+                    stop = True
+                    break
+                try:
+                    line = lines.get(timeout=wait)
+                except queue.Empty:
+                    continue
+                if line is None:
+                    break
+                if end is not None and end.search(line) is not None:
+                    if self.reason is None:
+                        self.reason = 'completed'
+                    return Status.OKAY
+                print(line, end='', flush=True)
+                if log is not None:
+                    log.write(line)
+                if self.feed(line) == True:
+                    stop = True
+                    break
+        except KeyboardInterrupt:
+            Command.stop(proc)
+            raise
+        if stop == True:
+            Command.stop(proc)
+            return Status.FAIL
+        proc.wait()
+        # a session that exits before finishing the run has failed too
+        if proc.returncode != 0 or end is not None:
+            self.reason = 'exited with code '+str(proc.returncode)
+            return Status.FAIL
+        if self.reason is None:
+            self.reason = 'completed'
+        return Status.OKAY
+
+
+    def report(self):
+        '''Summarizes the messages seen and why the simulation ended.'''
+        at = ' at '+format_time(self.now) if self.now is not None else ''
+        print('info: Simulation '+str(self.reason)+at)
+        print('info: Assertions:', ', '.join([str(self.counts[s])+' '+s+('s' if self.counts[s] != 1 else '') for s in SEVERITIES]))
+        pass
+    pass
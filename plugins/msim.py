@@ -8,10 +8,20 @@
 import os, sys, shutil, argparse, random
 from typing import List
 
-from mod import Env, Generic, Command, Hdl, Blueprint
+from daemon import delegate
+
+# run on the warm profile daemon instead when one is available
+delegate(__file__)
+
+from mod import Env, Generic, Command, Hdl, Blueprint, Status, Fingerprint, JobServer, Telemetry
+from session import parse_seeds, parse_sweep
+import monitor, checker, layer
 
 SIM_DIR = "msim"
 
+# directory within SIM_DIR that holds saved simulation states
+CHECKPOINT_DIR = 'checkpoints'
+
 # temporarily append modelsim installation path to PATH env variable
 MODELSIM_PATH = Env.read("ORBIT_ENV_MODELSIM_PATH", missing_ok=True)
 Env.add_path(MODELSIM_PATH)
@@ -19,8 +29,14 @@ Env.add_path(MODELSIM_PATH)
 DO_FILE = 'orbit.do'
 WAVEFORM_FILE = 'vsim.wlf'
 
+# directory within SIM_DIR that holds the scripts and logs of a sweep's runs
+RUN_DIR = 'runs'
+
 ## Handle command-line arguments
 
+# stands in for a seed to be chosen at random
+ANY_SEED = object()
+
 parser = argparse.ArgumentParser(prog='msim', allow_abbrev=False)
 
 parser.add_argument('--enable-veriti', default=0, metavar='BIT', help="toggle the usage of veriti verification library")
@@ -28,23 +44,38 @@ parser.add_argument('--enable-veriti', default=0, metavar='BIT', help="toggle th
 parser.add_argument('--lint', action='store_true', default=False, help='perform static code analysis and exit')
 parser.add_argument('--run-model', default=1, metavar='BIT', help="run the pre-simulation script")
 parser.add_argument('--run-sim', default=1, metavar='BIT', help='start process to run through simulation')
+parser.add_argument('--stream', action='append', default=[], metavar='FILE', help="stream a vector file from the model to the simulation through a pipe")
+parser.add_argument('--lib-cache', default=1, metavar='BIT', help="toggle the machine-wide cache of precompiled libraries")
+monitor.add_arguments(parser)
+checker.add_arguments(parser)
 
 parser.add_argument('--gui', action='store_true', default=False, help='open the gui')
 parser.add_argument('--review', action='store_true', default=False, help='review the previous simulation')
 parser.add_argument('--clean', action='store_true', default=False, help='remove previous simulation artifacts')
 parser.add_argument('--generic', '-g', action='append', type=Generic.from_arg, default=[], metavar='KEY=VALUE', help='override top-level VHDL generics')
-parser.add_argument('--seed', action='store', type=int, nargs='?', default=None, const=random.randrange(sys.maxsize), metavar='NUM', help='set the randomness seed')
+parser.add_argument('--seed', action='store', type=int, nargs='?', default=None, const=ANY_SEED, metavar='NUM', help='set the randomness seed')
+parser.add_argument('--force', action='store_true', default=False, help='run the simulation even if its result is cached')
+parser.add_argument('--skip-compile', action='store_true', default=False, help='use the libraries already compiled by an earlier run')
+parser.add_argument('--run-dir', default=None, metavar='DIR', help='simulate in this directory instead of the compilation directory')
+parser.add_argument('--isolate', action='store_true', default=False, help='simulate in a new directory of its own over the shared compiled libraries')
+parser.add_argument('--watch', action='store_true', default=False, help='compile and simulate again whenever a source file changes')
+parser.add_argument('--profile', action='store_true', default=False, help='rank the design units by their share of the simulation time')
 
 parser.add_argument('--top-config', default=None, help='define the top-level configuration unit')
+parser.add_argument('--checkpoint', default=None, metavar='TIME|EXPR', help='save and later restore the simulation state at a time or when a condition is met')
+parser.add_argument('--sweep-seeds', type=parse_seeds, default=None, metavar='LIST', help='simulate once per seed in one vsim session (ex: 1-20,33)')
+parser.add_argument('--sweep-generic', action='append', type=parse_sweep, default=[], metavar='KEY=V1,V2', help='simulate once per value of a generic in one vsim session')
 
 args = parser.parse_args()
 
 USE_VERITI = int(args.enable_veriti) != 0
 RUN_MODEL = int(args.run_model) != 0
+USE_LIB_CACHE = int(args.lib_cache) != 0
 
-# import and use the veriti library
-if USE_VERITI == True:
-    import veriti
+# a seed chosen at random makes the run irreproducible
+RANDOM_SEED = args.seed is ANY_SEED
+if RANDOM_SEED == True:
+    args.seed = random.randrange(sys.maxsize)
 
 generics: List[Generic] = args.generic
 
@@ -57,6 +88,24 @@ SETUP_SIM_ONLY = int(args.run_sim) == 0
 LINT_ONLY = args.lint
 CLEAN = args.clean
 
+# run many simulations through one vsim session
+SWEEP = args.sweep_seeds is not None or len(args.sweep_generic) > 0
+if SWEEP == True and (OPEN_GUI == True or args.checkpoint is not None or len(args.stream) > 0):
+    exit("error: Sweeps cannot be combined with \"--gui\", \"--checkpoint\", or \"--stream\"")
+if args.watch == True and (OPEN_GUI == True or REVIEW == True or SWEEP == True):
+    exit("error: Option \"--watch\" cannot be combined with \"--gui\", \"--review\", or sweeps")
+if args.profile == True and (OPEN_GUI == True or SWEEP == True):
+    exit("error: Option \"--profile\" cannot be combined with \"--gui\" or sweeps")
+if args.isolate == True and (args.run_dir is not None or args.watch == True):
+    exit("error: Option \"--isolate\" cannot be combined with \"--run-dir\" or \"--watch\"")
+
+# streamed vectors are gone once the simulation ends
+if len(set(args.stream) & set(checker.files(args.compare))) > 0:
+    exit("error: Streamed vector files cannot be compared with \"--compare\"")
+
+# profile the run with modelsim's sampling profiler
+PROFILE = args.profile == True and SETUP_SIM_ONLY == False
+
 # open an existing waveform result
 if REVIEW == True:
     if os.path.exists(WAVEFORM_FILE) == True:
@@ -83,34 +132,223 @@ for rule in Blueprint().parse():
     pass
 
 # force remove directory if clean is enabled
-if CLEAN == True and os.path.exists(SIM_DIR) == True:
-    shutil.rmtree(SIM_DIR)
+if CLEAN == True:
+    for path in [SIM_DIR, args.run_dir]:
+        if path is not None and os.path.exists(path) == True:
+            shutil.rmtree(path)
+
+# the compiled libraries live in SIM_DIR, which is also where the simulation
+# runs unless it is given its own directory
+COMPILE_DIR = os.path.abspath(SIM_DIR)
+os.makedirs(COMPILE_DIR, exist_ok=True)
+
+if args.isolate == True:
+    args.run_dir = layer.run_dir(SIM_DIR)
+    print('info: Running in isolated directory:', Env.quote_str(os.path.abspath(args.run_dir)))
+
+# each run in watch mode starts from the build directory
+BUILD_DIR = os.getcwd()
 
 # enter modelsim directory
-os.makedirs(SIM_DIR, exist_ok=True)
-os.chdir(SIM_DIR)
+if args.run_dir is not None:
+    os.makedirs(args.run_dir, exist_ok=True)
+    os.chdir(args.run_dir)
+else:
+    os.chdir(SIM_DIR)
+
+# record the time of each stage and tool (each run of watch mode records its own,
+# and time spent in the GUI is not part of the build)
+if args.watch == False and OPEN_GUI == False:
+    Telemetry.begin('msim')
+
+# identify the simulator for the caches
+MODELSIM_VERSION: str = None
+version, status = Command('vcom').arg('-version').output()
+if status == Status.OKAY and len(version.strip()) > 0:
+    MODELSIM_VERSION = version.strip()
+
+BENCH = Env.read("ORBIT_BENCH", missing_ok=True)
+
+# reuse the result of an identical earlier simulation
+results = None
+if LINT_ONLY == False and OPEN_GUI == False and SETUP_SIM_ONLY == False and SWEEP == False and args.watch == False and PROFILE == False and BENCH is not None and MODELSIM_VERSION is not None:
+    missing = [path for path in checker.expected(args.compare) if os.path.isfile(path) == False]
+    if len(missing) > 0:
+        print('info: Not caching the result since the expected vectors in', Env.quote_str(missing[0]), 'do not exist yet')
+    elif RUN_MODEL == False and py_model != None:
+        # the vectors left by an earlier run of the model are not in the key
+        print('info: Not caching the result of a run that reuses the Python model\'s earlier outputs')
+    elif RUN_MODEL == True and py_model != None and (args.seed is None or RANDOM_SEED == True):
+        print('info: Not caching the result of a randomized run without a fixed seed')
+    else:
+        from simcache import ResultCache, replay, model_files
+        fp = Fingerprint() \
+            .add('msim', MODELSIM_VERSION, BENCH, top_level_config, USE_VERITI, RUN_MODEL, args.seed) \
+            .add(args.fail_fast, args.max_errors, args.stop_time, args.checkpoint) \
+            .add(args.compare, args.columns, args.radix, args.tolerance, args.mask) \
+            .add(*[item.to_str() for item in generics])
+        # the verdict depends on what the expected vectors hold
+        for path in checker.expected(args.compare):
+            fp.add_file(path)
+        for item in compile_order:
+            fp.add(item.lib).add_file(item.path)
+        if py_model != None:
+            for path in model_files(py_model):
+                fp.add(os.path.relpath(path, os.path.dirname(os.path.abspath(py_model)))).add_file(path)
+        results = ResultCache('msim', fp)
+        verdict = results.restore() if args.force == False else None
+        if verdict is not None:
+            exit(replay(verdict))
+    pass
+
+# the simulation state saved after the testbench's initialization phase
+checkpoint: str = None
+checkpoint_time: int = None
+restore = False
+if args.checkpoint is not None and LINT_ONLY == False and MODELSIM_VERSION is None:
+    print('warning: Unable to determine ModelSim version; skipping checkpoint')
+elif args.checkpoint is not None and LINT_ONLY == False:
+    try:
+        checkpoint_time = monitor.parse_time(args.checkpoint)
+    except ValueError:
+        # otherwise the checkpoint is taken when the condition becomes true
+        pass
+    # any change to the elaborated design invalidates the saved state
+    fp = Fingerprint() \
+        .add('msim', MODELSIM_VERSION, BENCH, top_level_config, args.checkpoint) \
+        .add(*[item.to_str() for item in generics])
+    for item in compile_order:
+        fp.add(item.lib).add_file(item.path)
+    # the testbench may preload files that come with the model before the
+    # checkpoint (vectors that differ by seed must be read after it)
+    if py_model != None:
+        from simcache import model_files
+        for path in model_files(py_model):
+            fp.add(os.path.relpath(path, os.path.dirname(os.path.abspath(py_model)))).add_file(path)
+    # a checkpoint only replaces an older one of the same testbench and generics,
+    # so alternating between testbenches or generics keeps each one's state
+    variant = str(BENCH)+'-'+Fingerprint().add(top_level_config).add(*[item.to_str() for item in generics]).digest()[:8]
+    checkpoint = os.path.join(CHECKPOINT_DIR, variant+'-'+fp.digest()[:16]+'.cpt')
+    restore = os.path.exists(checkpoint) == True and args.force == False
+    os.makedirs(CHECKPOINT_DIR, exist_ok=True)
+    if restore == False:
+        for name in os.listdir(CHECKPOINT_DIR):
+            if name.startswith(variant+'-') == True:
+                path = os.path.join(CHECKPOINT_DIR, name)
+                if os.path.isdir(path) == True:
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+    if checkpoint_time is None and args.stop_time is not None:
+        print('warning: Simulated-time limit counts from the checkpoint when it is reached by a condition')
+    pass
 
 # track what libraries we have seen
 libraries = []
 
-print("info: Compiling HDL source code ...")
+# search paths of the precompiled libraries used from the cache
+lib_paths: List[str] = []
+
+# map dependency libraries to the machine-wide cache
+if USE_LIB_CACHE == True:
+    Telemetry.stage('libraries')
+    from libcache import LibCache, partition
+    if MODELSIM_VERSION is not None:
+        cache = LibCache('modelsim', MODELSIM_VERSION, [], compiler='vcom')
+        cached, compile_order = partition(compile_order, Env.read('ORBIT_IP_PATH', missing_ok=True))
+        for (lib, files) in cached:
+            def build(path: str) -> bool:
+                work = os.path.join(path, lib)
+                if Command('vlib').arg(work).spawn() != Status.OKAY:
+                    return False
+                for item in files:
+                    print('  -', Env.quote_str(item.path))
+                    if Command('vcom').arg('-work').arg(work).arg(item.path).spawn() != Status.OKAY:
+                        return False
+                return True
+            path = cache.fetch(lib, files, build)
+            if path is None:
+                exit('error: Failed to precompile library '+Env.quote_str(lib))
+            # later libraries find this one through the local modelsim.ini
+            Command('vmap').arg(lib).arg(os.path.join(path, lib)).spawn().unwrap()
+            libraries.append(lib)
+            lib_paths += [path]
+            pass
+    else:
+        print('warning: Unable to determine ModelSim version; skipping library cache')
+    pass
+
+def compile_hdl(item: Hdl) -> Status:
+    return Command('vcom').arg('-work').arg(item.lib).arg(item.path).spawn()
+
+# watch mode compiles the files itself
+COMPILE = args.skip_compile == False and args.watch == False
+
+# concurrent runs share the compiled libraries (watch mode owns them while it
+# compiles, and each of its runs reads them like any other)
+shared = layer.Layer(COMPILE_DIR)
+key = None
+if COMPILE == True:
+    # the libraries are compiled again only when their sources changed
+    if MODELSIM_VERSION is not None:
+        key = Fingerprint().add('msim', MODELSIM_VERSION, *lib_paths)
+        for item in compile_order:
+            key.add(item.lib).add_file(item.path)
+        key = key.digest()
+    COMPILE = shared.update('compile', key)
+    if COMPILE == False:
+        print("info: Using the libraries compiled by an earlier run")
+elif args.watch == False:
+    shared.share()
+else:
+    # whatever watch mode compiles is not what an earlier run recorded
+    shared.invalidate(['compile'])
+
+job = None
+if COMPILE == True:
+    Telemetry.stage('compile')
+    print("info: Compiling HDL source code ...")
+    # wait for a core from the host's job server
+    job = JobServer().acquire('vcom')
 item: Hdl
 for item in compile_order:
-    print('  -', Env.quote_str(item.path))
+    # libraries are mapped from the local modelsim.ini
+    lib_dir = item.lib if args.run_dir is None else os.path.join(COMPILE_DIR, item.lib)
     # create new libraries and their mappings
     if item.lib not in libraries:
-        Command('vlib').arg(item.lib).spawn().unwrap()
-        Command('vmap').arg(item.lib).arg(item.lib).spawn().unwrap()
+        if COMPILE == True or args.watch == True:
+            Command('vlib').arg(lib_dir).spawn().unwrap()
+        Command('vmap').arg(item.lib).arg(lib_dir).spawn().unwrap()
         libraries.append(item.lib)
     # compile VHDL
-    Command('vcom').arg('-work').arg(item.lib).arg(item.path).spawn().unwrap()
+    if COMPILE == True:
+        print('  -', Env.quote_str(item.path))
+        compile_hdl(item).unwrap()
     pass
 
+if COMPILE == True:
+    job.release()
+    shared.commit('compile', key)
+
+# keep compiling and simulating as the sources change
+if args.watch == True:
+    from watch import Watch
+    def rerun(model_stale: bool) -> Command:
+        forward = [a for a in sys.argv[1:] if a not in ('--watch', '--clean')] + ['--skip-compile']
+        # the vectors of an unchanged model are still in place
+        if model_stale == False and len(args.stream) == 0:
+            forward += ['--run-model', '0']
+        return Command(sys.executable).arg(os.path.abspath(__file__)).args(forward)
+    Watch(compile_order, py_model if RUN_MODEL == True else None).loop(compile_hdl, rerun if LINT_ONLY == False else None, cwd=BUILD_DIR)
+    exit(0)
+
 if LINT_ONLY == True:
     print("info: Static analysis complete")
     exit(0)
 
-# pre-simulation hook: generate test vectors
+# anything besides the generics and seed that is given to the model
+model_context: List[str] = []
+
 if USE_VERITI == True and py_model != None:
     import veriti
 
@@ -120,27 +358,131 @@ if USE_VERITI == True and py_model != None:
     # export the interfaces using orbit to get the json data format
     design_if = Command("orbit").arg("get").arg(ORBIT_TOP).arg("--json").output()[0]
     bench_if = Command("orbit").arg("get").arg(ORBIT_BENCH).arg("--json").output()[0]
-    
-    # prepare the proper context
-    veriti.config.set(design_if=design_if, bench_if=bench_if, work_dir='.', generics=generics, seed=args.seed)
+    model_context = [design_if, bench_if]
     pass
 
-if RUN_MODEL == True and py_model != None:
-    import runpy, sys, os
-    # switch the sys.path[0] from this script's path to the model's path
-    this_script_path = sys.path[0]
-    sys.path[0] = os.path.dirname(py_model)
-    print("info: Running Python software model ...")
-    # run the python model script in its own namespace
-    runpy.run_path(py_model, init_globals={})
-    sys.path[0] = this_script_path
+# the model runs alongside the simulation when its vectors are streamed
+STREAM = RUN_MODEL == True and py_model != None and len(args.stream) > 0
+
+
+def prepare_model(seed, generics: List[Generic], fixed: bool):
+    '''Pre-simulation hook: generates the test vectors for a simulation with
+    `seed` and `generics`, reusing earlier outputs when the seed is `fixed`.'''
+    if USE_VERITI == True and py_model != None:
+        # prepare the proper context
+        veriti.config.set(design_if=design_if, bench_if=bench_if, work_dir='.', generics=generics, seed=seed)
+    if RUN_MODEL == True and py_model != None and STREAM == False:
+        from model import run_model
+        Telemetry.stage('model')
+        print("info: Running Python software model ...")
+        # outputs of a run with a fixed seed can be reused when nothing changed
+        if seed is not None and fixed == True:
+            from memo import Memo
+            Memo(py_model, [item.to_str() for item in generics], seed, model_context) \
+                .run(lambda: run_model(py_model), reuse=args.force == False)
+        else:
+            run_model(py_model)
     pass
 
-BENCH = Env.read("ORBIT_BENCH", missing_ok=True)
+
+if SWEEP == False:
+    prepare_model(args.seed, generics, RANDOM_SEED == False)
 
 if BENCH is None:
     exit('error: No testbench to simulate\n\nUse \"--lint\" to only compile the HDL code or set a testbench to simulate')
 
+# override bench with top-level config
+BENCH = top_level_config if top_level_config != None else BENCH
+
+
+def write_run(file):
+    '''Writes the commands that run the loaded simulation to the .do `file`.'''
+    if args.stop_time is not None:
+        # a restored simulation starts at the checkpoint's time
+        remaining = args.stop_time - (checkpoint_time if checkpoint_time != None else 0)
+        if remaining > 0:
+            file.write('run '+monitor.format_time(remaining)+'\n')
+        file.write('echo "orbit: stopped at $now"\n')
+    else:
+        file.write('run -all\n')
+    pass
+
+
+# run every combination of swept seeds and generics in one vsim session
+if SWEEP == True and SETUP_SIM_ONLY == False:
+    from session import Session, expand
+    if os.path.exists(RUN_DIR) == True:
+        shutil.rmtree(RUN_DIR)
+    os.makedirs(RUN_DIR)
+    runs = expand(generics, args.sweep_generic, args.sweep_seeds if args.sweep_seeds is not None else [])
+    print("info: Sweeping", len(runs), "simulations of testbench", Env.quote_str(BENCH), "in one vsim session ...")
+    session = Session(Command('vsim').arg('-c'))
+    summary = []
+    # the session holds one core from the host's job server throughout
+    job = JobServer().acquire('vsim')
+    try:
+        for (i, (overrides, seed)) in enumerate(runs):
+            # each run keeps its script, log, and waveform in a directory of its own
+            run = os.path.join(RUN_DIR, 'run-'+str(i+1))
+            os.makedirs(run)
+            name = os.path.join(run, 'run')
+            seed = seed if seed is not None else args.seed
+            design = [item.to_str() for item in overrides]
+            print("info: Starting run", str(i+1), "of", str(len(runs)), "(seed: "+str(seed)+", generics: "+(' '.join(design) if len(design) > 0 else '-')+") ...")
+            prepare_model(seed, overrides, args.sweep_seeds is not None or RANDOM_SEED == False)
+            Telemetry.stage('simulation')
+            session.open()
+            with open(name+'.do', 'w') as file:
+                # keep running the script when an assertion breaks the simulation
+                file.write('onbreak {resume}\n')
+                if session.loaded == design:
+                    file.write('restart -f\n')
+                else:
+                    if session.loaded is not None:
+                        file.write('quit -sim\n')
+                    file.write(' '.join(['vsim', '-onfinish', 'stop', '-wlf', os.path.join(RUN_DIR, WAVEFORM_FILE), BENCH] + ['-g'+g for g in design])+'\n')
+                write_run(file)
+                # the session's waveform starts over with the next run, so keep a copy
+                file.write('dataset save sim '+os.path.join(run, WAVEFORM_FILE)+'\n')
+                pass
+            watcher = monitor.Monitor.from_args('modelsim', args)
+            with open(name+'.log', 'w') as log:
+                status = session.run(name+'.do', watcher, log=log)
+            if status == Status.OKAY:
+                session.loaded = design
+            watcher.report()
+            passed = status == Status.OKAY and watcher.counts['error'] + watcher.counts['failure'] == 0
+            # compare the run's output vectors to its expected vectors
+            if passed == True and len(args.compare) > 0:
+                Telemetry.stage('check')
+                passed = checker.Checker.from_args(args).run(args.compare)
+            # post-simulation hook: analyze outcomes
+            if USE_VERITI == True and passed == True:
+                passed = veriti.log.check(veriti.log.get_name(), None) == True
+            summary += [[str(i+1), str(seed), ' '.join(design) if len(design) > 0 else '-', 'PASS' if passed == True else 'FAIL', str(watcher.reason)]]
+            pass
+    finally:
+        session.close()
+        job.release()
+        shared.release()
+    # print and save a table of the runs
+    table = [['Run', 'Seed', 'Generics', 'Result', 'Reason']] + summary
+    widths = [max([len(row[c]) for row in table]) for c in range(len(table[0]))]
+    lines = ['  '.join([cell.ljust(w) for (cell, w) in zip(row, widths)]).rstrip() for row in table]
+    with open(os.path.join(RUN_DIR, 'summary.txt'), 'w') as f:
+        f.write('\n'.join(lines)+'\n')
+    print("info: Sweep summary ("+str(len([r for r in summary if r[3] == 'PASS']))+" of "+str(len(summary))+" passed):")
+    for line in lines:
+        print('    '+line)
+    print("info: Run logs saved in", Env.quote_str(os.path.abspath(RUN_DIR)))
+    exit(0 if all([r[3] == 'PASS' for r in summary]) == True else Status.FAIL.value)
+
+if PROFILE == True:
+    import hotspot
+    # never read the report of an earlier run
+    if os.path.exists(hotspot.MODELSIM_REPORT) == True:
+        os.remove(hotspot.MODELSIM_REPORT)
+
 # 2. create a .do file to automate modelsim actions
 print("info: Generating .do file ...")
 with open(DO_FILE, 'w') as file:
@@ -159,8 +501,26 @@ with open(DO_FILE, 'w') as file:
         else:
             file.write('add wave *\n')
             pass
+    # sample where the simulation spends its time from the start
+    if PROFILE == True:
+        file.write('profile on\n')
+    # save the state once the testbench reaches the checkpoint
+    if SETUP_SIM_ONLY == False and checkpoint != None and restore == False:
+        if checkpoint_time != None:
+            file.write('run '+monitor.format_time(checkpoint_time)+'\n')
+            file.write('checkpoint '+checkpoint+'\n')
+        else:
+            file.write('when -label orbit_checkpoint {'+args.checkpoint+'} { set orbit_checkpoint 1; stop }\n')
+            file.write('run -all\n')
+            file.write('nowhen orbit_checkpoint\n')
+            file.write('if {[info exists orbit_checkpoint]} { checkpoint '+checkpoint+' }\n')
     if SETUP_SIM_ONLY == False:
-        file.write('run -all\n')
+        write_run(file)
+    if PROFILE == True:
+        # the time reached gives the simulation's throughput
+        if args.stop_time is None:
+            file.write('echo "orbit: stopped at $now"\n')
+        file.write('profile report -du -file '+hotspot.MODELSIM_REPORT+'\n')
     if OPEN_GUI == False:
         file.write('quit\n')
     pass
@@ -170,27 +530,87 @@ with open(DO_FILE, 'w') as file:
 # determine to run as script or as gui
 mode = "-batch" if OPEN_GUI == False else "-gui"
 
-# override bench with top-level config
-BENCH = top_level_config if top_level_config != None else BENCH
-
 # run simulation with vsim
+Telemetry.stage('simulation')
 print("info: Starting VHDL simulation for testbench", Env.quote_str(BENCH), "...")
-Command('vsim') \
-    .arg(mode) \
-    .arg('-onfinish').arg('stop') \
-    .arg('-do').arg(DO_FILE) \
-    .arg('-wlf').arg(WAVEFORM_FILE) \
-    .arg(BENCH) \
-    .args(['-g' + item.to_str() for item in generics]) \
-    .spawn().unwrap()
+if restore == True:
+    print("info: Restoring simulation state from checkpoint", Env.quote_str(checkpoint), "...")
+    sim = Command('vsim') \
+        .arg(mode) \
+        .arg('-restore').arg(checkpoint) \
+        .arg('-do').arg(DO_FILE) \
+        .arg('-wlf').arg(WAVEFORM_FILE)
+else:
+    sim = Command('vsim') \
+        .arg(mode) \
+        .arg('-onfinish').arg('stop') \
+        .arg('-do').arg(DO_FILE) \
+        .arg('-wlf').arg(WAVEFORM_FILE) \
+        .arg(BENCH) \
+        .args(['-g' + item.to_str() for item in generics])
+
+# watch the simulator's output as it runs
+watcher = monitor.Monitor.from_args('modelsim', args)
+
+# wait for a core (and the memory vsim needs) from the host's job server
+job = JobServer().acquire('vsim') if OPEN_GUI == False else None
+
+if STREAM == True:
+    from model import Stream
+    stream = Stream(py_model, args.stream).open().start()
+    try:
+        proc = sim.start(group=True, capture=True)
+        status = stream.finish(watcher.watch(proc, poll=stream.check))
+    finally:
+        stream.close()
+else:
+    proc = sim.start(group=True, capture=True)
+    status = watcher.watch(proc)
+
+if job is not None:
+    job.release(peak_mb=proc.peak_mb())
+shared.release()
+watcher.report()
+
+if PROFILE == True:
+    Telemetry.stage('profile')
+    hotspot.Profile('modelsim', 'profiler samples') \
+        .add(hotspot.read_table(hotspot.MODELSIM_REPORT)) \
+        .measure(proc, watcher.now) \
+        .report()
+
+if checkpoint != None and restore == False and SETUP_SIM_ONLY == False:
+    if os.path.exists(checkpoint) == True:
+        print("info: Saved simulation state to checkpoint", Env.quote_str(checkpoint))
+    else:
+        print("warning: Simulation never reached the checkpoint", Env.quote_str(args.checkpoint))
+
+rc = 0 if status == Status.OKAY else Status.FAIL.value
+scores = {}
+artifacts = [WAVEFORM_FILE]
+
+# post-simulation hook: compare the output vectors to the expected vectors
+if rc == 0 and len(args.compare) > 0:
+    Telemetry.stage('check')
+    if checker.Checker.from_args(args).run(args.compare) == False:
+        rc = Status.FAIL.value
 
 # post-simulation hook: analyze outcomes
-if USE_VERITI == True:
+if USE_VERITI == True and rc == 0:
+    import veriti
+    Telemetry.stage('results')
     log_file = veriti.log.get_name()
     print("info: Simulation history saved at:", veriti.log.get_event_log_path(log_file))
     print("info: Computing results ...")
-    print("info: Simulation score:", veriti.log.report_score(log_file))
+    scores = {'Simulation': str(veriti.log.report_score(log_file))}
+    print("info: Simulation score:", scores['Simulation'])
+    artifacts += [os.path.relpath(veriti.log.get_event_log_path(log_file))]
     rc = 0 if veriti.log.check(log_file, None) == True else 101
-    exit(rc)
-else:
-    print('info: Simulation complete')
\ No newline at end of file
+elif rc == 0:
+    print('info: Simulation complete')
+
+if results is not None and watcher.timed_out == False:
+    results.store({'returncode': rc, 'reason': watcher.reason, 'counts': watcher.counts, 'scores': scores}, artifacts)
+
+if rc != 0 or USE_VERITI == True:
+    exit(rc)
\ No newline at end of file
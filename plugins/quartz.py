@@ -8,15 +8,32 @@
 # The script can auto-detect an Intel FPGA connected to the PC to program
 # with a .pof or .sof bitstream file.
 #
+# The project directory after each stage is saved in the artifact cache, keyed
+# on the Quartus version, the project settings, the source files' contents,
+# and the stages run so far. Only the stages after the last cached one run.
+#
+# The timing and utilization in the reports of the stages are saved in the
+# history of build metrics (metrics.py).
+#
+# With '--isolate', the project is created in a new directory of its own under
+# 'quartz/', so builds of one IP with other generics or boards can run at once.
+# Quartus has no compiled libraries to share between them; what they share is
+# the artifact cache, which is safe to read and write concurrently.
+#
 # [1] https://www.intel.co.jp/content/dam/altera-www/global/ja_JP/pdfs/literature/an/an312.pdf
 # [2] https://community.intel.com/t5/Intel-Quartus-Prime-Software/Passing-parameter-generic-to-the-top-level-in-Quartus-tcl/td-p/239039
 
 from typing import List
 import os
+
+from daemon import delegate
+
+# run on the warm profile daemon instead when one is available
+delegate(__file__)
+
 import argparse
-import toml
 
-from mod import Command, Env, Generic, Blueprint, Hdl
+from mod import Command, Env, Generic, Blueprint, Hdl, Status, Fingerprint, JobServer, Telemetry
 
 # temporarily appends quartus installation path to PATH env variable
 QUARTUS_PATH = Env.read("ORBIT_ENV_QUARTUS_PATH", missing_ok=True)
@@ -77,6 +94,8 @@ parser.add_argument("--prog-sram", action="store_true", default=False, help="pro
 parser.add_argument("--prog-flash", action="store_true", default=False, help="program with permanent bitfile")
 
 parser.add_argument('--generic', '-g', action='append', type=Generic.from_arg, default=[], metavar='key=value', help='override top-level VHDL generics')
+parser.add_argument('--force', action='store_true', default=False, help='run every stage even if its outputs are cached')
+parser.add_argument('--isolate', action='store_true', default=False, help='create the project in a new directory of its own')
 
 args = parser.parse_args()
 
@@ -130,6 +149,13 @@ bdf_files = []
 pin_assignments = []
 
 board_config = None
+
+def load_board(path: str) -> dict:
+    # toml is only needed once a board file is found
+    import toml
+    print('info: Loaded board file:', path)
+    return toml.load(path)
+
 # read/parse blueprint file
 for rule in Blueprint().parse():
     if rule.fileset == 'VHDL-RTL':
@@ -144,12 +170,10 @@ for rule in Blueprint().parse():
         bdf_files += [rule.path]
     elif rule.fileset == 'BOARD-CF':
         if board_config == None and args.board is None:
-            board_config = toml.load(rule.path)
-            print('info: Loaded board file:', rule.path)
+            board_config = load_board(rule.path)
         # match filename with the filename provided on command-line
         elif os.path.splitext(os.path.basename(rule.path))[0] == args.board:
-            board_config = toml.load(rule.path)
-            print('info: Loaded board file:', rule.path)
+            board_config = load_board(rule.path)
         pass
     pass
 
@@ -183,7 +207,6 @@ load_package flow
 # Create the project and overwrite any settings or files that exist
 project_new """ + Env.quote_str(PROJECT) + """ -revision """ + Env.quote_str(PROJECT) + """ -overwrite
 # Set default configurations and device
-set_global_assignment -name NUM_PARALLEL_PROCESSORS """ + Env.quote_str("ALL") + """
 set_global_assignment -name VHDL_INPUT_VERSION VHDL_1993
 set_global_assignment -name EDA_SIMULATION_TOOL "ModelSim-Altera (VHDL)"
 set_global_assignment -name EDA_OUTPUT_DATA_FORMAT "VHDL" -section_id EDA_SIMULATION
@@ -198,12 +221,20 @@ set_global_assignment -name INTERNAL_FLASH_UPDATE_MODE "SINGLE IMAGE WITH ERAM"
 set_global_assignment -name RESERVE_ALL_UNUSED_PINS_WEAK_PULLUP "AS INPUT TRI-STATED"
 """
 
+# wait for cores (and the memory quartus needs) from the host's job server
+job = None
+if flow is not None or synth == True:
+    job = JobServer().acquire('quartus', os.cpu_count() or 1)
+
 # 1. write TCL file for quartus project
 
 tcl = Tcl(TCL_SCRIPT)
 
 tcl.append(PROJECT_SETTINGS)
 
+tcl.append('# Use the cores granted by the job server')
+tcl.append("set_global_assignment -name NUM_PARALLEL_PROCESSORS "+(str(job.threads) if job is not None else Env.quote_str("ALL")), end='\n\n')
+
 tcl.append('#### Application-specific settings ####', end='\n\n')
 
 tcl.append('# Add source code files to the project')
@@ -249,39 +280,112 @@ tcl.append('# Close the project')
 tcl.append('project_close')
 
 # create and enter the quartus project directory
+if args.isolate == True:
+    import layer
+    PROJECT_DIR = layer.run_dir(PROJECT_DIR)
+    print('info: Building in isolated directory:', Env.quote_str(os.path.abspath(PROJECT_DIR)))
 os.makedirs(PROJECT_DIR, exist_ok=True)
 os.chdir(PROJECT_DIR)
 
+# record the time of each stage and tool
+Telemetry.begin('quartz')
+
 # finish writing the TCL script and save it to disk
 tcl.save()
 
 # 2. run quartus with TCL script
 
-# execute quartus using the generated tcl script
-Command("quartus_sh").args(['-t', tcl.get_script()]).spawn().unwrap()
+# list of (stage, command) to run in order
+stages = []
+# outputs restored from the cache may come from a project set up for another host
+parallel = ['--parallel='+str(job.threads)] if job is not None else []
+if flow is not None:
+    # the flow runs within quartus_sh
+    stages += [('compile', Command("quartus_sh").args(['-t', tcl.get_script()]))]
+else:
+    # synthesize design
+    if synth == True:
+        stages += [('map', Command("quartus_map").arg(PROJECT).args(parallel))]
+    # route design to board
+    if impl == True:
+        stages += [('fit', Command("quartus_fit").arg(PROJECT).args(parallel))]
+    # perform static timing analysis
+    if sta == True:
+        stages += [('sta', Command("quartus_sta").arg(PROJECT).args(parallel))]
+    # generate bitstream
+    if asm == True:
+        stages += [('asm', Command("quartus_asm").arg(PROJECT))]
+    # generate necessary files for timing simulation
+    if eda_netlist == True:
+        stages += [('eda', Command("quartus_eda").args([PROJECT, '--simulation']))]
+    pass
+
+# key each stage on everything that affects its outputs, except absolute paths
+artifacts = None
+keys = []
+version, status = Command('quartus_sh').arg('--version').output()
+if len(stages) > 0 and status == Status.OKAY and len(version.strip()) > 0:
+    from artifacts import ArtifactCache
+    artifacts = ArtifactCache()
+    fp = Fingerprint().add('quartus', version.strip(), PROJECT_SETTINGS, top_unit, flow)
+    for item in vhdl_files + vlog_files:
+        fp.add(item.lib).add_file(item.path)
+    for bdf in bdf_files:
+        fp.add_file(bdf)
+    fp.add(*[g.to_str() for g in generics])
+    fp.add(*sorted(board_config.get('pins', {}).items()))
+    key = fp.digest()
+    for (stage, _) in stages:
+        key = Fingerprint().add(key, stage).digest()
+        keys += [key]
+    pass
+
+# restore the outputs of the last stage that is cached
+done = 0
+if artifacts is not None and args.force == False:
+    Telemetry.stage('artifacts')
+    for i in reversed(range(len(stages))):
+        if artifacts.fetch(keys[i]) == True:
+            print('info: Skipping cached stages:', ', '.join([stage for (stage, _) in stages[:i+1]]))
+            done = i+1
+            break
+    pass
+
+# execute quartus using the generated tcl script (restored outputs include the project)
+if done == 0:
+    Telemetry.stage('project' if flow is None else 'compile')
+    Command("quartus_sh").args(['-t', tcl.get_script()]).spawn().unwrap()
 
 # 3. perform a specified toolflow
 
-# synthesize design
-if synth == True:
-    Command("quartus_map").arg(PROJECT).spawn().unwrap()
-# route design to board
-if impl == True:
-    Command("quartus_fit").arg(PROJECT).spawn().unwrap()
-# perform static timing analysis
-if sta == True:
-    Command("quartus_sta").arg(PROJECT).spawn().unwrap()
-# generate bitstream
-if asm == True:
-    Command("quartus_asm").arg(PROJECT).spawn().unwrap()
-# generate necessary files for timing simulation
-if eda_netlist == True:
-    Command("quartus_eda").args([PROJECT, '--simulation']).spawn().unwrap()
+for i in range(len(stages)):
+    (stage, command) = stages[i]
+    if i < done:
+        continue
+    # the compile flow already ran with the tcl script
+    if stage != 'compile':
+        Telemetry.stage(stage)
+        command.spawn().unwrap()
+    if artifacts is not None:
+        artifacts.store(keys[i], os.listdir('.'))
+    pass
+
+if job is not None:
+    job.release()
+
+# keep the timing and utilization of the stages in the history of build metrics
+names = [stage for (stage, _) in stages]
+if len(names) > 0:
+    Telemetry.stage('metrics')
+    from metrics import record_build
+    reports = [(stage, PROJECT+'.'+stage+'.rpt') for stage in ['map', 'fit', 'sta'] if stage in names or 'compile' in names]
+    record_build('quartz', DEVICE, reports)
 
 # 4. program the FPGA board
 
 # auto-detect the FPGA programming cable
 if pgm_temporary == True or pgm_permanent == True:
+    Telemetry.stage('program')
     out, status = Command("quartus_pgm").arg('-a').output()
     status.unwrap()
     if out.startswith('Error ') == True:
@@ -312,5 +416,7 @@ elif pgm_permanent == True:
 
 # open the project using quartus GUI
 if open_project == True:
+    # time spent in the GUI is not part of the build
+    Telemetry.end()
     Command('quartus').arg(PROJECT+'.qpf').spawn().unwrap()
     pass
\ No newline at end of file
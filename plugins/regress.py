@@ -0,0 +1,221 @@
+# Project: orbit-profile
+# Plugin: regress
+#
+# Runs every testbench of an IP with one of the simulation plugins.
+#
+# Testbenches are found in the blueprint's VHDL-SIM files as the entities that
+# have no ports. The design is compiled once, then the chosen plugin (gsim,
+# msim, or xsim) simulates each testbench in its own run directory, several at
+# a time. Testbenches start longest-first based on the runtimes recorded by
+# earlier regressions, so a long testbench does not start last and hold up the
+# whole regression.
+#
+# For CI matrix jobs, '--shard i/N' splits the testbenches into N shards of
+# about equal expected runtime and runs only the i-th one. Every job computes
+# the same split as long as the jobs read the same runtime history.
+
+import os, sys, re, json, time, argparse
+from typing import Dict, List, Tuple
+
+from mod import Env, Command, Status, Blueprint, Lock, Telemetry
+
+# directory within the build directory that holds each testbench's run
+REGRESS_DIR = 'regress'
+
+# arguments that make each plugin compile the design and stop
+COMPILE_ARGS = {
+    'gsim': ['--lint'],
+    'msim': ['--lint'],
+    'xsim': ['--compile'],
+}
+
+# arguments that make each plugin simulate one testbench in `run_dir`
+def run_args(plugin: str, run_dir: str) -> List[str]:
+    if plugin == 'xsim':
+        return ['--elaborate', '--simulate', 'cl', '--run-dir', run_dir]
+    return ['--skip-compile', '--run-dir', run_dir]
+
+
+def parse_shard(s: str) -> Tuple[int, int]:
+    '''Reads a shard such as '2/4' (the second of four).'''
+    m = re.fullmatch(r'(\d+)/(\d+)', s.strip())
+    if m is None or int(m.group(2)) < 1 or int(m.group(1)) < 1 or int(m.group(1)) > int(m.group(2)):
+        raise argparse.ArgumentTypeError('Shard '+Env.quote_str(s)+' must be <i>/<n> with 1 <= i <= n')
+    return (int(m.group(1)), int(m.group(2)))
+
+
+def split(benches: List[str], expected: Dict[str, float], n: int) -> List[List[str]]:
+    '''Assigns the testbenches to `n` shards of about equal expected runtime.
+
+    Each testbench, longest first, goes to the shard with the least work so
+    far. Ties are broken by name and shard number to keep the split stable.'''
+    shards = [[] for _ in range(n)]
+    loads = [0.0 for _ in range(n)]
+    for bench in sorted(benches, key=lambda b: (-expected[b], b)):
+        i = loads.index(min(loads))
+        shards[i] += [bench]
+        loads[i] += expected[bench]
+    return shards
+
+
+class History:
+    '''Runtimes of each testbench recorded by earlier regressions.'''
+
+    def __init__(self, path: str, plugin: str):
+        self._path = path
+        self._plugin = plugin
+        self.runtimes: Dict[str, float] = self._load().get(plugin, {})
+        pass
+
+
+    def _load(self) -> dict:
+        try:
+            with open(self._path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+
+    def expect(self, benches: List[str]) -> Dict[str, float]:
+        '''Estimates the runtime of each testbench, using the average of the
+        known runtimes for testbenches that have not run before.'''
+        known = [self.runtimes[b] for b in benches if b in self.runtimes]
+        default = sum(known) / len(known) if len(known) > 0 else 1.0
+        return dict([(b, self.runtimes.get(b, default)) for b in benches])
+
+
+    def record(self, runtimes: Dict[str, float]):
+        '''Merges new `runtimes` into the history, which other jobs may share.'''
+        os.makedirs(os.path.dirname(os.path.abspath(self._path)), exist_ok=True)
+        with Lock(self._path+'.lock'):
+            history = self._load()
+            entries = history.setdefault(self._plugin, {})
+            for (bench, seconds) in runtimes.items():
+                # smooth out the noise of a single run
+                old = entries.get(bench)
+                entries[bench] = round(seconds if old is None else (old + seconds) / 2, 3)
+            tmp = self._path+'.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(history, f, indent=2, sort_keys=True)
+            os.replace(tmp, self._path)
+        pass
+    pass
+
+
+## Handle command-line arguments
+
+parser = argparse.ArgumentParser(prog='regress', allow_abbrev=False, epilog='Other arguments are passed to the simulation plugin.')
+
+parser.add_argument('--sim', choices=list(COMPILE_ARGS.keys()), default='gsim', help='simulation plugin to run each testbench with')
+parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count(), metavar='NUM', help='number of testbenches to simulate at once')
+parser.add_argument('--shard', type=parse_shard, default=None, metavar='I/N', help='only run the i-th of n shards of the testbenches')
+parser.add_argument('--list', action='store_true', default=False, help='list the testbenches to run and exit')
+
+args, forward = parser.parse_known_args()
+
+PLUGIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), args.sim+'.py')
+HISTORY_FILE = Env.read('ORBIT_ENV_REGRESS_HISTORY', default=os.path.join(REGRESS_DIR, 'runtimes.json'))
+
+## Find the testbenches
+
+benches: List[str] = Blueprint().testbenches()
+
+if len(benches) == 0:
+    exit('error: No testbenches found in the blueprint\'s VHDL-SIM files')
+
+history = History(HISTORY_FILE, args.sim)
+expected = history.expect(benches)
+
+if args.shard is not None:
+    (index, count) = args.shard
+    benches = split(benches, expected, count)[index-1]
+
+# the longest testbenches start first
+benches.sort(key=lambda b: (-expected[b], b))
+
+if args.list == True:
+    for bench in benches:
+        print(bench+'\t'+str(round(expected[bench], 3))+'s')
+    exit(0)
+
+if len(benches) == 0:
+    print('info: No testbenches in this shard')
+    exit(0)
+
+## Compile the design once
+
+# record the time of each stage, with each testbench's run as a tool
+Telemetry.begin('regress', os.path.join(REGRESS_DIR, args.sim), 'compile')
+
+# plugins that always need a testbench still compile without simulating it
+Env.write('ORBIT_BENCH', benches[0])
+print('info: Compiling the design with', args.sim, '...')
+Command(sys.executable).arg(PLUGIN).args(forward + COMPILE_ARGS[args.sim]).spawn().unwrap()
+
+## Simulate the testbenches in parallel
+
+run_root = os.path.abspath(os.path.join(REGRESS_DIR, args.sim))
+os.makedirs(run_root, exist_ok=True)
+
+Telemetry.stage('simulation')
+jobs = max(1, args.jobs if args.jobs is not None else 1)
+print('info: Running', len(benches), 'testbenches with', args.sim, '('+str(jobs)+' at a time) ...')
+
+pending = list(benches)
+running = []
+outcomes: Dict[str, Tuple[bool, float]] = {}
+runtimes: Dict[str, float] = {}
+try:
+    while len(pending) > 0 or len(running) > 0:
+        while len(pending) > 0 and len(running) < jobs:
+            bench = pending.pop(0)
+            log = open(os.path.join(run_root, bench+'.log'), 'w')
+            Env.write('ORBIT_BENCH', bench)
+            proc = Command(sys.executable) \
+                .arg(PLUGIN) \
+                .args(forward + run_args(args.sim, os.path.join(run_root, bench))) \
+                .start(group=True, log=log)
+            running += [(proc, bench, time.monotonic(), log)]
+        time.sleep(0.05)
+        for job in list(running):
+            (proc, bench, start, log) = job
+            if proc.poll() is None:
+                continue
+            running.remove(job)
+            log.close()
+            seconds = time.monotonic() - start
+            passed = proc.returncode == 0
+            outcomes[bench] = (passed, seconds)
+            # a result restored from the cache says nothing about the runtime
+            with open(log.name, 'r', errors='replace') as f:
+                if 'Reusing cached simulation result' not in f.read():
+                    runtimes[bench] = seconds
+            print('info: ['+str(len(outcomes))+'/'+str(len(benches))+']', 'PASS' if passed == True else 'FAIL', bench, '('+str(round(seconds, 1))+'s)')
+        pass
+except KeyboardInterrupt:
+    for (proc, _, _, _) in running:
+        Command.stop(proc)
+    raise
+finally:
+    if len(runtimes) > 0:
+        history.record(runtimes)
+
+# print and save a table of the testbenches
+table = [['Testbench', 'Result', 'Seconds']]
+for bench in benches:
+    (passed, seconds) = outcomes[bench]
+    table += [[bench, 'PASS' if passed == True else 'FAIL', str(round(seconds, 1))]]
+widths = [max([len(row[c]) for row in table]) for c in range(len(table[0]))]
+lines = ['  '.join([cell.ljust(w) for (cell, w) in zip(row, widths)]).rstrip() for row in table]
+with open(os.path.join(run_root, 'summary.txt'), 'w') as f:
+    f.write('\n'.join(lines)+'\n')
+
+failed = [b for b in benches if outcomes[b][0] == False]
+print('info: Regression summary ('+str(len(benches)-len(failed))+' of '+str(len(benches))+' passed):')
+for line in lines:
+    print('    '+line)
+for bench in failed:
+    print('info: Log for', bench, 'saved at:', Env.quote_str(os.path.join(run_root, bench+'.log')))
+
+if len(failed) > 0:
+    exit(Status.FAIL.value)
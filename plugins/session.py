@@ -0,0 +1,111 @@
+# Project: orbit-profile
+# Module: session.py
+#
+# Drives many simulations through one interactive simulator session.
+#
+# Loading and elaborating a design often takes longer than simulating a short
+# test. For a sweep over seeds and generics, the simulator is started once in
+# command-line mode and each run is sent to it as a .do script over stdin. Runs
+# that keep the same generics restart the loaded design ('restart -f') instead
+# of loading it again. After each script, the session echoes a marker so the
+# end of a run can be told apart without the simulator exiting.
+#
+# A run stopped early (such as by '--fail-fast' or '--timeout') takes down the
+# whole session, so the next run starts a new one.
+
+import argparse, itertools, subprocess
+from typing import List, Tuple
+
+from mod import Env, Command, Generic, Status
+from monitor import Monitor, Lines
+
+# printed by the session after each run's script
+MARKER = 'orbit: run done'
+
+
+def parse_seeds(s: str) -> List[int]:
+    '''Expands a list of seeds and seed ranges such as '1-20,33'.'''
+    seeds = []
+    try:
+        for part in s.split(','):
+            bounds = part.strip().split('-', 1)
+            if len(bounds) == 2:
+                seeds += list(range(int(bounds[0]), int(bounds[1])+1))
+            else:
+                seeds += [int(bounds[0])]
+    except ValueError:
+        raise argparse.ArgumentTypeError('Seeds '+Env.quote_str(s)+' must be numbers or ranges (ex: 1-20,33)')
+    return seeds
+
+
+def parse_sweep(s: str) -> Tuple[str, List[str]]:
+    '''Splits a generic to sweep such as 'WIDTH=8,16,32' into its key and values.'''
+    item = Generic.from_arg(s)
+    return (item.key, item.val.split(','))
+
+
+def expand(generics: List[Generic], sweeps: List[Tuple[str, List[str]]], seeds: List[int]) -> List[Tuple[List[Generic], int]]:
+    '''Lists every combination of the swept generic values and seeds.
+
+    Runs that share generics are next to each other so they can reuse the
+    loaded design.'''
+    runs = []
+    for values in itertools.product(*[vals for (_, vals) in sweeps]):
+        swept = dict([(key, val) for ((key, _), val) in zip(sweeps, values)])
+        overrides = [item for item in generics if item.key not in swept] + [Generic(k, v) for (k, v) in swept.items()]
+        for seed in (seeds if len(seeds) > 0 else [None]):
+            runs += [(overrides, seed)]
+    return runs
+
+
+class Session:
+    '''An interactive simulator started with `command` that runs .do scripts.'''
+
+    def __init__(self, command: Command):
+        self._command = command
+        self._proc = None
+        self._lines = None
+        # identifies the design currently loaded in the session, if any
+        self.loaded = None
+        pass
+
+
+    def open(self):
+        '''Starts the simulator if it is not already running.'''
+        if self._proc is None or self._proc.poll() is not None:
+            self._proc = self._command.start(group=True, capture=True, interactive=True)
+            self._lines = Lines(self._proc)
+            self.loaded = None
+        return self
+
+
+    def run(self, do_file: str, watcher: Monitor, log=None, poll=None) -> Status:
+        '''Runs the script `do_file` and watches its output until it finishes.'''
+        self.open()
+        try:
+            # the echoed command itself must not match the marker
+            self._proc.stdin.write('do '+do_file+'\n')
+            self._proc.stdin.write('echo "'+MARKER.replace(' done', '')+'" "done"\n')
+            self._proc.stdin.flush()
+        except BrokenPipeError:
+            pass
+        status = watcher.watch(self._proc, poll=poll, lines=self._lines, until=MARKER, log=log)
+        if status != Status.OKAY:
+            self.loaded = None
+        return status
+
+
+    def close(self):
+        '''Quits the simulator.'''
+        if self._proc is None or self._proc.poll() is not None:
+            return
+        try:
+            self._proc.stdin.write('quit -f\n')
+            self._proc.stdin.close()
+            self._proc.wait(timeout=30)
+        except (BrokenPipeError, OSError):
+            pass
+        except subprocess.TimeoutExpired:
+            Command.stop(self._proc)
+        pass
+    pass
@@ -0,0 +1,121 @@
+# Project: orbit-profile
+# Module: simcache.py
+#
+# A cache of simulation results shared by the simulation plugins on this host.
+#
+# Each result is keyed on a fingerprint of every input that affects the outcome
+# of a simulation: the simulator and its version, the HDL sources in compile
+# order, the Python model and the local modules and data files next to it, the
+# seed, the generics, and the options that decide pass or fail. An entry holds the verdict (exit code, why the simulation
+# stopped, assertion counts, veriti scores) and copies of the key artifacts
+# such as the waveform. A rerun with the same fingerprint restores the entry
+# instead of compiling and simulating again.
+#
+# Entries are written to a temporary name and renamed into place under a file
+# lock, and the least recently used entries are evicted past the size limit.
+
+import os, json, time, shutil, uuid
+from typing import List
+
+from mod import Env, Lock, Fingerprint, cache_home, evict
+
+# size limit of the cache in megabytes if not set by the environment
+DEFAULT_LIMIT_MB = 2048
+
+
+def default_root() -> str:
+    return Env.read('ORBIT_ENV_RESULT_CACHE', default=os.path.join(cache_home(), 'results'))
+
+
+def model_files(py_model: str) -> List[str]:
+    '''Lists the files the Python model `py_model` may read: every file in its
+    directory and below, such as the local modules it imports and its data
+    files. Hidden directories, bytecode, and the build directory are skipped.'''
+    skipped = [os.path.abspath(d) for d in [os.getenv('ORBIT_BUILD_DIR'), os.path.dirname(os.getenv('ORBIT_BLUEPRINT', '')), os.getcwd()] if d is not None and len(d) > 0]
+    root = os.path.dirname(os.path.abspath(py_model))
+    files = []
+    for (dirpath, dirs, names) in os.walk(root):
+        dirs[:] = sorted([d for d in dirs if d.startswith('.') == False and d != '__pycache__' and os.path.join(dirpath, d) not in skipped])
+        files += [os.path.join(dirpath, n) for n in sorted(names) if n.endswith('.pyc') == False]
+    return files
+
+
+class ResultCache:
+    '''Cached results of one plugin's simulation identified by `fingerprint`.'''
+
+    def __init__(self, plugin: str, fingerprint: Fingerprint, root: str=None):
+        self._root = os.path.join(root if root is not None else default_root(), plugin)
+        self._limit = int(Env.read('ORBIT_ENV_RESULT_CACHE_MB', default=str(DEFAULT_LIMIT_MB))) * 1024 * 1024
+        self.key = fingerprint.digest()
+        self._entry = os.path.join(self._root, self.key)
+        self._start = time.time()
+        os.makedirs(self._root, exist_ok=True)
+        pass
+
+
+    def restore(self) -> dict:
+        '''Copies the cached artifacts into the working directory and returns the
+        cached verdict, or `None` if there is no result for this fingerprint.'''
+        with Lock(os.path.join(self._root, '.lock'), shared=True):
+            verdict_file = os.path.join(self._entry, 'verdict.json')
+            if os.path.exists(verdict_file) == False:
+                return None
+            with open(verdict_file, 'r') as f:
+                verdict = json.load(f)
+            artifacts = os.path.join(self._entry, 'artifacts')
+            for name in verdict.get('artifacts', []):
+                os.makedirs(os.path.dirname(os.path.abspath(name)), exist_ok=True)
+                shutil.copy2(os.path.join(artifacts, name), name)
+            # mark the entry as recently used
+            os.utime(self._entry)
+        print('info: Reusing cached simulation result', self.key[:12], "(use '--force' to run again)")
+        return verdict
+
+
+    def store(self, verdict: dict, artifacts: List[str]=[]):
+        '''Saves the `verdict` and the existing files among `artifacts`, given
+        relative to the working directory.'''
+        verdict = dict(verdict)
+        verdict['seconds'] = round(time.time() - self._start, 3)
+        verdict['artifacts'] = [a for a in artifacts if os.path.isfile(a) == True and os.path.isabs(a) == False and a.startswith('..') == False]
+        tmp = os.path.join(self._root, '.tmp-'+uuid.uuid4().hex)
+        try:
+            for name in verdict['artifacts']:
+                dest = os.path.join(tmp, 'artifacts', name)
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                shutil.copy2(name, dest)
+            os.makedirs(tmp, exist_ok=True)
+            with open(os.path.join(tmp, 'verdict.json'), 'w') as f:
+                json.dump(verdict, f, indent=2)
+            with Lock(os.path.join(self._root, '.lock')):
+                # the newest result replaces an older one (such as with '--force')
+                if os.path.exists(self._entry) == True:
+                    shutil.rmtree(self._entry)
+                os.rename(tmp, self._entry)
+                self._evict()
+        except OSError as e:
+            print('warning: Failed to cache simulation result:', str(e))
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+        pass
+
+
+    def _evict(self):
+        '''Removes the least recently used entries until the cache fits its limit.
+
+        Assumes the exclusive lock is already held.'''
+        names = [n for n in os.listdir(self._root) if n.startswith('.') == False]
+        evict([os.path.join(self._root, n) for n in names if os.path.isdir(os.path.join(self._root, n)) == True], self._limit)
+        pass
+    pass
+
+
+def replay(verdict: dict) -> int:
+    '''Prints the summary of a cached `verdict` and returns its exit code.'''
+    print('info: Simulation '+str(verdict.get('reason'))+' (cached from a run of '+str(verdict.get('seconds'))+'s)')
+    counts = verdict.get('counts')
+    if counts is not None:
+        print('info: Assertions:', ', '.join([str(n)+' '+s+('s' if n != 1 else '') for (s, n) in counts.items()]))
+    for (name, score) in verdict.get('scores', {}).items():
+        print('info: '+name+' score:', score)
+    return verdict.get('returncode', 0)
@@ -8,6 +8,16 @@
 #   
 #   Referenced from:
 #       https://grittyengineer.com/vivado-non-project-mode-releasing-vivados-true-potential/
+#
+#   The outputs of each stage are saved in the artifact cache (artifacts.py),
+#   keyed on the Vivado version, part, generics, source files' contents, and
+#   the stages run so far. Only the stages after the last cached one run,
+#   starting from its checkpoint. Use '--force' to run every stage.
+#
+#   The time, CPU time, and peak memory of each stage are saved as the build's
+#   telemetry (see Telemetry in mod.py), and the timing and utilization in the
+#   reports of each stage are saved in the history of build metrics (see
+#   metrics.py).
 # ------------------------------------------------------------------------------
 
 # try to disable webtalk (may have no affect if using WEBPACK license)
@@ -28,6 +38,28 @@ set OFF 0
 set ERR_CODE 1
 set OK_CODE  0
 
+# the python interpreter that runs the modules below
+set PYTHON "python3"
+if { [info exists env(ORBIT_ENV_PYTHON)] && $env(ORBIT_ENV_PYTHON) != "" } {
+    set PYTHON $env(ORBIT_ENV_PYTHON)
+}
+# the python modules next to this script
+set PLUGIN_DIR [file dirname [file normalize [info script]]]
+# the artifact cache's command-line interface
+set ARTIFACTS [file join $PLUGIN_DIR "artifacts.py"]
+# the host's job server, which grants vivado up to its limit of 8 threads
+set JOBS [file join $PLUGIN_DIR "mod.py"]
+# the history of timing, utilization, and runtime of each build
+set METRICS [file join $PLUGIN_DIR "metrics.py"]
+set MAX_THREADS 8
+# stages recorded for the build's telemetry (none when it is turned off)
+set TELEMETRY "telemetry.jsonl"
+if { [info exists env(ORBIT_ENV_TELEMETRY)] && $env(ORBIT_ENV_TELEMETRY) == "off" } {
+    set TELEMETRY ""
+}
+# name, start time, and cpu seconds of the current stage
+set STAGE {}
+
 # --- Procedures ---------------------------------------------------------------
 # ------------------------------------------------------------------------------
 
@@ -50,6 +82,140 @@ proc program_device { bit_file } {
     refresh_hw_device $device 
 }
 
+# computes the artifact cache key of a stage's inputs (values or @files)
+proc artifact_key { args } {
+    if { [catch {exec $::PYTHON $::ARTIFACTS key -- {*}$args} key] != 0 } {
+        puts "WARNING: Artifact cache is unavailable: $key"
+        return ""
+    }
+    return $key
+}
+
+# restores the outputs saved under `key` into the current directory
+proc artifact_fetch { key } {
+    if { $key == "" || [catch {exec $::PYTHON $::ARTIFACTS fetch $key} out] != 0 } {
+        return 0
+    }
+    puts $out
+    return 1
+}
+
+# saves the existing `files` of the current directory under `key`
+proc artifact_store { key files } {
+    if { $key == "" } {
+        return
+    }
+    if { [catch {exec $::PYTHON $::ARTIFACTS store $key {*}$files} out] != 0 } {
+        puts "WARNING: Failed to cache artifacts: $out"
+    } elseif { $out != "" } {
+        puts $out
+    }
+}
+
+# holds cores (and memory) from the host's job server until vivado exits, and
+# returns how many threads vivado may use
+proc hold_job_tokens {} {
+    if { [catch {open |[list $::PYTHON $::JOBS hold vivado [pid] --threads $::MAX_THREADS] r} holder] != 0 } {
+        puts "WARNING: Job server is unavailable: $holder"
+        return $::MAX_THREADS
+    }
+    set threads $::MAX_THREADS
+    while { [gets $holder line] >= 0 } {
+        if { [string is integer -strict $line] } {
+            set threads $line
+            break
+        }
+        puts $line
+    }
+    # a nonblocking channel lets vivado exit without waiting on the holder
+    fconfigure $holder -blocking 0
+    return $threads
+}
+
+# returns the cpu seconds and peak memory (MB) of vivado so far, or zeros where
+# /proc is not available
+proc process_usage {} {
+    set cpu 0.0
+    set peak 0.0
+    catch {
+        set f [open "/proc/[pid]/stat" r]
+        set stat [read $f]
+        close $f
+        # utime, stime, cutime, and cstime follow the command name, in clock
+        # ticks of (nearly always) 1/100 s
+        set fields [split [string range $stat [expr {[string last ")" $stat] + 2}] end] " "]
+        set cpu [expr {([lindex $fields 11] + [lindex $fields 12] + [lindex $fields 13] + [lindex $fields 14]) / 100.0}]
+    }
+    catch {
+        set f [open "/proc/[pid]/status" r]
+        foreach line [split [read $f] "\n"] {
+            if { [string match "VmHWM:*" $line] } {
+                set peak [expr {[lindex $line 1] / 1024.0}]
+            }
+        }
+        close $f
+    }
+    return [list $cpu $peak]
+}
+
+# ends the current stage of the telemetry and starts the stage `name` (if any)
+proc telemetry_stage { name } {
+    if { $::TELEMETRY == "" } {
+        return
+    }
+    if { $::STAGE != {} } {
+        lassign $::STAGE prev start cpu
+        lassign [process_usage] now peak
+        set f [open $::TELEMETRY a]
+        puts $f [format {{"name": "%s", "start": %.6f, "end": %.6f, "cpu": %.3f, "peak_mb": %.1f}} $prev $start [expr {[clock microseconds] / 1e6}] [expr {$now - $cpu}] $peak]
+        close $f
+    }
+    set ::STAGE {}
+    if { $name != "" } {
+        # reset the peak memory so it is measured per stage
+        catch {
+            set f [open "/proc/[pid]/clear_refs" w]
+            puts $f 5
+            close $f
+        }
+        set ::STAGE [list $name [expr {[clock microseconds] / 1e6}] [lindex [process_usage] 0]]
+    }
+}
+
+# saves the stages recorded so far as the build's telemetry
+proc telemetry_save {} {
+    telemetry_stage ""
+    if { $::TELEMETRY == "" || [file exists $::TELEMETRY] == 0 } {
+        return
+    }
+    if { [catch {exec $::PYTHON $::JOBS trace viv-no-xpr $::TELEMETRY} out] != 0 } {
+        puts "WARNING: Failed to save telemetry: $out"
+    } else {
+        puts $out
+    }
+}
+
+# saves the timing and utilization in the reports of the stages up to `flow`
+# (and the runtime of those that ran) in the history of build metrics
+proc metrics_save { flow } {
+    set reports [list "synth=post_synth_timing_summary.rpt" "synth=post_synth_util.rpt"]
+    if { $flow >= $::IMPL_FLOW } {
+        lappend reports "impl=post_place_timing_summary.rpt" "impl=post_place_util.rpt"
+    }
+    if { $flow >= $::ROUTE_FLOW } {
+        lappend reports "route=post_route_timing_summary.rpt"
+    }
+    set stages {}
+    if { $::TELEMETRY != "" && [file exists $::TELEMETRY] } {
+        set stages [list --telemetry $::TELEMETRY]
+    }
+    if { [catch {exec $::PYTHON $::METRICS record viv-no-xpr {*}$reports --part $::PART {*}$stages} out] != 0 } {
+        puts "WARNING: Failed to save build metrics: $out"
+    } elseif { $out != "" } {
+        puts $out
+    }
+}
+
 # --- Handle command-line inputs -----------------------------------------------
 # ------------------------------------------------------------------------------
 
@@ -61,6 +227,8 @@ set FLOW $DEFAULT_FLOW
 set CLEAN $OFF
 # flag to program a connected device with a bitfile
 set PROGRAM_BOARD $OFF
+# flag to run every stage even if its outputs are cached
+set FORCE $OFF
 # list of top-level generics to override during synthesis
 set generics {}
 
@@ -89,6 +257,9 @@ for {set i 0 } { $i < $argc } { incr i } {
         "--pgm" {
             set PROGRAM_BOARD $ON
         }
+        "--force" {
+            set FORCE $ON
+        }
         default {
             # check for optional values 
             switch $prev_arg {
@@ -163,9 +334,18 @@ if { $FLOW == $DEFAULT_FLOW && $PROGRAM_BOARD == $ON } {
     exit $OK_CODE
 }
 
+# record the time of each stage
+if { $TELEMETRY != "" } {
+    file delete $TELEMETRY
+}
+telemetry_stage "setup"
+
 # --- Process data in blueprint ------------------------------------------------
 # ------------------------------------------------------------------------------
 
+# the inputs that decide the outputs of synthesis (without absolute paths)
+set synth_inputs [list "vivado" [version -short] $PART {*}$generics]
+
 foreach rule [split $blueprint_data "\n"] {
     # break rule into the 3 main components
     lassign [split $rule "\t"] fileset library path
@@ -174,31 +354,75 @@ foreach rule [split $blueprint_data "\n"] {
         # synthesizable vhdl files
         "VHDL-RTL" {
             read_vhdl -library $library $path
+            lappend synth_inputs $fileset $library "@$path"
         }
         # synthesizable verilog files
         "VLOG-RTL" {
             read_verilog -library $library $path
+            lappend synth_inputs $fileset $library "@$path"
         }
         # Xilinx design constraints
         "XIL-XDC" {
             read_xdc $path
+            lappend synth_inputs $fileset "@$path"
         }
     }
 }
 
+# --- Restore cached stages ----------------------------------------------------
+# ------------------------------------------------------------------------------
+
+# synthesis always runs when no later stage is requested
+set LAST_FLOW [expr { $FLOW > $SYNTH_FLOW ? $FLOW : $SYNTH_FLOW }]
+# checkpoint to continue from after each stage
+set CHECKPOINTS [dict create $SYNTH_FLOW "post_synth.dcp" $IMPL_FLOW "post_place.dcp" $ROUTE_FLOW "post_route.dcp"]
+
+# each stage's key follows from the key of the stage before it
+set keys [dict create]
+set key [artifact_key {*}$synth_inputs]
+for { set stage $SYNTH_FLOW } { $stage <= $LAST_FLOW } { incr stage } {
+    if { $key != "" } {
+        set key [artifact_key $key $stage]
+    }
+    dict set keys $stage $key
+}
+
+# restore the outputs of the last stage that is cached
+set RESTORED $DEFAULT_FLOW
+if { $FORCE == $OFF } {
+    telemetry_stage "artifacts"
+    for { set stage $LAST_FLOW } { $stage >= $SYNTH_FLOW } { incr stage -1 } {
+        if { [artifact_fetch [dict get $keys $stage]] == 1 } {
+            set RESTORED $stage
+            break
+        }
+    }
+}
+if { $RESTORED != $DEFAULT_FLOW && $RESTORED < $LAST_FLOW } {
+    open_checkpoint [dict get $CHECKPOINTS $RESTORED]
+}
+
 # --- Execute toolchain --------------------------------------------------------
 # ------------------------------------------------------------------------------
 
+# only run stages with the cores granted by the job server
+if { $RESTORED < $LAST_FLOW } {
+    set_param general.maxThreads [hold_job_tokens]
+}
+
 # 1. run synthesis
-if { $FLOW >= $DEFAULT_FLOW } {
+if { $FLOW >= $DEFAULT_FLOW && $RESTORED < $SYNTH_FLOW } {
+    telemetry_stage "synth"
     synth_design -top $env(ORBIT_TOP) -part $PART {*}$generics
     write_checkpoint -force "post_synth.dcp"
     report_timing_summary -file "post_synth_timing_summary.rpt"
     report_utilization -file "post_synth_util.rpt"
+    artifact_store [dict get $keys $SYNTH_FLOW] {post_synth.dcp post_synth_timing_summary.rpt post_synth_util.rpt}
 }
 
 # 2. run implementation
-if { $FLOW >= $IMPL_FLOW } {
+if { $FLOW >= $IMPL_FLOW && $RESTORED < $IMPL_FLOW } {
+    telemetry_stage "impl"
     opt_design
     place_design
     report_clock_utilization -file "clock_util.rpt"
@@ -210,27 +434,37 @@ if { $FLOW >= $IMPL_FLOW } {
     write_checkpoint -force "post_place.dcp"
     report_utilization -file "post_place_util.rpt"
     report_timing_summary -file "post_place_timing_summary.rpt"
+    artifact_store [dict get $keys $IMPL_FLOW] {post_place.dcp clock_util.rpt post_place_util.rpt post_place_timing_summary.rpt}
 }
 
 # 3. route design
-if { $FLOW >= $ROUTE_FLOW } {
+if { $FLOW >= $ROUTE_FLOW && $RESTORED < $ROUTE_FLOW } {
+    telemetry_stage "route"
     route_design -directive Explore
     write_checkpoint -force "post_route.dcp"
     report_route_status -file "post_route_status.rpt"
     report_timing_summary -file "post_route_timing_summary.rpt"
     report_power -file "post_route_power.rpt"
     report_drc -file "post_imp_drc.rpt"
+    artifact_store [dict get $keys $ROUTE_FLOW] {post_route.dcp post_route_status.rpt post_route_timing_summary.rpt post_route_power.rpt post_imp_drc.rpt}
 }
 
 # 4. generate bitstream
 if { $FLOW >= $BIT_FLOW } {
-    write_verilog -force "cpu_impl_netlist_$env(ORBIT_TOP).v" -mode timesim -sdf_anno true
-    write_bitstream -force $BIT_FILE
+    if { $RESTORED < $BIT_FLOW } {
+        telemetry_stage "bit"
+        write_verilog -force "cpu_impl_netlist_$env(ORBIT_TOP).v" -mode timesim -sdf_anno true
+        write_bitstream -force $BIT_FILE
+        artifact_store [dict get $keys $BIT_FLOW] [list "cpu_impl_netlist_$env(ORBIT_TOP).v" $BIT_FILE]
+    }
 
     # 4a. program to the connected device
     if { $PROGRAM_BOARD == $ON } {
+        telemetry_stage "program"
         program_device $BIT_FILE
     }
 }
 
+telemetry_save
+metrics_save $LAST_FLOW
 exit 0
\ No newline at end of file
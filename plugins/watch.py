@@ -0,0 +1,278 @@
+# Project: orbit-profile
+# Module: watch.py
+#
+# Rebuilds and reruns a simulation every time its sources change.
+#
+# The blueprint's source files and Python model are watched with inotify on
+# Linux, or by polling their modification times elsewhere. A file only counts
+# as changed when its contents differ, so saving without editing does nothing.
+# After a change, only the changed files and the files that depend on them
+# are analyzed again, in compile order. A file depends on another when it
+# names one of the other file's primary units (entity, package, configuration,
+# context), which may analyze a few extra files but never misses one.
+#
+# The simulation then runs as a separate invocation of the plugin that skips
+# compiling, and skips the model unless the model changed. A newer edit
+# cancels a run that is still in progress.
+
+import os, re, time, select, struct
+from typing import Callable, Dict, List, Set
+
+from mod import Env, Command, Status, Hdl, Fingerprint
+
+# seconds between checks of the files' modification times without inotify
+POLL_INTERVAL = 0.25
+
+# seconds to wait for more changes after the first one (an editor may write
+# several files at once)
+SETTLE = 0.05
+
+# inotify events for a file written and closed, or moved into place
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# primary units a VHDL file can define
+UNIT = re.compile(r'\b(?:entity|package|configuration|context)\s+(\w+)\s+is\b')
+WORD = re.compile(r'[a-z_][a-z0-9_]*')
+COMMENT = re.compile(r'--[^\n]*')
+
+
+def _inotify():
+    '''Returns the inotify file descriptor and the function to add a watch,
+    or `None` where inotify is not available.'''
+    try:
+        import ctypes, ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            return None
+        return (fd, libc.inotify_add_watch)
+    except (OSError, AttributeError):
+        return None
+
+
+class Watcher:
+    '''Reports which of the files at `paths` change.'''
+
+    def __init__(self, paths: List[str]):
+        self._paths = set([os.path.abspath(p) for p in paths])
+        self._digests: Dict[str, str] = dict([(p, self._digest(p)) for p in self._paths])
+        self._stats = dict([(p, self._stat(p)) for p in self._paths])
+        self._fd = None
+        self._dirs = {}
+        watcher = _inotify()
+        if watcher is not None:
+            (self._fd, add_watch) = watcher
+            # editors often replace a file rather than write it, so the
+            # directories are watched instead of the files
+            for d in set([os.path.dirname(p) for p in self._paths]):
+                wd = add_watch(self._fd, os.fsencode(d), IN_CLOSE_WRITE | IN_MOVED_TO)
+                if wd >= 0:
+                    self._dirs[wd] = d
+        pass
+
+
+    @staticmethod
+    def _digest(path: str) -> str:
+        try:
+            return Fingerprint().add_file(path).digest()
+        except OSError:
+            return None
+
+
+    @staticmethod
+    def _stat(path: str):
+        try:
+            s = os.stat(path)
+            return (s.st_mtime_ns, s.st_size)
+        except OSError:
+            return None
+
+
+    def method(self) -> str:
+        return 'inotify' if self._fd is not None else 'polling'
+
+
+    def _events(self, timeout: float) -> Set[str]:
+        '''Waits up to `timeout` seconds for files that may have changed.'''
+        if self._fd is None:
+            time.sleep(min(timeout, POLL_INTERVAL) if timeout is not None else POLL_INTERVAL)
+            touched = set()
+            for p in self._paths:
+                stat = self._stat(p)
+                if stat != self._stats[p]:
+                    self._stats[p] = stat
+                    touched.add(p)
+            return touched
+        (ready, _, _) = select.select([self._fd], [], [], timeout)
+        if len(ready) == 0:
+            return set()
+        touched = set()
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return touched
+        offset = 0
+        while offset + 16 <= len(data):
+            (wd, mask, _, length) = struct.unpack_from('iIII', data, offset)
+            name = os.fsdecode(data[offset+16:offset+16+length].rstrip(b'\0'))
+            offset += 16 + length
+            if mask & IN_Q_OVERFLOW != 0:
+                return set(self._paths)
+            path = os.path.join(self._dirs.get(wd, ''), name)
+            if path in self._paths:
+                touched.add(path)
+        return touched
+
+
+    def wait(self, timeout: float=None) -> Set[str]:
+        '''Returns the files whose contents changed, waiting up to `timeout`
+        seconds (or forever) for the first change.'''
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            left = max(0.0, deadline - time.monotonic()) if deadline is not None else None
+            touched = self._events(left)
+            if len(touched) > 0:
+                # gather the rest of a burst of writes
+                while True:
+                    more = self._events(SETTLE)
+                    if len(more) == 0:
+                        break
+                    touched |= more
+            changed = set()
+            for p in touched:
+                digest = self._digest(p)
+                if digest != self._digests[p]:
+                    self._digests[p] = digest
+                    changed.add(p)
+            if len(changed) > 0 or (deadline is not None and time.monotonic() >= deadline):
+                return changed
+        pass
+
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        pass
+    pass
+
+
+class Index:
+    '''The primary units each source file defines and the names it uses.'''
+
+    def __init__(self, order: List[Hdl]):
+        self._order = order
+        self._units: Dict[str, Set[str]] = {}
+        self._words: Dict[str, Set[str]] = {}
+        for item in order:
+            self.update(item.path)
+        pass
+
+
+    def update(self, path: str):
+        '''Reads the file at `path` again.'''
+        try:
+            with open(path, 'r', errors='replace') as f:
+                text = COMMENT.sub('', f.read().lower())
+        except OSError:
+            text = ''
+        self._units[path] = set(UNIT.findall(text))
+        self._words[path] = set(WORD.findall(text))
+        pass
+
+
+    def affected(self, dirty: Set[str]) -> List[Hdl]:
+        '''Lists the files in `dirty` and every file that depends on them, in
+        compile order.'''
+        dirty = set(dirty)
+        units = set()
+        for item in self._order:
+            if item.path in dirty or len(units & self._words[item.path]) > 0:
+                dirty.add(item.path)
+                units |= self._units[item.path]
+        return [item for item in self._order if item.path in dirty]
+    pass
+
+
+class Watch:
+    '''Analyzes the files in compile `order` and reruns the simulation as
+    they or the Python model change.'''
+
+    def __init__(self, order: List[Hdl], py_model: str=None):
+        self._order = [Hdl(item.lib, os.path.abspath(item.path)) for item in order]
+        self._model = os.path.abspath(py_model) if py_model is not None else None
+        self._index = Index(self._order)
+        paths = [item.path for item in self._order] + ([self._model] if self._model is not None else [])
+        self._watcher = Watcher(paths)
+        pass
+
+
+    def _analyze(self, dirty: Set[str], analyze: Callable[[Hdl], Status]) -> Set[str]:
+        '''Analyzes the files affected by `dirty` and returns those that still
+        need to be analyzed.'''
+        pending = self._index.affected(dirty)
+        if len(pending) == 0:
+            return set()
+        print('info: Analyzing', len(pending), 'of', len(self._order), 'files ...')
+        for i in range(len(pending)):
+            print('  -', Env.quote_str(pending[i].path))
+            if analyze(pending[i]) != Status.OKAY:
+                print('error: Analysis failed; waiting for the next change ...')
+                return set([item.path for item in pending[i:]])
+        return set()
+
+
+    def loop(self, analyze: Callable[[Hdl], Status], rerun: Callable[[bool], Command]=None, cwd: str=None):
+        '''Watches the files until interrupted.
+
+        `analyze` analyzes one file. `rerun` returns the command that simulates
+        the design, given whether the model must run again, which then runs in
+        `cwd`. Without `rerun`, the files are only analyzed.'''
+        print('info: Watching', len(self._order) + (1 if self._model is not None else 0), 'files for changes with', self._watcher.method(), '(press Ctrl+C to stop) ...')
+        # the first pass analyzes every file
+        dirty = set([item.path for item in self._order])
+        model_stale = True
+        changed_at = time.monotonic()
+        proc = None
+        try:
+            while True:
+                dirty = self._analyze(dirty, analyze)
+                changes = set()
+                if len(dirty) == 0 and rerun is None:
+                    print('info: Static analysis complete')
+                elif len(dirty) == 0:
+                    proc = rerun(model_stale).start(group=True, cwd=cwd)
+                    # a newer edit cancels the run
+                    while proc.poll() is None and len(changes) == 0:
+                        changes = self._watcher.wait(0.1)
+                    if proc.poll() is None:
+                        print('info: Cancelling the run for a newer change ...')
+                        Command.stop(proc)
+                    else:
+                        model_stale = False
+                        verdict = 'PASS' if proc.returncode == 0 else 'FAIL (exit code '+str(proc.returncode)+')'
+                        print('info:', verdict, round(time.monotonic() - changed_at, 2), 'seconds after the change')
+                    proc = None
+                if len(changes) == 0:
+                    changes = self._watcher.wait()
+                changed_at = time.monotonic()
+                for path in sorted(changes):
+                    print('info: Changed', Env.quote_str(path))
+                    if path == self._model:
+                        model_stale = True
+                    else:
+                        self._index.update(path)
+                        dirty.add(path)
+                pass
+        except KeyboardInterrupt:
+            if proc is not None:
+                Command.stop(proc)
+            print('info: Stopped watching')
+        finally:
+            self._watcher.close()
+        pass
+    pass
@@ -19,9 +19,20 @@
 #
 #   'review'- View the waveform. This will only open the waveform in the gui for inspection.
 #
-import os,sys, getopt
+# Profiling:
+#   '--profile' elaborates the snapshot with xsim's profiler and ranks the design units
+#   by their share of the simulation time after a 'cl' run (see hotspot.py).
+#
+# Isolation:
+#   '--isolate' simulates in a new directory of its own under 'xsim/', over the
+#   compiled libraries and snapshots shared by every run of the IP (see layer.py).
+#
+import os,sys, getopt, shutil
 from typing import List
 
+from mod import Command, Status, Fingerprint, JobServer, Telemetry
+import monitor, checker, layer
+
 # --- constants ----------------------------------------------------------------
 
 # define python path
@@ -34,6 +45,9 @@ if(VIVADO_PATH != None and os.path.exists(VIVADO_PATH) and VIVADO_PATH not in os
 
 XSIM_DIR = 'xsim'
 
+# runs the python model and remembers its outputs
+MODEL_RUNNER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'model.py')
+
 # --- classes and functions ----------------------------------------------------
 
 class Generic:
@@ -69,21 +83,17 @@ def invoke(command: str, args: List[str], verbose: bool=False, exit_on_err: bool
 
     Prints the command if `verbose` is `True`.
     '''
-    code_line = command + ' '
-    for c in args:
-        code_line = code_line + quote_str(c) + ' '
-    rc = os.system(code_line)
-    if verbose == True:
-        print(code_line)
+    # run through Command so the tool is recorded by the build's telemetry
+    status = Command(command).args(args).spawn(verbose=verbose)
     # immediately stop script upon a bad return code
-    if(rc != 0 and exit_on_err == True):
-        exit('ERROR: plugin exited with error code: '+str(rc))
+    if(status != Status.OKAY and exit_on_err == True):
+        exit('ERROR: plugin exited with error code: '+str(status.value))
 
 
 # --- Handle command-line arguments --------------------------------------------
 
 try: 
-    opts, args = getopt.getopt(sys.argv[1:], "g:ces:", ["flow=", "generic=", "compile", "elaborate", "simulate=", "script"], )
+    opts, args = getopt.getopt(sys.argv[1:], "g:ces:", ["flow=", "generic=", "compile", "elaborate", "simulate=", "script", "fail-fast", "max-errors=", "timeout=", "stop-time=", "seed=", "force", "run-dir=", "isolate", "profile", "compare=", "columns=", "radix=", "tolerance=", "mask=", "mismatches="], )
 except getopt.GetoptError:
     print("error: getopt threw error trying to parse command-line arguments\n")
     exit(2)
@@ -101,6 +111,31 @@ script_only = False
 
 sim_mode = CL
 
+# limits for stopping the simulation early
+fail_fast = False
+max_errors = None
+timeout = None
+stop_time = None
+
+# seed forwarded to the python model
+seed = None
+# run the simulation even if its result is cached
+force = False
+# simulate in this directory instead of the compilation directory
+run_dir = None
+# simulate in a new directory of its own
+isolate = False
+# rank the design units by their share of the simulation time
+profile = False
+
+# files of output vectors to compare to files of expected vectors
+compare = []
+columns = None
+radixes = []
+tolerances = []
+masks = []
+mismatches = checker.DEFAULT_MISMATCHES
+
 for opt, arg in opts:
     if opt in ('--simulate'):
         sim = True
@@ -121,6 +156,41 @@ for opt, arg in opts:
         elab = True
     elif opt in ('--generic', '-g'):
         generics += [Generic.from_str(arg)]
+    elif opt == '--fail-fast':
+        fail_fast = True
+    elif opt == '--force':
+        force = True
+    elif opt == '--seed':
+        seed = arg
+    elif opt == '--run-dir':
+        run_dir = arg
+    elif opt == '--isolate':
+        isolate = True
+    elif opt == '--profile':
+        profile = True
+    elif opt == '--compare':
+        compare += [arg]
+    elif opt == '--columns':
+        columns = arg.split(',')
+    elif opt == '--radix':
+        radixes += [arg]
+    elif opt == '--tolerance':
+        tolerances += [arg]
+    elif opt == '--mask':
+        masks += [arg]
+    elif opt in ('--max-errors', '--timeout', '--stop-time', '--mismatches'):
+        try:
+            if opt == '--max-errors':
+                max_errors = int(arg)
+            elif opt == '--mismatches':
+                mismatches = int(arg)
+            elif opt == '--timeout':
+                timeout = float(arg)
+            else:
+                stop_time = monitor.parse_time(arg)
+        except ValueError:
+            print('option \''+str(opt)+"\' has invalid value '"+str(arg)+"'")
+            exit(2)
     else:
         print('unknown option \''+str(opt)+'\'')
         exit(2)
@@ -130,6 +200,10 @@ for arg in args:
     print('error: unknown argument \''+str(arg)+'\'')
     exit(2)
 
+if isolate == True and run_dir != None:
+    print('error: option \'--isolate\' cannot be combined with \'--run-dir\'')
+    exit(2)
+
 # verify a toolflow was selected
 if(comp or elab or sim) == False:
     print('info: no toolflow performed\n')
@@ -171,25 +245,123 @@ with open(os.getenv("ORBIT_BLUEPRINT"), 'r') as blueprint:
 os.makedirs(XSIM_DIR, exist_ok=True)
 os.chdir(XSIM_DIR)
 
+# concurrent runs share the compiled libraries and snapshots
+shared = layer.Layer(os.getcwd())
+xsim_dir = os.path.abspath('xsim.dir')
+
+if isolate == True:
+    run_dir = layer.run_dir(XSIM_DIR)
+    print('info: running in isolated directory \''+os.path.abspath(os.path.join(os.environ.get("ORBIT_BUILD_DIR"), run_dir))+'\'')
+
+# share the compiled libraries and snapshots with the run directory
+if run_dir != None:
+    os.makedirs(xsim_dir, exist_ok=True)
+    os.chdir(os.environ.get("ORBIT_BUILD_DIR"))
+    os.makedirs(run_dir, exist_ok=True)
+    os.chdir(run_dir)
+    # compiling and elaborating write through a link to the shared directory
+    # (an earlier simulation here left its own hard links in its place)
+    if os.path.islink('xsim.dir') == False and os.path.isdir('xsim.dir') == True:
+        shutil.rmtree('xsim.dir')
+    if os.path.lexists('xsim.dir') == False:
+        try:
+            os.symlink(xsim_dir, 'xsim.dir', target_is_directory=True)
+        except OSError as e:
+            exit('error: failed to link the compiled libraries into \''+run_dir+'\': '+str(e))
+
+# record the time of each stage and tool (time spent in the GUI is not part of
+# the build)
+if sim == False or sim_mode == CL:
+    Telemetry.begin('xsim')
+
+# reuse the result of an identical earlier simulation
+results = None
+if sim == True and sim_mode == CL and script_only == False and profile == False and BENCH != None and len(BENCH) > 0:
+    out, _ = Command('xsim').arg('-version').output()
+    missing = [path for path in checker.expected(compare) if os.path.isfile(path) == False]
+    if len(missing) > 0:
+        print('info: not caching the result since the expected vectors in \''+missing[0]+'\' do not exist yet')
+    elif py_model != None and seed == None:
+        print('info: not caching the result of a run without a fixed seed')
+    elif len(out.strip()) > 0:
+        from simcache import ResultCache, replay, model_files
+        fp = Fingerprint() \
+            .add('xsim', out.strip(), BENCH, seed, wf_config) \
+            .add(fail_fast, max_errors, stop_time) \
+            .add(compare, columns, radixes, tolerances, masks) \
+            .add(*[g.to_str() for g in generics])
+        # the verdict depends on what the expected vectors hold
+        for path in checker.expected(compare):
+            fp.add_file(path)
+        for (lib, path) in vhdl_sources:
+            fp.add(lib).add_file(path)
+        if py_model != None:
+            for path in model_files(py_model):
+                fp.add(os.path.relpath(path, os.path.dirname(os.path.abspath(py_model)))).add_file(path)
+        results = ResultCache('xsim', fp)
+        verdict = results.restore() if force == False else None
+        if verdict is not None:
+            exit(replay(verdict))
+    pass
+
 # 1. pre-simulation hook: generate test vectors
 if py_model != None:
+    Telemetry.stage('model')
     print("INFO: Running python software model ...")
     # format generics for SW MODEL
     py_generics = []
     for item in generics:
         py_generics += ['-g=' + item.to_str()]
-    invoke(PYTHON_PATH, [py_model] + py_generics)
+    seed_args = ['--seed='+seed] if seed != None else []
+    # run through the model runner to reuse outputs of an identical earlier run
+    force_args = ['--force'] if force == True else []
+    invoke(PYTHON_PATH, [MODEL_RUNNER] + force_args + [py_model] + py_generics + seed_args)
     pass
 
 if script_only == True:
     exit(0)
 
+# restore the libraries and snapshot of an identical earlier build
+snapshots = None
+snapshot_key = None
+if comp == True and elab == True and BENCH != None and len(BENCH) > 0:
+    Telemetry.stage('artifacts')
+    out, _ = Command('xelab').arg('-version').output()
+    if len(out.strip()) > 0:
+        from artifacts import ArtifactCache
+        fp = Fingerprint() \
+            .add('xsim-snapshot', out.strip(), BENCH, profile) \
+            .add(*[g.to_str() for g in generics])
+        for (lib, path) in vhdl_sources:
+            fp.add(lib).add_file(path)
+        snapshots = ArtifactCache()
+        snapshot_key = fp.digest()
+    pass
+
+# update the shared directory only when the snapshot's sources changed, and
+# only once no other run is using it
+SNAPSHOT = 'snapshot-'+str(BENCH)
+if comp == True or elab == True:
+    if shared.update(SNAPSHOT, snapshot_key if force == False else None) == False:
+        print('info: using the snapshot elaborated by an earlier run')
+        comp = False
+        elab = False
+    elif snapshots != None and force == False and snapshots.fetch(snapshot_key, 'xsim.dir') == True:
+        comp = False
+        elab = False
+        shared.commit(SNAPSHOT, snapshot_key)
+else:
+    shared.share()
+
 # compile sources
 if comp == True:
+    Telemetry.stage('compile')
     print('info: compiling VHDL source files...')
-    for (lib, path) in vhdl_sources:
-        invoke('xvhdl', ['--incr', '--work', lib, path], verbose=False)
-        pass
+    # wait for a core from the host's job server
+    with JobServer().acquire('xvhdl'):
+        for (lib, path) in vhdl_sources:
+            invoke('xvhdl', ['--incr', '--work', lib, path], verbose=False)
+            pass
 
 if BENCH == None or len(BENCH) == 0:
     exit('error: no testbench specified to perform commands any further for top-level entity \''+str(TOP)+'\'')
@@ -200,13 +372,26 @@ snapshot = BENCH
 
 # elaborate the testbench
 if elab == True:
+    Telemetry.stage('elaboration')
     print('info: elaborating design for testbench \''+BENCH+'\'')
     # compile all generics
     gen_args = []
     for g in generics:
         gen_args += ['-generic_top', g.to_str()]
     # print(gen_args)
-    invoke('xelab', ['-debug', 'typical', '-top', BENCH, '-snapshot', snapshot] + gen_args)
+    # elaborate with as many threads as the host's job server grants
+    with JobServer().acquire('xelab', os.cpu_count() or 1) as job:
+        mt_args = ['-mt', str(job.threads) if job.threads > 1 else 'off']
+        # a snapshot built with the profiler records where its time goes
+        prof_args = ['--profile'] if profile == True else []
+        invoke('xelab', ['-debug', 'typical', '-top', BENCH, '-snapshot', snapshot] + mt_args + prof_args + gen_args)
+    # share the compiled libraries and snapshot with later builds
+    if snapshots != None:
+        snapshots.store(snapshot_key, ['.'], base='xsim.dir')
+
+# let other runs use what was built
+if comp == True or elab == True:
+    shared.commit(SNAPSHOT, snapshot_key)
 
 # verify a tcl file exists to load from
 # if sim_mode == GUI and tcl_config == None:
@@ -220,7 +405,18 @@ elif(sim_mode == REVIEW):
 
 if(sim_mode == CL):
     log_wave_tcl_cmd = "log_wave -recursive *" if(wf_config == None) else "open_wave_config "+wf_config
-    simple_tcl = log_wave_tcl_cmd+'\nrun all\nexit\n'
+    run_tcl_cmd = 'run all' if stop_time == None else 'run '+monitor.format_time(stop_time)+'\nputs "orbit: stopped at [current_time]"'
+    if profile == True:
+        import hotspot
+        # never read the report of an earlier run
+        if os.path.exists(hotspot.XSIM_REPORT) == True:
+            os.remove(hotspot.XSIM_REPORT)
+        # the time reached gives the simulation's throughput
+        if stop_time == None:
+            run_tcl_cmd += '\nputs "orbit: stopped at [current_time]"'
+        # snapshots elaborated without the profiler have no report to write
+        run_tcl_cmd += '\nif {[catch {report_profile -file '+hotspot.XSIM_REPORT+'} err]} { puts "orbit: no profile: $err" }'
+    simple_tcl = log_wave_tcl_cmd+'\n'+run_tcl_cmd+'\nexit\n'
     with open('batch.tcl', 'w') as cl_tcl:
         cl_tcl.write(simple_tcl)
     run_args = ['--tclbatch', 'batch.tcl']
@@ -238,28 +434,50 @@ if sim_mode == REVIEW and os.path.exists(snapshot+'.wdb') == False:
 
 snapshot_arg = [snapshot] if(sim_mode != REVIEW) else [snapshot+'.wdb']
 
+# the simulation runs on hard links to the snapshot, so the files xsim writes
+# next to it stay in the run directory
+if sim == True and run_dir != None and sim_mode != REVIEW:
+    os.remove('xsim.dir')
+    layer.link_tree(xsim_dir, 'xsim.dir')
+    # the run has its own links to the snapshot, so builds of other snapshots
+    # need not wait for it to finish
+    shared.release()
+
 # run simulation through xilinx xsim (`run_args` must be last)
 if sim == True:
+    Telemetry.stage('simulation')
     xsim_args = snapshot_arg + gui_args + wave_args + log_args + run_args
-    invoke('xsim', xsim_args)
 
     if sim_mode == CL:
-        # open log to verify simulation passed
-        errors = 0
-        failures = 0
-        with open(LOG_FILE, 'r') as log:
-            for line in log.readlines():
-                # skip comments
-                if line.startswith('#'):
-                    continue
-                # count errors and failures
-                line = line.lower()
-                if line.startswith('error: '):
-                    errors += 1
-                elif line.startswith('failure: '):
-                    failures += 1
-            pass
-
+        # watch the simulation output as it runs to verify it passed
+        watcher = monitor.Monitor('xsim', fail_fast, max_errors, timeout, stop_time)
+        with JobServer().acquire('xsim'):
+            proc = Command('xsim').args(xsim_args).start(group=True, capture=True)
+            status = watcher.watch(proc)
+        shared.release()
+        watcher.report()
+
+        if profile == True:
+            Telemetry.stage('profile')
+            hotspot.Profile('xsim', 'profiler report') \
+                .add(hotspot.read_table(hotspot.XSIM_REPORT)) \
+                .measure(proc, watcher.now) \
+                .report()
+
+        errors = watcher.counts['error']
+        failures = watcher.counts['failure']
+        rc = 1 if(errors > 0 or failures > 0) else status.value
+        # compare the output vectors to the expected vectors
+        if rc == 0 and len(compare) > 0:
+            Telemetry.stage('check')
+            if checker.Checker(columns, radixes, tolerances, masks, mismatches).run(compare) == False:
+                rc = Status.FAIL.value
+        if results != None and watcher.timed_out == False:
+            results.store({'returncode': rc, 'reason': watcher.reason, 'counts': watcher.counts}, [LOG_FILE, snapshot+'.wdb'])
         # verify the simulation passed with no problems
         if(errors > 0 or failures > 0):
-            exit('error: simulation reported '+str(errors)+' errors and '+str(failures)+' failures')
\ No newline at end of file
+            exit('error: simulation reported '+str(errors)+' errors and '+str(failures)+' failures')
+        if rc != 0:
+            exit(rc)
+    else:
+        invoke('xsim', xsim_args)
\ No newline at end of file
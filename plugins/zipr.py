@@ -14,7 +14,6 @@
 import argparse, os
 from typing import List
 from glob import glob
-from zipfile import ZipFile
 
 # --- classes and functions ----------------------------------------------------
 # ------------------------------------------------------------------------------
@@ -176,6 +175,8 @@ if len(found_files) < total_count and args.force == False:
 # write the zip file
 OUTPUT_FILE = args.output+'.zip'
 
+from zipfile import ZipFile
+
 with ZipFile(OUTPUT_FILE, 'w') as zip:
     for f in found_files:
         # determine archive name
@@ -0,0 +1,99 @@
+# Project: orbit-profile
+# Module: batch.py
+#
+# Fetches many package sources concurrently with a bounded pool of workers.
+#
+# A manifest lists one source per line in the same format the protocol accepts
+# on its command-line. Lines beginning with semicolons ';' and empty lines are
+# ignored. A failed source is reported at the end and does not stop the others.
+
+import os, time, threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Callable
+
+# default number of sources to fetch at once
+DEFAULT_JOBS = min(8, (os.cpu_count() or 1) * 2)
+
+
+def read_manifest(path: str) -> List[str]:
+    '''Loads the unique sources listed in the manifest at `path`, in order.'''
+    result = []
+    with open(path, 'r') as manifest:
+        for line in manifest.readlines():
+            line = line.strip()
+            # skip blank and commented lines
+            if len(line) == 0 or line.startswith(';') == True:
+                continue
+            if line not in result:
+                result += [line]
+            pass
+    return result
+
+
+class Progress:
+    '''Tracks aggregate progress and throughput across concurrent fetches.'''
+
+    def __init__(self, total: int):
+        self._total = total
+        self._done = 0
+        self._bytes = 0
+        self._failures = []
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+        pass
+
+
+    def advance(self, nbytes: int):
+        '''Records `nbytes` more bytes were transferred.'''
+        with self._lock:
+            self._bytes += nbytes
+        pass
+
+
+    def _rate(self) -> str:
+        elapsed = max(time.perf_counter() - self._start, 1e-6)
+        return '{:.2f} MB/s'.format(self._bytes / elapsed / 1e6)
+
+
+    def finish(self, source: str, error: str=None):
+        '''Records that `source` completed, failing with `error` if given.'''
+        with self._lock:
+            self._done += 1
+            status = 'fetched'
+            if error is not None:
+                self._failures += [(source, error)]
+                status = 'failed'
+            print('info: ['+str(self._done)+'/'+str(self._total)+'] '+status, source, '('+'{:.2f}'.format(self._bytes / 1e6)+' MB total, '+self._rate()+')')
+        pass
+
+
+    def report(self) -> int:
+        '''Prints a summary of the batch and returns the number of failures.'''
+        elapsed = time.perf_counter() - self._start
+        print('info: Fetched '+str(self._total - len(self._failures))+'/'+str(self._total)+' sources in '+'{:.2f}'.format(elapsed)+'s ('+'{:.2f}'.format(self._bytes / 1e6)+' MB, '+self._rate()+')')
+        for (source, error) in self._failures:
+            print('error: Failed to fetch', source+':', error)
+        return len(self._failures)
+    pass
+
+
+def fetch_all(sources: List[str], fetch: Callable, jobs: int=DEFAULT_JOBS) -> int:
+    '''Calls `fetch(source, progress)` for each source with at most `jobs` running
+    at once.
+
+    Returns the number of sources that failed.'''
+    progress = Progress(len(sources))
+
+    def work(source: str):
+        try:
+            fetch(source, progress)
+        except Exception as e:
+            progress.finish(source, str(e) if len(str(e)) > 0 else type(e).__name__)
+        else:
+            progress.finish(source)
+        pass
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        for _ in pool.map(work, sources):
+            pass
+    return progress.report()
@@ -0,0 +1,189 @@
+# Project: orbit-profile
+# Module: cache.py
+#
+# A content-addressed download cache shared by the protocols on this host.
+#
+# Entries are keyed on a digest of what uniquely identifies a download (such as
+# a URL and its ETag, or a repository and a commit). Entries are written to a
+# temporary name and renamed into place, and all access is guarded by a file
+# lock so concurrent jobs can safely share the cache. When the cache grows past
+# its size limit, the least recently used entries are evicted.
+
+import os, sys, stat, shutil, hashlib, uuid
+from typing import Optional
+
+# the caches of the protocols and plugins share their helpers
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'plugins'))
+from mod import Lock, cache_home, evict
+
+# parent directory for all data the protocols keep on this host
+CACHE_HOME = cache_home()
+
+# location of the cache if not set by the environment
+DEFAULT_ROOT = os.path.join(CACHE_HOME, 'protocols')
+
+# size limit of the cache in megabytes if not set by the environment
+DEFAULT_LIMIT_MB = 4096
+
+
+def link_or_copy(src: str, dst: str):
+    '''Places the file `src` at `dst` with a hard link, or a copy if linking fails.'''
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+    pass
+
+
+def copy_writable(src: str, dst: str):
+    '''Places a copy of the file `src` at `dst` that the owner can write to.'''
+    shutil.copy2(src, dst)
+    os.chmod(dst, os.stat(dst).st_mode | stat.S_IWUSR)
+    pass
+
+
+def link_tree(src: str, dst: str, place=link_or_copy):
+    '''Recreates the directory `src` at `dst` using hard links for its files
+    (or whatever else `place` puts at the destination).'''
+    for root, dirs, files in os.walk(src):
+        rel = os.path.relpath(root, src)
+        target = os.path.normpath(os.path.join(dst, rel))
+        os.makedirs(target, exist_ok=True)
+        for name in dirs + files:
+            path = os.path.join(root, name)
+            if os.path.islink(path) == True:
+                os.symlink(os.readlink(path), os.path.join(target, name))
+            elif name in files:
+                place(path, os.path.join(target, name))
+            pass
+        # do not descend into symbolic links to directories
+        dirs[:] = [d for d in dirs if os.path.islink(os.path.join(root, d)) == False]
+        pass
+    pass
+
+
+def _make_read_only(path: str):
+    '''Removes write permissions so linked copies cannot modify cached data.'''
+    paths = [path]
+    if os.path.isdir(path) == True:
+        for root, _, files in os.walk(path):
+            paths += [os.path.join(root, f) for f in files]
+    for p in paths:
+        if os.path.islink(p) == False and os.path.isfile(p) == True:
+            mode = os.stat(p).st_mode
+            os.chmod(p, mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+    pass
+
+
+def _remove(path: str):
+    if os.path.isdir(path) == True and os.path.islink(path) == False:
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.lexists(path) == True:
+        os.remove(path)
+    pass
+
+
+class Cache:
+    '''A size-bounded, least recently used cache of files and directories.'''
+
+    def __init__(self, root: str=None, limit: int=None):
+        if root is None:
+            root = os.getenv('ORBIT_ENV_PROTOCOL_CACHE_DIR', DEFAULT_ROOT)
+        if limit is None:
+            limit = int(os.getenv('ORBIT_ENV_PROTOCOL_CACHE_MB', DEFAULT_LIMIT_MB)) * 1024 * 1024
+        self._root = root
+        self._limit = limit
+        os.makedirs(os.path.join(self._root, 'objects'), exist_ok=True)
+        os.makedirs(os.path.join(self._root, 'tmp'), exist_ok=True)
+        pass
+
+
+    @staticmethod
+    def key(*parts: str) -> str:
+        '''Computes the key that identifies an entry from its `parts`.'''
+        hasher = hashlib.sha256()
+        for p in parts:
+            hasher.update(str(p).encode('utf-8'))
+            hasher.update(b'\0')
+        return hasher.hexdigest()
+
+
+    def _lock(self, shared: bool=False) -> Lock:
+        return Lock(os.path.join(self._root, '.lock'), shared=shared)
+
+
+    def _object(self, key: str) -> str:
+        return os.path.join(self._root, 'objects', key[:2], key)
+
+
+    def get(self, key: str, dest: str, copy: bool=False) -> bool:
+        '''Materializes the entry for `key` at `dest`.
+
+        Files are hard linked when possible and copied otherwise, or always
+        copied (and left writable) with `copy`. Returns `False` if the entry is
+        not in the cache.'''
+        place = copy_writable if copy == True else link_or_copy
+        with self._lock(shared=True):
+            obj = self._object(key)
+            if os.path.exists(obj) == False:
+                return False
+            # mark the entry as recently used
+            os.utime(obj)
+            if os.path.isdir(obj) == True:
+                link_tree(obj, dest, place)
+            else:
+                if os.path.exists(dest) == True:
+                    os.remove(dest)
+                place(obj, dest)
+            pass
+        return True
+
+
+    def put(self, key: str, src: str, copy: bool=False):
+        '''Stores the file or directory `src` as the entry for `key`.
+
+        The entry is assembled under a temporary name and then renamed into
+        place, so readers never observe a partially written entry. Its files
+        are made read-only, so with `copy` they are copied rather than linked
+        to leave the files of `src` writable.'''
+        place = shutil.copy2 if copy == True else link_or_copy
+        tmp = os.path.join(self._root, 'tmp', uuid.uuid4().hex)
+        try:
+            if os.path.isdir(src) == True:
+                link_tree(src, tmp, place)
+            else:
+                place(src, tmp)
+            _make_read_only(tmp)
+            with self._lock():
+                obj = self._object(key)
+                # another job may have stored the same entry in the meantime
+                if os.path.exists(obj) == False:
+                    os.makedirs(os.path.dirname(obj), exist_ok=True)
+                    os.rename(tmp, obj)
+                self._evict()
+            pass
+        finally:
+            _remove(tmp)
+        pass
+
+
+    def _evict(self):
+        '''Removes the least recently used entries until the cache fits its limit.
+
+        Assumes the exclusive lock is already held.'''
+        objects = os.path.join(self._root, 'objects')
+        entries = []
+        for bucket in os.listdir(objects):
+            entries += [os.path.join(objects, bucket, name) for name in os.listdir(os.path.join(objects, bucket))]
+        evict(entries, self._limit)
+        pass
+    pass
+
+
+def open_cache() -> Optional[Cache]:
+    '''Opens the host's shared cache, or returns `None` if it is unavailable.'''
+    try:
+        return Cache()
+    except (OSError, ValueError) as e:
+        print('warning: Download cache is unavailable:', str(e))
+        return None
@@ -1,32 +1,214 @@
-# Project: orbit-profile 
+# Project: orbit-profile
 # Protocol: p-git.py
 #
 # Downloads packages that use git remote repositories.
-import sys, os
-import subprocess
-import random
+#
+# The tag is resolved to a commit with `git ls-remote` so a clone that was
+# already downloaded on this host is served from the shared download cache
+# instead of the network.
+#
+# Otherwise, a local bare mirror is kept for each remote and brought up to date
+# with an incremental fetch. The requested tag is then checked out from the
+# mirror with a shallow clone, so the remote's full history is transferred at
+# most once per host.
+#
+# With '--manifest <file>', many sources (one <url>###<tag> per line) are
+# fetched concurrently by a bounded pool of workers.
+import os
+import argparse, subprocess, tempfile, hashlib, shutil, time
+from typing import List
+
+from cache import Cache, Lock, CACHE_HOME, open_cache
+from batch import DEFAULT_JOBS, read_manifest, fetch_all
 
 DELIMITER = '###'
 
-if len(sys.argv) < 2:
-    print('error: Script requires URL as command-line argument')
-    exit(101)
+# directory to keep bare mirrors of remote repositories
+MIRROR_DIR = os.getenv('ORBIT_ENV_GIT_MIRROR_DIR', os.path.join(CACHE_HOME, 'mirrors'))
+
+
+def quote_str(s: str) -> str:
+    '''Wraps the string `s` around double quotes `\"` characters.'''
+    return '\"' + s + '\"'
+
+
+class Timer:
+    '''Reports how long a step of the download takes.'''
+
+    def __init__(self, step: str):
+        self._step = step
+        self._start = None
+        pass
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        print('info: Step', quote_str(self._step), 'took', '{:.3f}'.format(time.perf_counter() - self._start)+'s')
+        return False
+    pass
+
+
+def git(args: List[str], quiet: bool=False) -> int:
+    '''Runs git with `args` and returns its exit code.'''
+    out = subprocess.DEVNULL if quiet == True else None
+    return subprocess.run(["git"] + args, stdout=out, stderr=out).returncode
+
+
+def resolve(repo: str, tag: str) -> str:
+    '''Finds the commit that `tag` refers to on the remote `repo`.
+
+    Returns `None` if the reference cannot be resolved.'''
+    proc = subprocess.run(["git", "ls-remote", repo, tag, tag+'^{}'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    if proc.returncode != 0:
+        return None
+    refs = {}
+    for line in proc.stdout.decode('utf-8').splitlines():
+        words = line.split('\t')
+        if len(words) == 2:
+            refs[words[1]] = words[0]
+    # prefer the commit an annotated tag points to over the tag object itself
+    for ref in ['refs/tags/'+tag+'^{}', 'refs/tags/'+tag, 'refs/heads/'+tag]:
+        if ref in refs:
+            return refs[ref]
+    return None
+
+
+def repo_name(repo: str) -> str:
+    '''Returns the last component of the `repo` url without a `.git` extension.'''
+    name = os.path.basename(repo.rstrip('/'))
+    if name.endswith('.git') == True:
+        name = name[:-len('.git')]
+    return name
+
+
+def mirror_path(repo: str) -> str:
+    '''Returns the path of the local bare mirror for the remote `repo`.'''
+    return os.path.join(MIRROR_DIR, repo_name(repo)+'-'+hashlib.sha256(repo.encode('utf-8')).hexdigest()[:16]+'.git')
+
+
+def update_mirror(repo: str, mirror: str, commit: str=None) -> bool:
+    '''Creates or incrementally fetches the bare `mirror` of `repo`.
+
+    The fetch is skipped when the mirror already has `commit`.'''
+    os.makedirs(MIRROR_DIR, exist_ok=True)
+    with Lock(mirror+'.lock'):
+        if os.path.exists(mirror) == False:
+            # clone into a temporary name so an interrupted clone is never used
+            tmp = tempfile.mkdtemp(prefix=os.path.basename(mirror)+'.', dir=MIRROR_DIR)
+            if git(["clone", "--mirror", "--quiet", repo, tmp]) != 0:
+                shutil.rmtree(tmp, ignore_errors=True)
+                return False
+            os.rename(tmp, mirror)
+        elif commit is None or git(["-C", mirror, "cat-file", "-e", commit+'^{commit}'], quiet=True) != 0:
+            if git(["-C", mirror, "fetch", "--prune", "--quiet", "origin"]) != 0:
+                return False
+        pass
+    return True
 
-source = sys.argv[1]
 
-# access the url and tag
-comps = source.split(DELIMITER, 1)
+def checkout(repo: str, mirror: str, tag: str, dest: str) -> bool:
+    '''Performs a shallow clone of `tag` from the local `mirror` into `dest`.'''
+    with Lock(mirror+'.lock', shared=True):
+        # the file:// scheme is required for git to honor --depth on local paths
+        if git(["-c", "advice.detachedHead=false", "clone", "--quiet", "--depth", "1", "-b", tag, "file://"+os.path.abspath(mirror), dest]) != 0:
+            return False
+    # point the clone back at the original remote
+    return git(["-C", dest, "remote", "set-url", "origin", repo]) == 0
 
-REPO = comps[0]
-TAG = comps[1]
+
+class InstallError(Exception):
+    pass
+
+
+def install(source: str, queue: str, cache: Cache=None) -> str:
+    '''Downloads the `source` (<url>###<tag>) into a new directory in `queue`.
+
+    Returns the path to the new directory.'''
+    # access the url and tag
+    comps = source.split(DELIMITER, 1)
+    if len(comps) != 2:
+        raise InstallError('source '+quote_str(source)+' is missing '+quote_str(DELIMITER+'<tag>'))
+    repo, tag = comps
+
+    # create a uniquely named destination so parallel installs never collide
+    os.makedirs(queue, exist_ok=True)
+    dest = tempfile.mkdtemp(prefix=repo_name(repo)+'-'+tag.replace('/', '_')+'-', dir=queue)
+    try:
+        return _install(repo, tag, dest, cache)
+    except:
+        # do not leave an incomplete package behind in the queue
+        shutil.rmtree(dest, ignore_errors=True)
+        raise
+
+
+def _install(repo: str, tag: str, dest: str, cache: Cache=None) -> str:
+    with Timer('resolve'):
+        commit = resolve(repo, tag)
+    key = Cache.key('p-git', repo, commit) if commit is not None and cache is not None else None
+
+    if key is not None:
+        with Timer('cache'):
+            hit = cache.get(key, dest, copy=True)
+        if hit == True:
+            print("info: Using cached clone of", repo, "at", commit)
+            return dest
+        pass
+
+    mirror = mirror_path(repo)
+    with Timer('mirror'):
+        ok = update_mirror(repo, mirror, commit)
+    if ok == False:
+        raise InstallError('failed to update mirror of '+repo)
+
+    with Timer('checkout'):
+        ok = checkout(repo, mirror, tag, dest)
+    if ok == False:
+        raise InstallError('failed to check out '+quote_str(tag)+' from '+repo)
+
+    # the checkout is handed to orbit as a working tree, so it never shares
+    # the cache's read-only files
+    if key is not None:
+        with Timer('store'):
+            cache.put(key, dest, copy=True)
+    return dest
+
+
+## Handle command-line arguments
+
+parser = argparse.ArgumentParser(prog='p-git', allow_abbrev=False)
+
+parser.add_argument('source', nargs='?', default=None, help='remote repository and tag (<url>'+DELIMITER+'<tag>)')
+parser.add_argument('--manifest', default=None, metavar='FILE', help='fetch every source listed in a file')
+parser.add_argument('--jobs', '-j', type=int, default=DEFAULT_JOBS, metavar='NUM', help='number of sources to fetch at once')
+
+args = parser.parse_args()
+
+if args.source is not None and args.manifest is not None:
+    print('error: A source cannot be combined with \'--manifest <file>\'')
+    exit(101)
+
+if args.source is None and args.manifest is None:
+    print('error: Script requires URL as command-line argument')
+    exit(101)
 
 print("info: Identifying download destination ...")
 # determine the destination to place downloads for future installing
 ORBIT_QUEUE = os.getenv("ORBIT_QUEUE")
 print("info: Download directory:", ORBIT_QUEUE)
 
-dest = ORBIT_QUEUE+'/'+str(random.randint(0, 999999))+'/'
-# clone to the specific tag using git
-subprocess.run(["git", "clone", "-b", TAG, REPO, dest, "--quiet"])
+cache = open_cache()
+
+# fetch many sources concurrently
+if args.manifest is not None:
+    failures = fetch_all(read_manifest(args.manifest), lambda source, _: install(source, ORBIT_QUEUE, cache), jobs=args.jobs)
+    exit(101 if failures > 0 else 0)
+
+try:
+    install(args.source, ORBIT_QUEUE, cache)
+except InstallError as e:
+    print('error:', str(e))
+    exit(101)
 
 exit(0)
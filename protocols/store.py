@@ -0,0 +1,154 @@
+# Project: orbit-profile
+# Module: store.py
+#
+# A content-addressed store of extracted package files shared on this host.
+#
+# Each unique file is kept once as a read-only blob named after its digest.
+# Installs are materialized from the blobs with hard links, falling back to
+# reflinks and then copies when the filesystem cannot link. Every install is
+# recorded so garbage collection can remove blobs no install references.
+
+import os, stat, shutil, hashlib, json, uuid
+from typing import BinaryIO, Iterable
+
+from cache import Lock, CACHE_HOME
+
+# location of the store if not set by the environment
+DEFAULT_ROOT = os.path.join(CACHE_HOME, 'store')
+
+# number of bytes to hold in memory at a time when adding a file
+CHUNK_SIZE = 1024 * 1024
+
+# ioctl request code to clone a file's extents on linux (FICLONE)
+_FICLONE = 0x40049409
+
+
+def reflink(src: str, dst: str) -> bool:
+    '''Creates `dst` as a copy-on-write clone of `src`, if the filesystem supports it.'''
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    try:
+        with open(src, 'rb') as s, open(dst, 'wb') as d:
+            fcntl.ioctl(d.fileno(), _FICLONE, s.fileno())
+        return True
+    except OSError:
+        if os.path.exists(dst) == True:
+            os.remove(dst)
+        return False
+
+
+class Store:
+    '''A deduplicated store of file contents.'''
+
+    def __init__(self, root: str=None):
+        if root is None:
+            root = os.getenv('ORBIT_ENV_PACKAGE_STORE_DIR', DEFAULT_ROOT)
+        self._root = root
+        for d in ['blobs', 'installs', 'tmp']:
+            os.makedirs(os.path.join(self._root, d), exist_ok=True)
+        pass
+
+
+    def lock(self, shared: bool=True) -> Lock:
+        '''Guards the store against garbage collection while installing.'''
+        return Lock(os.path.join(self._root, '.lock'), shared=shared)
+
+
+    def _blob(self, name: str) -> str:
+        return os.path.join(self._root, 'blobs', name[:2], name)
+
+
+    def add(self, src: BinaryIO, executable: bool=False) -> str:
+        '''Reads the stream `src` into the store and returns the name of its blob.
+
+        Executable files are kept apart from other files with the same contents
+        because linked files share their permissions.'''
+        tmp = os.path.join(self._root, 'tmp', uuid.uuid4().hex)
+        hasher = hashlib.sha256()
+        try:
+            with open(tmp, 'wb') as dst:
+                for chunk in iter(lambda: src.read(CHUNK_SIZE), b''):
+                    hasher.update(chunk)
+                    dst.write(chunk)
+                pass
+            name = hasher.hexdigest() + ('.x' if executable == True else '')
+            blob = self._blob(name)
+            if os.path.exists(blob) == False:
+                os.chmod(tmp, 0o555 if executable == True else 0o444)
+                os.makedirs(os.path.dirname(blob), exist_ok=True)
+                os.replace(tmp, blob)
+        finally:
+            if os.path.exists(tmp) == True:
+                os.remove(tmp)
+        return name
+
+
+    def materialize(self, name: str, dest: str):
+        '''Places the blob `name` at `dest` by hard link, reflink, or copy.'''
+        blob = self._blob(name)
+        if os.path.lexists(dest) == True:
+            os.remove(dest)
+        try:
+            os.link(blob, dest)
+            return
+        except OSError:
+            pass
+        if reflink(blob, dest) == False:
+            shutil.copyfile(blob, dest)
+        # unlike links, clones and copies are owned by the install
+        os.chmod(dest, 0o755 if name.endswith('.x') == True else 0o644)
+        pass
+
+
+    def record(self, path: str, names: Iterable[str]):
+        '''Records that the install at `path` references the blobs `names`.'''
+        path = os.path.realpath(path)
+        manifest = os.path.join(self._root, 'installs', hashlib.sha256(path.encode('utf-8')).hexdigest()+'.json')
+        blobs = set(names)
+        # an install directory may receive several packages
+        if os.path.exists(manifest) == True:
+            with open(manifest, 'r') as f:
+                blobs |= set(json.load(f)['blobs'])
+        tmp = manifest+'.'+uuid.uuid4().hex
+        with open(tmp, 'w') as f:
+            json.dump({'path': path, 'blobs': sorted(blobs)}, f)
+        os.replace(tmp, manifest)
+        pass
+
+
+    def gc(self) -> int:
+        '''Removes blobs that no existing install references.
+
+        Returns the number of bytes freed.'''
+        freed = 0
+        with self.lock(shared=False):
+            live = set()
+            installs = os.path.join(self._root, 'installs')
+            for entry in os.listdir(installs):
+                manifest = os.path.join(installs, entry)
+                try:
+                    with open(manifest, 'r') as f:
+                        data = json.load(f)
+                except (OSError, ValueError):
+                    continue
+                if os.path.exists(data['path']) == False:
+                    os.remove(manifest)
+                    continue
+                live |= set(data['blobs'])
+            blobs = os.path.join(self._root, 'blobs')
+            for bucket in os.listdir(blobs):
+                for name in os.listdir(os.path.join(blobs, bucket)):
+                    blob = os.path.join(blobs, bucket, name)
+                    info = os.stat(blob)
+                    # keep blobs still linked from anywhere, even if unrecorded
+                    if name in live or info.st_nlink > 1:
+                        continue
+                    os.chmod(blob, stat.S_IWUSR | stat.S_IRUSR)
+                    os.remove(blob)
+                    freed += info.st_size
+                pass
+            pass
+        return freed
+    pass
@@ -1,22 +1,359 @@
 # Project: orbit-profile
 # Protocol: zipp
 #
-# A quick-and-dirty script to download packages from the internet for 
-# integration with orbit.
+# Downloads zip archives from the internet for integration with orbit.
+#
+# The archive is streamed to a partial file on disk in fixed-size chunks, so
+# memory use stays bounded regardless of the archive's size. An interrupted
+# download is resumed on the next attempt with an HTTP Range request. Once the
+# archive is complete, its checksum is optionally verified and its members are
+# extracted one at a time into the current directory.
+#
+# A checksum can be given with '--checksum <algo>=<hex>' or as a fragment at the
+# end of the URL (https://example.com/pkg.zip#sha256=<hex>).
+#
+# Completed archives are kept in the host's shared download cache, keyed on the
+# checksum when one is given or else on the URL and the server's ETag, so later
+# installs of the same archive skip the network transfer.
+#
+# With '--manifest <file>', many archives are fetched concurrently by a bounded
+# pool of workers sharing one pooled HTTP session. Each line of the manifest
+# holds a URL, optionally followed by the directory to extract it into.
+#
+# Extracted files go through the host's content-addressed package store: each
+# unique file is kept once and installed with a hard link (or a reflink or copy
+# where links are not possible). Run with '--gc' to delete stored files that
+# are no longer used by any install.
+
+import sys, os
+import argparse, hashlib, json, shutil, tempfile
+from typing import List
+
+from cache import Cache, Lock, open_cache
+from batch import Progress, DEFAULT_JOBS, read_manifest, fetch_all
+from store import Store
+
+# number of bytes to hold in memory at a time when downloading or extracting
+CHUNK_SIZE = 1024 * 1024
+
+# number of times to resume a download after the connection is interrupted
+RETRIES = 3
+
+# seconds to wait on the server before considering the connection lost
+TIMEOUT = 30
+
+# directory to keep partially downloaded archives between invocations
+PARTIAL_DIR = os.path.join(tempfile.gettempdir(), 'orbit-zipp')
+
+
+class DownloadError(Exception):
+    pass
+
+
+def split_checksum(url: str):
+    '''Separates a trailing `#<algo>=<hex>` fragment from the `url`.
+
+    Returns the url without the fragment and the checksum (or `None`).'''
+    base, sep, fragment = url.partition('#')
+    if sep == '' or '=' not in fragment:
+        return (url, None)
+    algo = fragment.split('=', 1)[0].lower()
+    if algo not in hashlib.algorithms_available:
+        return (url, None)
+    return (base, fragment)
+
+
+def parse_checksum(checksum: str):
+    '''Splits a `<algo>=<hex>` string into its algorithm and digest.'''
+    words = checksum.split('=', 1)
+    if len(words) != 2 or words[0].lower() not in hashlib.algorithms_available:
+        raise DownloadError('invalid checksum "'+checksum+'" (expecting <algo>=<hex>)')
+    return (words[0].lower(), words[1].strip().lower())
+
+
+def partial_path(url: str) -> str:
+    '''Returns the path of the partial download file for `url`.'''
+    os.makedirs(PARTIAL_DIR, exist_ok=True)
+    name = hashlib.sha256(url.encode('utf-8')).hexdigest()[:32]
+    return os.path.join(PARTIAL_DIR, name+'.part')
+
+
+def _read_validator(part: str):
+    '''Loads the validator (ETag or Last-Modified) recorded for a partial file.'''
+    try:
+        with open(part+'.meta', 'r') as f:
+            return json.load(f).get('validator')
+    except (OSError, ValueError):
+        return None
+
+
+def _write_validator(part: str, response):
+    validator = response.headers.get('ETag')
+    # weak etags cannot be used to resume a range
+    if validator is None or validator.startswith('W/'):
+        validator = response.headers.get('Last-Modified')
+    with open(part+'.meta', 'w') as f:
+        json.dump({'validator': validator}, f)
+
+
+def probe(url: str, session) -> str:
+    '''Requests the validator (ETag or Last-Modified) of the resource at `url`.
+
+    Returns `None` if the server does not provide one.'''
+    import requests
+    try:
+        r = session.head(url, allow_redirects=True, timeout=TIMEOUT)
+    except requests.exceptions.RequestException:
+        return None
+    if r.ok == False:
+        return None
+    validator = r.headers.get('ETag')
+    if validator is None or validator.startswith('W/'):
+        validator = r.headers.get('Last-Modified')
+    return validator
 
-import sys
-import requests, zipfile, io
 
-if len(sys.argv) < 2:
-    print('error: Script requires URL as command-line argument')
+def discard(part: str):
+    '''Removes a partial download and its metadata.'''
+    for path in (part, part+'.meta'):
+        if os.path.exists(path) == True:
+            os.remove(path)
+    pass
+
+
+def open_session(pool_size: int=1):
+    '''Creates an HTTP session that keeps up to `pool_size` connections per host
+    open for reuse.'''
+    import requests
+    from requests.adapters import HTTPAdapter
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def download(url: str, part: str, session=None, chunk_size: int=CHUNK_SIZE, retries: int=RETRIES, progress: Progress=None) -> str:
+    '''Streams the contents at `url` into the file `part`.
+
+    Any existing bytes in `part` are kept and only the remainder is requested
+    from the server. The download is resumed up to `retries` times if the
+    connection drops. Transferred bytes are counted against `progress` if
+    given. Returns the path to the completed file.'''
+    import requests
+    if session is None:
+        session = requests.Session()
+    attempt = 0
+    while True:
+        offset = os.path.getsize(part) if os.path.exists(part) == True else 0
+        headers = {}
+        if offset > 0:
+            headers['Range'] = 'bytes='+str(offset)+'-'
+            # only resume if the resource has not changed since the last attempt
+            validator = _read_validator(part)
+            if validator is not None:
+                headers['If-Range'] = validator
+        try:
+            with session.get(url, headers=headers, stream=True, timeout=TIMEOUT) as r:
+                if r.status_code == 416:
+                    # the range starts at or past the end of the resource
+                    total = r.headers.get('Content-Range', '').rpartition('/')[2]
+                    if total.isdigit() == True and int(total) == offset:
+                        return part
+                    discard(part)
+                    continue
+                if r.ok == False:
+                    raise DownloadError(str(r)+' '+str(r.reason))
+                if r.status_code == 206:
+                    start = r.headers.get('Content-Range', '').split(' ')[-1].split('-')[0]
+                    if start != str(offset):
+                        raise DownloadError('server responded with unexpected range "'+r.headers.get('Content-Range', '')+'"')
+                    mode = 'ab'
+                else:
+                    # server ignored the range request or the resource changed
+                    offset = 0
+                    mode = 'wb'
+                    _write_validator(part, r)
+                expected = r.headers.get('Content-Length')
+                received = 0
+                with open(part, mode) as f:
+                    for chunk in r.iter_content(chunk_size=chunk_size):
+                        f.write(chunk)
+                        received += len(chunk)
+                        if progress is not None:
+                            progress.advance(len(chunk))
+                    pass
+                # an early close from the server is treated like a dropped connection
+                if expected is not None and r.headers.get('Content-Encoding') is None and received < int(expected):
+                    raise requests.exceptions.ChunkedEncodingError('connection closed after '+str(offset+received)+' bytes')
+                return part
+        except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError, requests.exceptions.Timeout) as e:
+            attempt += 1
+            if attempt > retries:
+                raise DownloadError('download interrupted: '+str(e))
+            print('warning: Download interrupted; resuming ('+str(attempt)+'/'+str(retries)+') ...')
+        pass
+
+
+def verify(path: str, checksum: str, chunk_size: int=CHUNK_SIZE):
+    '''Computes the digest of the file at `path` and compares it to `checksum`.'''
+    algo, digest = parse_checksum(checksum)
+    hasher = hashlib.new(algo)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            hasher.update(chunk)
+    if hasher.hexdigest() != digest:
+        raise DownloadError('checksum mismatch: expected '+algo+' '+digest+' but computed '+hasher.hexdigest())
+    pass
+
+
+def extract(archive: str, dest: str='.', chunk_size: int=CHUNK_SIZE, store: Store=None):
+    '''Extracts each member of the zip file `archive` into the directory `dest`.
+
+    Members are copied in chunks of `chunk_size` bytes so no member is ever
+    held entirely in memory. If a `store` is given, members are added to it and
+    linked into `dest` instead of being written out as new copies.'''
+    if store is not None:
+        with store.lock():
+            store.record(dest, _extract(archive, dest, chunk_size, store))
+    else:
+        _extract(archive, dest, chunk_size, None)
+    pass
+
+
+def _extract(archive: str, dest: str, chunk_size: int, store: Store) -> List[str]:
+    import zipfile
+    blobs = []
+    root = os.path.realpath(dest)
+    try:
+        z = zipfile.ZipFile(archive)
+    except zipfile.BadZipFile as e:
+        raise DownloadError('invalid zip archive: '+str(e))
+    with z:
+        for info in z.infolist():
+            target = os.path.realpath(os.path.join(root, info.filename))
+            # refuse to write outside of the destination directory
+            if target != root and target.startswith(root+os.sep) == False:
+                raise DownloadError('archive member "'+info.filename+'" escapes the destination directory')
+            if info.is_dir() == True:
+                os.makedirs(target, exist_ok=True)
+                continue
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            if store is not None:
+                executable = (info.external_attr >> 16) & 0o111 != 0
+                with z.open(info) as src:
+                    name = store.add(src, executable)
+                store.materialize(name, target)
+                blobs += [name]
+                continue
+            with z.open(info) as src, open(target, 'wb') as dst:
+                shutil.copyfileobj(src, dst, chunk_size)
+            pass
+        pass
+    return blobs
+
+
+def fetch(url: str, checksum: str=None, dest: str='.', session=None, cache: Cache=None, progress: Progress=None, store: Store=None):
+    '''Downloads, verifies, and extracts the zip archive at `url` into `dest`.
+
+    If a `cache` is given, a matching archive is served from it instead of the
+    network and newly downloaded archives are stored in it. If a `store` is
+    given, the extracted files are deduplicated through it.'''
+    url, fragment = split_checksum(url)
+    if checksum is None:
+        checksum = fragment
+    if session is None:
+        session = open_session()
+    part = partial_path(url)
+    # only one fetch of the url at a time may resume, verify, or extract (and
+    # then discard) its partial file
+    with Lock(part+'.lock'):
+        _fetch(url, checksum, part, dest, session, cache, progress, store)
+    pass
+
+
+def _fetch(url: str, checksum: str, part: str, dest: str, session, cache: Cache, progress: Progress, store: Store):
+    key = None
+    if cache is not None:
+        # a known digest identifies the content on its own
+        if checksum is not None:
+            key = Cache.key('zipp', checksum.lower())
+        else:
+            validator = probe(url, session)
+            if validator is not None:
+                key = Cache.key('zipp', url, validator)
+        pass
+    cached = key is not None and cache.get(key, part) == True
+    if cached == True:
+        print('info: Using cached archive for', url)
+    else:
+        download(url, part, session=session, progress=progress)
+        if checksum is not None:
+            try:
+                verify(part, checksum)
+            except DownloadError:
+                # a corrupted archive is not worth resuming
+                discard(part)
+                raise
+        pass
+    try:
+        extract(part, dest, store=store)
+    except DownloadError:
+        # a truncated archive or an error page is not worth resuming either
+        discard(part)
+        raise
+    # only an archive that extracted is kept, keyed on what was actually
+    # downloaded in case the resource changed
+    if cached == False and cache is not None:
+        validator = _read_validator(part)
+        if checksum is None and validator is not None:
+            key = Cache.key('zipp', url, validator)
+        if key is not None:
+            cache.put(key, part)
+    discard(part)
+    pass
+
+
+## Handle command-line arguments
+
+parser = argparse.ArgumentParser(prog='zipp', allow_abbrev=False)
+
+parser.add_argument('url', nargs='?', default=None, help='location of the zip archive')
+parser.add_argument('--checksum', default=None, metavar='ALGO=HEX', help='verify the archive against a digest (ex: sha256=<hex>)')
+parser.add_argument('--no-cache', action='store_true', default=False, help='always download from the network')
+parser.add_argument('--manifest', default=None, metavar='FILE', help='fetch every archive listed in a file')
+parser.add_argument('--jobs', '-j', type=int, default=DEFAULT_JOBS, metavar='NUM', help='number of archives to fetch at once')
+parser.add_argument('--no-store', action='store_true', default=False, help='extract files as copies instead of through the package store')
+parser.add_argument('--gc', action='store_true', default=False, help='remove unused files from the package store and exit')
+
+args = parser.parse_args()
+
+if args.gc == True:
+    freed = Store().gc()
+    print('info: Freed', '{:.2f}'.format(freed / 1e6), 'MB from the package store')
+    exit(0)
+
+if (args.url is None) == (args.manifest is None):
+    print('error: Script requires either a URL or \'--manifest <file>\'')
     exit(101)
 
-# get the url
-URL = sys.argv[1]
+cache = None if args.no_cache == True else open_cache()
+store = None if args.no_store == True else Store()
+
+# fetch many archives concurrently
+if args.manifest is not None:
+    session = open_session(args.jobs)
+
+    def fetch_entry(entry: str, progress: Progress):
+        words = entry.split()
+        dest = words[1] if len(words) > 1 else '.'
+        fetch(words[0], dest=dest, session=session, cache=cache, progress=progress, store=store)
+
+    failures = fetch_all(read_manifest(args.manifest), fetch_entry, jobs=args.jobs)
+    exit(101 if failures > 0 else 0)
 
-r = requests.get(URL)
-if r.ok == False:
-    print('error:', str(r), str(r.reason))
+try:
+    fetch(args.url, args.checksum, cache=cache, store=store)
+except DownloadError as e:
+    print('error:', str(e))
     exit(101)
-z = zipfile.ZipFile(io.BytesIO(r.content))
-z.extractall()
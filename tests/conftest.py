@@ -0,0 +1,127 @@
+# Project: orbit-profile
+# Module: conftest.py
+#
+# Local stand-ins shared by the tests: an HTTP server that serves files with
+# ranged requests and can drop a transfer partway through.
+
+import os, sys, threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Dict, List
+
+import pytest
+
+# root directory of the profile
+PROFILE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.insert(0, os.path.join(PROFILE_DIR, 'protocols'))
+
+
+class FileServer(ThreadingHTTPServer):
+    '''Serves the `files` by name, honoring `Range` and `If-Range` requests.
+
+    The next `drops` transfers stop after half of their bytes and close the
+    connection. Every request's path and `Range` header is kept in `requests`.'''
+    daemon_threads = True
+
+    def __init__(self):
+        self.files: Dict[str, bytes] = {}
+        self.drops = 0
+        self.requests: List[tuple] = []
+        self._lock = threading.Lock()
+        super().__init__(('127.0.0.1', 0), Handler)
+        pass
+
+
+    def url(self, name: str) -> str:
+        return 'http://127.0.0.1:'+str(self.server_address[1])+'/'+name
+
+
+    def take_drop(self) -> bool:
+        with self._lock:
+            if self.drops > 0:
+                self.drops -= 1
+                return True
+            return False
+    pass
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+
+    def _headers(self, body: bool) -> bytes:
+        name = self.path.lstrip('/')
+        data = self.server.files.get(name)
+        if body == True:
+            self.server.requests += [(name, self.headers.get('Range'))]
+        if data is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return None
+        etag = '"'+str(len(data))+'-'+str(hash(data))+'"'
+        start = 0
+        ranged = self.headers.get('Range')
+        if ranged is not None and self.headers.get('If-Range') in (None, etag):
+            start = int(ranged.split('=', 1)[1].split('-')[0])
+        if start >= len(data) and start > 0:
+            self.send_response(416)
+            self.send_header('Content-Range', 'bytes */'+str(len(data)))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return None
+        self.send_response(206 if start > 0 else 200)
+        if start > 0:
+            self.send_header('Content-Range', 'bytes '+str(start)+'-'+str(len(data) - 1)+'/'+str(len(data)))
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(data) - start))
+        self.end_headers()
+        return data[start:]
+
+
+    def do_HEAD(self):
+        self._headers(False)
+        pass
+
+
+    def do_GET(self):
+        data = self._headers(True)
+        if data is None:
+            return
+        if self.server.take_drop() == True:
+            # send half of the body and hang up
+            self.wfile.write(data[:len(data) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(data)
+        pass
+    pass
+
+
+@pytest.fixture
+def http_server():
+    '''A local `FileServer` that runs for the duration of one test.'''
+    server = FileServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def protocol_env(tmp_path) -> Dict[str, str]:
+    '''The environment to run a protocol with its caches, store, and partial
+    downloads kept under the test's directory.'''
+    env = dict(os.environ)
+    env.update({
+        'ORBIT_HOME': str(tmp_path / 'home'),
+        'ORBIT_QUEUE': str(tmp_path / 'queue'),
+        'TMPDIR': str(tmp_path / 'tmp'),
+    })
+    os.makedirs(env['TMPDIR'], exist_ok=True)
+    return env
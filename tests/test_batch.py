@@ -0,0 +1,115 @@
+# Project: orbit-profile
+# Test: test_batch.py
+#
+# Fetches manifests of sources concurrently, with the zipp protocol against a
+# local HTTP server and the p-git protocol against local repositories.
+
+import os, io, sys, time, zipfile, threading, subprocess
+
+from conftest import PROFILE_DIR
+from batch import read_manifest, fetch_all
+
+PROTOCOLS = os.path.join(PROFILE_DIR, 'protocols')
+
+
+def test_manifest_skips_comments_blanks_and_duplicates(tmp_path):
+    manifest = tmp_path / 'manifest.txt'
+    manifest.write_text('; packages\nhttp://a/x.zip\n\n  http://b/y.zip  \nhttp://a/x.zip\n;http://c/z.zip\n')
+    assert read_manifest(str(manifest)) == ['http://a/x.zip', 'http://b/y.zip']
+
+
+def test_a_failure_does_not_stop_the_other_sources(capsys):
+    fetched = []
+    lock = threading.Lock()
+
+    def fetch(source, progress):
+        if source.startswith('bad') == True:
+            raise RuntimeError('no such package')
+        progress.advance(10)
+        with lock:
+            fetched.append(source)
+
+    failures = fetch_all(['a', 'bad-1', 'b', 'bad-2', 'c'], fetch, jobs=2)
+    assert failures == 2
+    assert sorted(fetched) == ['a', 'b', 'c']
+    out = capsys.readouterr().out
+    assert 'Fetched 3/5 sources' in out
+    assert 'error: Failed to fetch bad-1: no such package' in out
+    assert 'error: Failed to fetch bad-2: no such package' in out
+
+
+def test_at_most_jobs_sources_are_fetched_at_once():
+    running = [0]
+    peak = [0]
+    lock = threading.Lock()
+
+    def fetch(source, progress):
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        time.sleep(0.05)
+        with lock:
+            running[0] -= 1
+
+    assert fetch_all([str(i) for i in range(12)], fetch, jobs=3) == 0
+    assert peak[0] == 3
+
+
+def make_zip(name: str) -> bytes:
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, 'w') as z:
+        z.writestr(name+'/Orbit.toml', '[ip]\nname = "'+name+'"\n')
+    return data.getvalue()
+
+
+def test_zipp_manifest_counts_failures(http_server, protocol_env, tmp_path):
+    http_server.files['a.zip'] = make_zip('a')
+    http_server.files['b.zip'] = make_zip('b')
+    manifest = tmp_path / 'manifest.txt'
+    manifest.write_text('\n'.join([
+        http_server.url('a.zip')+' out-a',
+        http_server.url('missing.zip')+' out-missing',
+        http_server.url('b.zip')+' out-b',
+        http_server.url('a.zip')+' out-a',
+    ])+'\n')
+    proc = subprocess.run([sys.executable, os.path.join(PROTOCOLS, 'zipp.py'), '--no-cache', '--no-store', '--manifest', str(manifest), '--jobs', '2'],
+        env=protocol_env, cwd=str(tmp_path), stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True, timeout=60)
+    assert proc.returncode == 101, proc.stdout
+    assert 'Fetched 2/3 sources' in proc.stdout
+    assert os.path.isfile(tmp_path / 'out-a' / 'a' / 'Orbit.toml') == True
+    assert os.path.isfile(tmp_path / 'out-b' / 'b' / 'Orbit.toml') == True
+    # the duplicate line is only fetched once
+    assert len([r for r in http_server.requests if r[0] == 'a.zip']) == 1
+
+
+def git(args, cwd):
+    subprocess.run(['git'] + args, cwd=cwd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def make_repo(path, tag: str):
+    os.makedirs(path)
+    git(['init', '-q'], path)
+    (path / 'Orbit.toml').write_text('[ip]\nname = "'+path.name+'"\n')
+    git(['add', '.'], path)
+    git(['-c', 'user.name=t', '-c', 'user.email=t@t', 'commit', '-q', '-m', 'init'], path)
+    git(['tag', tag], path)
+
+
+def test_p_git_manifest_fetches_local_repositories(protocol_env, tmp_path):
+    make_repo(tmp_path / 'repo-a', 'v1')
+    make_repo(tmp_path / 'repo-b', 'v2')
+    manifest = tmp_path / 'manifest.txt'
+    manifest.write_text('\n'.join([
+        str(tmp_path / 'repo-a')+'###v1',
+        str(tmp_path / 'repo-b')+'###v2',
+        str(tmp_path / 'repo-b')+'###v9',
+        str(tmp_path / 'repo-a')+'###v1',
+    ])+'\n')
+    proc = subprocess.run([sys.executable, os.path.join(PROTOCOLS, 'p-git.py'), '--manifest', str(manifest), '--jobs', '3'],
+        env=protocol_env, cwd=str(tmp_path), stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True, timeout=120)
+    assert proc.returncode == 101, proc.stdout
+    assert 'Fetched 2/3 sources' in proc.stdout
+    assert 'v9' in proc.stdout
+    installs = sorted(os.listdir(protocol_env['ORBIT_QUEUE']))
+    assert len(installs) == 2
+    assert installs[0].startswith('repo-a-v1-') == True and installs[1].startswith('repo-b-v2-') == True
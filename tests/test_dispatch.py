@@ -0,0 +1,154 @@
+# Project: orbit-profile
+# Test: test_dispatch.py
+#
+# Runs distributed regressions with workers on localhost against stub tools.
+
+import os, sys, json, time, socket, signal, threading, subprocess
+from typing import List
+
+import pytest
+
+from conftest import PROFILE_DIR
+
+sys.path.insert(0, os.path.join(PROFILE_DIR, 'bench'))
+from stubs import make_sandbox
+
+DISPATCH = os.path.join(PROFILE_DIR, 'plugins', 'dispatch.py')
+
+
+@pytest.fixture
+def sandbox(tmp_path) -> dict:
+    '''A build directory whose tools are stubs that take a moment to run.'''
+    env = make_sandbox(str(tmp_path), latency=0.3)
+    env.update({
+        'ORBIT_ENV_JOBS': '8',
+        'ORBIT_ENV_JOBS_DIR': str(tmp_path / 'jobs'),
+        'ORBIT_ENV_DISPATCH_TOKEN': 'secret',
+    })
+    return env
+
+
+class Output:
+    '''Collects the lines a process prints in the background.'''
+
+    def __init__(self, proc: subprocess.Popen):
+        self.lines: List[str] = []
+        self._thread = threading.Thread(target=self._read, args=(proc,), daemon=True)
+        self._thread.start()
+        pass
+
+
+    def _read(self, proc: subprocess.Popen):
+        for line in proc.stdout:
+            self.lines += [line]
+        pass
+
+
+    def wait_for(self, text: str, timeout: float=60.0) -> str:
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            for line in self.lines:
+                if text in line:
+                    return line
+            time.sleep(0.05)
+        raise AssertionError('never printed '+repr(text)+':\n'+''.join(self.lines))
+
+
+    def text(self) -> str:
+        self._thread.join(timeout=10)
+        return ''.join(self.lines)
+    pass
+
+
+def start(args: List[str], env: dict) -> subprocess.Popen:
+    return subprocess.Popen([sys.executable, DISPATCH] + args, env=env, cwd=env['ORBIT_BUILD_DIR'], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True, start_new_session=True)
+
+
+def summary(env: dict) -> List[List[str]]:
+    with open(os.path.join(env['ORBIT_BUILD_DIR'], 'dispatch', 'gsim', 'summary.txt'), 'r') as f:
+        return [line.split() for line in f.read().splitlines()[1:]]
+
+
+def test_local_workers_run_every_job(sandbox):
+    proc = subprocess.run([sys.executable, DISPATCH, '--workers', '2', '--seeds', '1-4', '--enable-veriti', '0'],
+        env=sandbox, cwd=sandbox['ORBIT_BUILD_DIR'], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True, timeout=120)
+    assert proc.returncode == 0, proc.stdout
+    assert 'Dispatch summary (4 of 4 passed)' in proc.stdout
+    rows = summary(sandbox)
+    assert [row[2] for row in rows] == ['1', '2', '3', '4']
+    assert set([row[5] for row in rows]) == set(['local-1', 'local-2'])
+
+
+def test_jobs_of_a_killed_worker_are_retried(sandbox):
+    coordinator = start(['--seeds', '1-4', '--enable-veriti', '0'], sandbox)
+    output = Output(coordinator)
+    try:
+        address = output.wait_for('Start a worker with').split('--worker')[1].strip()
+        doomed = start(['--worker', address, '--name', 'doomed'], sandbox)
+        doomed_output = Output(doomed)
+        doomed_output.wait_for('Running job')
+        # the worker and the simulation it started both die mid-job
+        os.killpg(doomed.pid, signal.SIGKILL)
+        doomed.wait()
+        output.wait_for('Lost connection to worker doomed')
+        survivor = start(['--worker', address, '--name', 'survivor'], sandbox)
+        assert coordinator.wait(timeout=120) == 0, output.text()
+        survivor.wait(timeout=30)
+    finally:
+        for p in [coordinator]:
+            if p.poll() is None:
+                os.killpg(p.pid, signal.SIGKILL)
+    text = output.text()
+    assert 'Retrying job' in text
+    assert 'Dispatch summary (4 of 4 passed)' in text
+    rows = summary(sandbox)
+    assert set([row[5] for row in rows]) == set(['survivor'])
+    assert max([int(row[6]) for row in rows]) == 2
+
+
+def test_a_worker_with_the_wrong_token_is_refused(sandbox):
+    coordinator = start(['--seeds', '1-2', '--enable-veriti', '0'], sandbox)
+    output = Output(coordinator)
+    try:
+        address = output.wait_for('Start a worker with').split('--worker')[1].strip()
+        intruder = subprocess.run([sys.executable, DISPATCH, '--worker', address, '--name', 'intruder'], env=dict(sandbox, ORBIT_ENV_DISPATCH_TOKEN='guess'),
+            cwd=sandbox['ORBIT_BUILD_DIR'], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True, timeout=30)
+        assert intruder.returncode != 0
+        assert 'Coordinator failed to prove it knows the token' in intruder.stdout
+        start(['--worker', address, '--name', 'trusted'], sandbox)
+        assert coordinator.wait(timeout=120) == 0, output.text()
+    finally:
+        if coordinator.poll() is None:
+            os.killpg(coordinator.pid, signal.SIGKILL)
+    assert set([row[5] for row in summary(sandbox)]) == set(['trusted'])
+
+
+def test_a_job_the_worker_cannot_run_is_reported_as_crashed(sandbox):
+    # a coordinator stand-in that hands out a job in a directory the worker lacks
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    worker = start(['--worker', '127.0.0.1:'+str(server.getsockname()[1]), '--name', 'w'], dict(sandbox, ORBIT_ENV_DISPATCH_TOKEN=''))
+    try:
+        server.settimeout(30)
+        (conn, _) = server.accept()
+        conn.settimeout(30)
+        reader = conn.makefile('r')
+        send = lambda msg: conn.sendall((json.dumps(msg)+'\n').encode('utf-8'))
+        assert json.loads(reader.readline())['type'] == 'hello'
+        send({'type': 'welcome', 'name': 'w'})
+        result = None
+        for line in reader:
+            msg = json.loads(line)
+            if msg['type'] == 'request' and result is None:
+                result = {}
+                send({'type': 'job', 'id': 0, 'name': '0-unit1', 'plugin': 'gsim', 'args': [], 'env': {}, 'cwd': os.path.join(sandbox['ORBIT_BUILD_DIR'], 'missing')})
+            elif msg['type'] == 'result':
+                result = msg
+                break
+        send({'type': 'done'})
+        assert result['id'] == 0 and result['rc'] not in (0, 101)
+    finally:
+        server.close()
+        if worker.poll() is None:
+            os.killpg(worker.pid, signal.SIGKILL)
@@ -0,0 +1,77 @@
+# Project: orbit-profile
+# Test: test_zipp.py
+#
+# Downloads archives with the zipp protocol from a local HTTP server that
+# interrupts its transfers.
+
+import os, io, sys, hashlib, zipfile, subprocess
+
+from conftest import PROFILE_DIR
+
+ZIPP = os.path.join(PROFILE_DIR, 'protocols', 'zipp.py')
+
+# contents that do not compress, so the archive spans several of zipp's chunks
+# and an interrupted transfer leaves whole chunks behind
+PAYLOAD = os.urandom(3 * 1024 * 1024)
+
+
+def make_zip() -> bytes:
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, 'w') as z:
+        z.writestr('pkg/data.bin', PAYLOAD)
+        z.writestr('pkg/Orbit.toml', '[ip]\nname = "pkg"\n')
+    return data.getvalue()
+
+
+def zipp(args, env, cwd) -> subprocess.CompletedProcess:
+    return subprocess.run([sys.executable, ZIPP, '--no-cache', '--no-store'] + args, env=env, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True, timeout=60)
+
+
+def test_resumes_an_interrupted_transfer(http_server, protocol_env, tmp_path):
+    archive = make_zip()
+    http_server.files['pkg.zip'] = archive
+    http_server.drops = 1
+    proc = zipp([http_server.url('pkg.zip')], protocol_env, str(tmp_path))
+    assert proc.returncode == 0, proc.stdout
+    assert 'resuming' in proc.stdout
+    # the second request only asks for the bytes that were not saved
+    assert len(http_server.requests) == 2 and http_server.requests[0] == ('pkg.zip', None)
+    start = int(http_server.requests[1][1].split('=')[1].rstrip('-'))
+    assert 0 < start <= len(archive) // 2
+    with open(tmp_path / 'pkg' / 'data.bin', 'rb') as f:
+        assert f.read() == PAYLOAD
+
+
+def test_resumes_a_partial_file_left_by_an_earlier_run(http_server, protocol_env, tmp_path):
+    archive = make_zip()
+    http_server.files['pkg.zip'] = archive
+    # every attempt of the first run is cut short
+    http_server.drops = 100
+    proc = zipp([http_server.url('pkg.zip')], protocol_env, str(tmp_path))
+    assert proc.returncode == 101, proc.stdout
+    assert os.path.exists(tmp_path / 'pkg') == False
+
+    http_server.drops = 0
+    http_server.requests.clear()
+    proc = zipp([http_server.url('pkg.zip')], protocol_env, str(tmp_path))
+    assert proc.returncode == 0, proc.stdout
+    (_, ranged) = http_server.requests[0]
+    assert ranged is not None and ranged != 'bytes=0-'
+    with open(tmp_path / 'pkg' / 'data.bin', 'rb') as f:
+        assert f.read() == PAYLOAD
+
+
+def test_discards_an_archive_with_the_wrong_checksum(http_server, protocol_env, tmp_path):
+    archive = make_zip()
+    http_server.files['pkg.zip'] = archive
+    url = http_server.url('pkg.zip')
+    proc = zipp([url, '--checksum', 'sha256='+hashlib.sha256(b'other').hexdigest()], protocol_env, str(tmp_path))
+    assert proc.returncode == 101, proc.stdout
+    assert 'checksum mismatch' in proc.stdout
+    assert os.path.exists(tmp_path / 'pkg') == False
+
+    # the next attempt downloads the archive from the start
+    http_server.requests.clear()
+    proc = zipp([url+'#sha256='+hashlib.sha256(archive).hexdigest()], protocol_env, str(tmp_path))
+    assert proc.returncode == 0, proc.stdout
+    assert http_server.requests == [('pkg.zip', None)]